@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
-
-import datetime
-import hashlib
-import os
-import pickle
+from blockstore import BlockLog, CaseState, ChainOfCustody, CustodyEvent, ItemIndex, LazyChain
 import sys
+from blockstore import BlockLog, CaseState, ChainOfCustody, ItemIndex, LazyChain
+from metrics import Session
 '''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     Authors:        MinhHien Luong
     File Name:      blockchain.py
@@ -13,47 +11,20 @@ import sys
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 '''
 
-class Case:
-    def __init__(self, case_id):
-        self.case_id = case_id
-        self.items = []
-
-    def add_item(self, item_id):
-        self.items.append({
-            'item_id': item_id,
-            'status': 'CHECKEDIN',
-            'time': datetime.datetime.now().isoformat(),
-        })
-
-    def get_items(self):
-        return self.items
-
-class ChainOfCustody:
-    def __init__(self, data, previous_hash):
-        self.timestamp = datetime.datetime.now()
-        self.data = data
-        self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self):
-        sha = hashlib.sha256()
-        sha.update(str(self.timestamp).encode('utf-8') +
-                   str(self.data).encode('utf-8') +
-                   str(self.previous_hash).encode('utf-8'))
-        return sha.hexdigest()
+class Case(CaseState):
+    pass
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, fsync=None):
         self.blocks_file = 'blocks.bin'
-        if os.path.exists(self.blocks_file):
-            with open(self.blocks_file, 'rb') as f:
-                self.chain = pickle.load(f)
-                print(f"Blockchain file found with INITIAL block.")
+        self.store = BlockLog(self.blocks_file, fsync)
+        self.chain = LazyChain(self.store, ChainOfCustody.decode)
+        if len(self.store):
+            print(f"Blockchain file found with INITIAL block.")
         else:
-            self.chain = [self.create_genesis_block()]
-            with open(self.blocks_file, 'wb') as f:
-                pickle.dump(self.chain, f)
-                print(f"Blockchain file not found. Created INITIAL block.")
+            self.store.append(self.create_genesis_block().raw)
+            print(f"Blockchain file not found. Created INITIAL block.")
+        self.items = ItemIndex(self.store, self.chain)
 
 
     def create_genesis_block(self):
@@ -62,25 +33,21 @@ class Blockchain:
     def add_block(self, new_data):
         previous_hash = self.chain[-1].hash
         new_block = ChainOfCustody(new_data, previous_hash)
-        self.chain.append(new_block)
-        with open(self.blocks_file, 'wb') as f:
-            pickle.dump(self.chain, f)
+        self.store.append(new_block.raw)
+        self.items.update(len(self.store) - 1, new_block)
+
+    def close(self):
+        self.items.checkpoint()
+        self.store.close()
 
     def get_chain(self):
         return self.chain
 
     def get_cases(self):
-        cases = {}
-        for block in self.chain:
-            if isinstance(block.data, Case):
-                cases[block.data.case_id] = block.data
-        return cases
+        return self.items.get_cases(Case)
 
     def get_case(self, case_id):
-        for block in self.chain:
-            if isinstance(block.data, Case) and block.data.case_id == case_id:
-                return block.data
-        return None
+        return self.items.get_case(case_id, Case)
 
 '''
 # Example usage
@@ -102,9 +69,9 @@ if __name__ == '__main__':
             case = block.data
             print(f"Case ID: {case.case_id}")
             for item in case.get_items():
-                print(f"Item ID: {item['item_id']}")
-                print(f"Status: {item['status']}")
-                print(f"Time: {item['time']}")
+                print(f"Item ID: {item.item_id}")
+                print(f"Status: {item.status}")
+                print(f"Time: {item.time}")
         else:
             print(f"Data: {block.data}")
         print(f"Previous Hash: {block.previous_hash}")
@@ -114,8 +81,16 @@ if __name__ == '__main__':
 
 if __name__ == '__main__':
 
+    # timings, when BCHOC_PROFILE / BCHOC_METRICS / BCHOC_CPROFILE ask for them
+    session = Session(sys.argv[1:])
+    session.start()
+
     # ititializes blockchain
-    blockchain = Blockchain()
+    try:
+        blockchain = Blockchain()
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
     #if((str(sys.argv[1]) == 'init')):
         #blockchain = Blockchain()
@@ -125,28 +100,21 @@ if __name__ == '__main__':
         if(str(sys.argv[2] == '-c')):
             case_id = str(sys.argv[3])
             case = Case(case_id)
+            print(f"Case: {case.case_id}")
             for x in range(4, len(sys.argv), 2):
                 if(x % 2 == 0 and (str(sys.argv[x])) == '-i'):
-                    # Make sure to check whether the item id is the same as any previous item id's and reject if so DO THIS LATER!!
-                    case.add_item(str(sys.argv[x+1]))
-            
-            # Adds Case to Block chain
-            blockchain.add_block(case)
-
-            # Taken from Howeie's original code, prints all values in the blockchain. Figure out how to print only the values added
-            for block in blockchain.get_chain():
-                if isinstance(block.data, Case):
-                    case = block.data
-                    print(f"Case: {case.case_id}")
-                    for item in case.get_items():
-                        print(f"Added item: {item['item_id']}")
-                        print(f"    Status: {item['status']}")
-                        print(f"    Time of action: {item['time']}")
-                else:
-                    print(f"Data: {block.data}")
-                    print(f"Previous Hash: {block.previous_hash}")
-                    print(f"Hash: {block.hash}")
-                    print("-----------------------------")
+                    # an item id already on the chain is rejected, as the chain would not verify
+                    event = CustodyEvent(case.case_id, sys.argv[x+1], 'CHECKEDIN')
+                    if event.item_id in blockchain.items:
+                        print(f"Error: Duplicate item ID: {event.item_id}")
+                        continue
+                    case.apply(event)
+
+                    # Adds the item's custody event to Block chain
+                    blockchain.add_block(event)
+                    print(f"Added item: {event.item_id}")
+                    print(f"    Status: {event.action}")
+                    print(f"    Time of action: {event.timestamp.isoformat()}")
     
     #elif((str(sys.argv[1]) == 'checkout')):    
 
@@ -158,6 +126,9 @@ if __name__ == '__main__':
 
     #elif((str(sys.argv[1]) == 'checkout')):
 
+    blockchain.close()
+    session.stop()
+
 
 
 
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from blockstore import BLOCK, FSYNC_CLOSE, BlockLog, ChainOfCustody, CustodyEvent, from_micros
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      benchmark.py
+    Description:    Benchmarks for the chain of custody scripts.
+                    Generates synthetic chains of any size and
+                    times loading, lookups, appends, status
+                    changes, log and verify on each variant of
+                    the CLI (bchoc.py, gradescope.py, mhl_bl.py,
+                    blockchain.py), writing the results as JSON
+                    and comparing them against an earlier run.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# usage:
+#   benchmark.py run --sizes 1000 100000 --out results.json
+#   benchmark.py run --baseline results.json        (exits 1 on a regression)
+#   benchmark.py generate DIR --events 10000000     (just write a chain)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+VARIANTS = ('bchoc', 'gradescope', 'mhl_bl')
+START_MICROS = 1_700_000_000_000_000
+
+# share of generated events by kind; the rest are checkouts and checkins
+ADD_SHARE = 0.4
+REMOVE_SHARE = 0.05
+REMOVE_REASONS = ('DISPOSED', 'DESTROYED', 'RELEASED')
+
+# operations that took less than this in total are too noisy to compare
+NOISE_FLOOR = 0.005
+
+
+# Writes a valid chain of `events` custody events (plus the genesis block)
+# to <directory>/blocks.bin: items are added to `cases` random cases, then
+# checked out, checked in and removed, always along legal transitions, so
+# the chain verifies clean. Returns a sample of its case ids and checked in
+# items for the benchmarks to work on. The same seed gives the same chain.
+def generate(directory, events, cases, seed=0, sample=1000):
+    rng = random.Random(seed)
+    case_ids = [rng.getrandbits(128).to_bytes(16, 'little') for _ in range(cases)]
+    item_case = []         # item id -> index of its case
+    statuses = []          # item id -> state
+    movable = []           # item ids that are not removed
+
+    path = os.path.join(directory, 'blocks.bin')
+    store = BlockLog(path, FSYNC_CLOSE)
+    genesis = ChainOfCustody("Genesis Block", "0", from_micros(START_MICROS))
+    store.append(genesis.raw)
+    prev = hashlib.sha256(genesis.raw).digest()
+    batch = []
+    for n in range(events):
+        roll = rng.random()
+        if roll < ADD_SHARE or not movable:
+            item_id = len(statuses)
+            item_case.append(rng.randrange(cases))
+            statuses.append('CHECKEDIN')
+            movable.append(item_id)
+            state, owner = 'CHECKEDIN', b''
+        else:
+            slot = rng.randrange(len(movable))
+            item_id = movable[slot]
+            owner = b''
+            if statuses[item_id] == 'CHECKEDOUT':
+                state = 'CHECKEDIN'
+            elif roll < ADD_SHARE + REMOVE_SHARE:
+                state = rng.choice(REMOVE_REASONS)
+                owner = b'bench' if state == 'RELEASED' else b''
+                movable[slot] = movable[-1]
+                movable.pop()
+            else:
+                state = 'CHECKEDOUT'
+            statuses[item_id] = state
+        raw = BLOCK.pack(prev, START_MICROS + (n + 1) * 1_000_000, case_ids[item_case[item_id]],
+                         item_id, state.encode('ascii'), len(owner)) + owner
+        prev = hashlib.sha256(raw).digest()
+        batch.append(raw)
+        if len(batch) >= 10000:
+            store.append_many(batch)
+            batch.clear()
+    store.append_many(batch)
+    store.close()
+
+    checkedin = [i for i in range(len(statuses)) if statuses[i] == 'CHECKEDIN']
+
+    return {
+        'events': events,
+        'cases': [str(CustodyEvent(case_id, 0, 'CHECKEDIN').case_id) for case_id in case_ids[:sample]],
+        'next_item': len(statuses),
+        'checkedin': rng.sample(checkedin, min(sample, len(checkedin))),
+    }
+
+
+# one named measurement: total seconds over `count` calls
+class Timings:
+    def __init__(self):
+        self.ops = {}
+
+    @contextlib.contextmanager
+    def time(self, name, count=1):
+        start = time.perf_counter()
+        yield
+        self.ops[name] = {'seconds': time.perf_counter() - start, 'count': count}
+
+    def skip(self, name, reason):
+        self.ops[name] = {'skipped': reason}
+
+
+# the variants share the storage layer but not their command APIs;
+# these return False when a variant has no way to do the operation
+def change_status(module, bl, case_id, item_id, action, owner=None):
+    if hasattr(bl, 'change_status'):
+        bl.change_status(item_id, action, owner)
+        return True
+    case_class = module.Case
+    method = {'CHECKEDOUT': 'checkout', 'CHECKEDIN': 'checkin'}.get(action, 'remove')
+    if not hasattr(case_class, method):
+        return False
+    module.blockchain = bl
+    case = bl.get_case(case_id) or case_class(case_id)
+    if method == 'remove':
+        case.remove(item_id, action, owner or 'null')
+    else:
+        getattr(case, method)(item_id)
+    return True
+
+
+def status_benchmark(timings, name, module, bl, targets, action, owner=None):
+    start = time.perf_counter()
+    for case_id, item_id in targets:
+        if not change_status(module, bl, case_id, item_id, action, owner):
+            timings.skip(name, 'not supported by this variant')
+            return
+    timings.ops[name] = {'seconds': time.perf_counter() - start, 'count': len(targets)}
+
+
+# Runs in a fresh interpreter (see run_variant) inside a copy of the
+# generated chain, so every variant starts cold and its peak RSS is its own.
+def measure(variant, meta, ops):
+    sys.path.insert(0, HERE)
+    from verify import verify_chain
+    module = importlib.import_module(variant)
+    timings = Timings()
+    rng = random.Random(1)
+    cases = meta['cases']
+
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        with timings.time('load'):
+            bl = module.Blockchain()
+        with timings.time('get_case_cold'):
+            bl.get_case(cases[0])
+        lookups = [rng.choice(cases) for _ in range(ops)]
+        with timings.time('get_case', len(lookups)):
+            for case_id in lookups:
+                bl.get_case(case_id)
+        items = [(bl.items.get(item_id).case_id, item_id) for item_id in meta['checkedin'][:ops]]
+
+        new_items = range(meta['next_item'], meta['next_item'] + ops)
+        with timings.time('add_block', ops):
+            for item_id in new_items:
+                bl.add_block(CustodyEvent(rng.choice(cases), item_id, 'CHECKEDIN'))
+
+        half = items[:len(items) // 2]
+        status_benchmark(timings, 'checkout', module, bl, half, 'CHECKEDOUT')
+        status_benchmark(timings, 'checkin', module, bl, half, 'CHECKEDIN')
+        status_benchmark(timings, 'remove', module, bl, items[len(items) // 2:], 'RELEASED', 'bench')
+
+        if hasattr(bl, 'log'):
+            with timings.time('log_full'):
+                bl.log(out=null)
+            with timings.time('log_reverse_10'):
+                bl.log(reverse=True, num_entries=10, out=null)
+            with timings.time('log_item', len(items)):
+                for _, item_id in items:
+                    bl.log(item_id=item_id, out=null)
+        else:
+            for name in ('log_full', 'log_reverse_10', 'log_item'):
+                timings.skip(name, 'not supported by this variant')
+
+        with timings.time('verify_full'):
+            result = verify_chain(bl.store, full=True)
+        with timings.time('verify_incremental'):
+            verify_chain(bl.store)
+        with timings.time('close'):
+            bl.close()
+
+        # the same chain again, now that close() has left a snapshot behind
+        with timings.time('reload'):
+            bl = module.Blockchain()
+        with timings.time('get_case_snapshot'):
+            bl.get_case(cases[0])
+        bl.close()
+
+    return {
+        'variant': variant,
+        'events': meta['events'],
+        'clean': result.clean(),
+        'ops': timings.ops,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_variant(variant, chain_dir, meta, ops):
+    with tempfile.TemporaryDirectory() as work:
+        shutil.copy(os.path.join(chain_dir, 'blocks.bin'), work)
+        with open(os.path.join(work, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'measure', variant,
+                               '--ops', str(ops)], cwd=work, stdout=subprocess.PIPE, check=True)
+    return json.loads(proc.stdout)
+
+
+def per_op(entry):
+    if 'skipped' in entry:
+        return None
+    return entry['seconds'] / max(entry['count'], 1)
+
+
+def print_results(results):
+    for result in results:
+        print(f"\n{result['variant']}, {result['events']} events "
+              f"(peak RSS {result['peak_rss_kb'] / 1024:.1f} MiB, "
+              f"{'CLEAN' if result['clean'] else 'NOT CLEAN'})")
+        for name, entry in result['ops'].items():
+            seconds = per_op(entry)
+            if seconds is None:
+                print(f"  {name:20} skipped ({entry['skipped']})")
+            else:
+                print(f"  {name:20} {seconds * 1000:10.3f} ms/op  x{entry['count']}")
+
+
+# ops that got more than `threshold` times slower per call than in `baseline`
+def regressions(baseline, results, threshold):
+    before = {(r['variant'], r['events']): r['ops'] for r in baseline['results']}
+    found = []
+    for result in results:
+        old_ops = before.get((result['variant'], result['events']), {})
+        for name, entry in result['ops'].items():
+            old_entry = old_ops.get(name, {'skipped': ''})
+            if per_op(old_entry) is None or per_op(entry) is None:
+                continue
+            if max(old_entry['seconds'], entry['seconds']) < NOISE_FLOOR:
+                continue
+            old, new = per_op(old_entry), per_op(entry)
+            if new / old > threshold:
+                found.append((result['variant'], result['events'], name, new / old))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the chain of custody scripts')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='generate chains and benchmark every variant on them')
+    parser_run.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='number of events in each generated chain')
+    parser_run.add_argument('--variants', nargs='+', default=list(VARIANTS),
+                            help='modules to benchmark (any of bchoc, gradescope, mhl_bl, blockchain)')
+    parser_run.add_argument('--ops', type=int, default=100, help='calls per repeated operation')
+    parser_run.add_argument('--seed', type=int, default=0)
+    parser_run.add_argument('--out', default='bench_results.json', help='where to write the results')
+    parser_run.add_argument('--baseline', help='earlier results to compare against')
+    parser_run.add_argument('--threshold', type=float, default=1.25,
+                            help='slowdown per op over the baseline that counts as a regression')
+
+    parser_generate = subparsers.add_parser('generate', help='only write a synthetic chain')
+    parser_generate.add_argument('directory')
+    parser_generate.add_argument('--events', type=int, default=100000)
+    parser_generate.add_argument('--cases', type=int, help='default: one per 100 events')
+    parser_generate.add_argument('--seed', type=int, default=0)
+
+    parser_measure = subparsers.add_parser('measure', help=argparse.SUPPRESS)
+    parser_measure.add_argument('variant')
+    parser_measure.add_argument('--ops', type=int, default=100)
+
+    args = parser.parse_args()
+
+    if args.command == 'measure':
+        with open('meta.json') as f:
+            meta = json.load(f)
+        json.dump(measure(args.variant, meta, args.ops), sys.stdout)
+        return 0
+
+    if args.command == 'generate':
+        os.makedirs(args.directory, exist_ok=True)
+        start = time.perf_counter()
+        meta = generate(args.directory, args.events, args.cases or max(args.events // 100, 1), args.seed)
+        with open(os.path.join(args.directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        print(f"{args.events} events written to {args.directory} in {time.perf_counter() - start:.1f} s")
+        return 0
+
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as chain_dir:
+            start = time.perf_counter()
+            meta = generate(chain_dir, size, max(size // 100, 1), args.seed)
+            print(f"generated {size} events in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+            for variant in args.variants:
+                print(f"  benchmarking {variant}", file=sys.stderr)
+                results.append(run_variant(variant, chain_dir, meta, args.ops))
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'ops': args.ops,
+        'results': results,
+    }
+    print_results(results)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nresults written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(baseline, results, args.threshold)
+        for variant, events, name, ratio in found:
+            print(f"REGRESSION: {variant} {name} at {events} events is {ratio:.2f}x slower")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,6 @@
-import datetime
-import hashlib
-import os
-import pickle
 import sys
+from blockstore import BlockLog, CaseState, ChainOfCustody, CustodyEvent, ItemIndex, LazyChain
+from verify import verify_chain
 '''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     Authors:        MinhHien Luong
     File Name:      blockchain.py
@@ -11,114 +9,81 @@ import sys
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 '''
 
-class Case:
-    def __init__(self, case_id):
-        self.case_id = case_id
-        self.items = []
-
+class Case(CaseState):
     def add(self, item_ids):
-        a = False
-        print(f"Case: {case_id}")
-        time = datetime.datetime.now().isoformat()
+        print(f"Case: {self.case_id}")
         for i in item_ids:
-            for block in blockchain.get_chain():
-                if isinstance(block.data, Case):
-                    case = block.data
-                    for item in case.get_items():
-                        if (item['item_id'] == i):
-                            print("VERIFY ISSUE: duplicate block added")
-                            a = True
-                        if a:
-                            break
-            self.items.append({
-            'item_id': i,
-            'status': 'CHECKEDIN',
-            'time': time,})
+            if i in blockchain.items:
+                print("VERIFY ISSUE: duplicate block added")
+            event = self.add_item(i)
+            blockchain.add_block(event)
             print(f"Added item: {i}")
-            print(f"Status: CHECKEDIN")
-            print(f"Time of action: {time}")
-
+            print(f"Status: {event.action}")
+            print(f"Time of action: {event.timestamp.isoformat()}")
+
+    # puts a status change for an item that is already on the chain into
+    # a new block, against whichever case the item belongs to
+    def record(self, entry, item_id, action, owner=None):
+        event = CustodyEvent(entry.case_id, item_id, action, owner)
+        blockchain.add_block(event)
+        if event.case_id == self.case_id:
+            self.apply(event)
+        return event
 
     def checkout(self, input_item_id):
-        print(f"Case: {case_id}")
-        for block in blockchain.get_chain():
-            if isinstance(block.data, Case):
-                case = block.data
-                for item in case.get_items():
-                    if (item['item_id'] == input_item_id):
-                        if (item['status'] != "CHECKEDIN"):
-                            print("Error: Cannot check out a checked out item. Must check it in first.")
-                        else:
-                            item['status'] = "CHECKEDOUT"
-                            print(f"Checked out item: {item['item_id']}")
-                            print(f"Status: {item['status']}")
-                            print(f"Time of action: {datetime.datetime.now().isoformat()}")
-                        return None
+        print(f"Case: {self.case_id}")
+        entry = blockchain.items.get(input_item_id)
+        if entry is None:
+            return None
+        if (entry.status != "CHECKEDIN"):
+            print("Error: Cannot check out a checked out item. Must check it in first.")
+        else:
+            event = self.record(entry, input_item_id, "CHECKEDOUT")
+            print(f"Checked out item: {event.item_id}")
+            print(f"Status: {event.action}")
+            print(f"Time of action: {event.timestamp.isoformat()}")
 
     def checkin(self, input_item_id):
-        print(f"Case: {case_id}")
-        for block in blockchain.get_chain():
-            if isinstance(block.data, Case):
-                case = block.data
-                for item in case.get_items():
-                    if (item['item_id'] == input_item_id):
-                        if (item['status'] == "CHECKEDOUT"):
-                            item['status'] = "CHECKEDIN"
-                            print(f"Checked out item: {item['item_id']}")
-                            print(f"Status: {item['status']}")
-                            print(f"Time of action: {datetime.datetime.now().isoformat()}")
-                        return None
-    
-    def remove(self, input_item_id, reason, owner_info):
-        print(f"Case: {case_id}")
-        for block in blockchain.get_chain():
-            if isinstance(block.data, Case):
-                case = block.data
-                for item in case.get_items():
-                    if (item['item_id'] == input_item_id):
-                        if (item['status'] == "CHECKEDIN"):
-                            item['status'] = reason
-                            print(f"Removed item: {item['item_id']}")
-                            print(f"Status: {item['status']}")
-                            if owner_info == "null":
-                                if reason == "RELEASED":
-                                    print("VERIFY ISSUE: released but no owner given")
-                            else:
-                                print(f"Owner info: {owner_info}")
-                            print(f"Time of action: {datetime.datetime.now().isoformat()}")
-                        else:
-                            print("Error: Cannot remove out a checked out item. Must check it in first.")
-                        return None
+        print(f"Case: {self.case_id}")
+        entry = blockchain.items.get(input_item_id)
+        if entry is None:
+            return None
+        if (entry.status == "CHECKEDOUT"):
+            event = self.record(entry, input_item_id, "CHECKEDIN")
+            print(f"Checked out item: {event.item_id}")
+            print(f"Status: {event.action}")
+            print(f"Time of action: {event.timestamp.isoformat()}")
 
-    def get_items(self):
-        return self.items
-
-class ChainOfCustody:
-    def __init__(self, data, previous_hash):
-        self.timestamp = datetime.datetime.now()
-        self.data = data
-        self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self):
-        sha = hashlib.sha256()
-        sha.update(str(self.timestamp).encode('utf-8') +
-                   str(self.data).encode('utf-8') +
-                   str(self.previous_hash).encode('utf-8'))
-        return sha.hexdigest()
+    def remove(self, input_item_id, reason, owner_info):
+        print(f"Case: {self.case_id}")
+        entry = blockchain.items.get(input_item_id)
+        if entry is None:
+            return None
+        if (entry.status == "CHECKEDIN"):
+            owner = None if owner_info == "null" else owner_info
+            event = self.record(entry, input_item_id, reason, owner)
+            print(f"Removed item: {event.item_id}")
+            print(f"Status: {event.action}")
+            if owner is None:
+                if reason == "RELEASED":
+                    print("VERIFY ISSUE: released but no owner given")
+            else:
+                print(f"Owner info: {owner}")
+            print(f"Time of action: {event.timestamp.isoformat()}")
+        else:
+            print("Error: Cannot remove out a checked out item. Must check it in first.")
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, fsync=None):
         self.blocks_file = 'blocks.bin'
-        if os.path.exists(self.blocks_file):
+        self.store = BlockLog(self.blocks_file, fsync)
+        self.chain = LazyChain(self.store, ChainOfCustody.decode)
+        if len(self.store):
             print("Blockchain file found with INITIAL block.")
-            with open(self.blocks_file, 'rb') as f:
-                self.chain = pickle.load(f)
         else:
             print("Blockchain file not found. Created INITIAL block.")
-            self.chain = [self.create_genesis_block()]
-            with open(self.blocks_file, 'wb') as f:
-                pickle.dump(self.chain, f)
+            self.store.append(self.create_genesis_block().raw)
+        self.items = ItemIndex(self.store, self.chain)
 
     def create_genesis_block(self):
         return ChainOfCustody("Genesis Block", "0")
@@ -126,25 +91,21 @@ class Blockchain:
     def add_block(self, new_data):
         previous_hash = self.chain[-1].hash
         new_block = ChainOfCustody(new_data, previous_hash)
-        self.chain.append(new_block)
-        with open(self.blocks_file, 'wb') as f:
-            pickle.dump(self.chain, f)
+        self.store.append(new_block.raw)
+        self.items.update(len(self.store) - 1, new_block)
+
+    def close(self):
+        self.items.checkpoint()
+        self.store.close()
 
     def get_chain(self):
         return self.chain
 
     def get_cases(self):
-        cases = {}
-        for block in self.chain:
-            if isinstance(block.data, Case):
-                cases[block.data.case_id] = block.data
-        return cases
+        return self.items.get_cases(Case)
 
     def get_case(self, case_id):
-        for block in self.chain:
-            if isinstance(block.data, Case) and block.data.case_id == case_id:
-                return block.data
-        return None
+        return self.items.get_case(case_id, Case)
 
 #runProgram class pushed by Leon Kwong
 """
@@ -198,7 +159,11 @@ class runProgram:
                 Case.__init__
 
             case "verify":
-                print("verify function empty")
+                jobs = 1
+                if "--jobs" in sys.argv:
+                    jobs = int(sys.argv[sys.argv.index("--jobs") + 1])
+                result = verify_chain(blockchain.store, full="--full" in sys.argv, jobs=jobs)
+                print(result.report())
 
 
 # Example usage
@@ -211,17 +176,14 @@ if __name__ == '__main__':
     ids = [12345, 34567] #info taken from input
     case = Case(case_id)
     case.add(ids)
-    blockchain.add_block(case) 
     print("\n")
 
     ids = [678]
     case.add(ids)
-    blockchain.add_block(case) 
     print("\n")
     
     ids = [998]
     case.add(ids)
-    blockchain.add_block(case) 
     print("\n")
     
     case.checkout(678)
@@ -229,12 +191,10 @@ if __name__ == '__main__':
 
     ids = [34567, 66666] # first id already added
     case.add(ids)
-    blockchain.add_block(case) 
     print("\n")
 
     ids = [11, 11] # same id added twice
     case.add(ids)
-    blockchain.add_block(case) 
     print("\n")
 
     case.checkout(998)
@@ -257,24 +217,22 @@ if __name__ == '__main__':
     # Add a case with a few items to the chain
     case_id = '65cc391d-6568-4dcc-a3f1-86a2f04140f3'
     case = Case(case_id)
-    case.add_item(987654321)
-    case.add_item(123456789)
-    blockchain.add_block(case)
+    blockchain.add_block(case.add_item(987654321))
+    blockchain.add_block(case.add_item(123456789))
 
     # Print out the blockchain
     for block in blockchain.get_chain():
         print(f"Timestamp: {block.timestamp}")
-        if isinstance(block.data, Case):
-            case = block.data
-            print(f"Case ID: {case.case_id}")
-            for item in case.get_items():
-                print(f"Item ID: {item['item_id']}")
-                print(f"Status: {item['status']}")
-                print(f"Time: {item['time']}")
+        if isinstance(block.data, CustodyEvent):
+            event = block.data
+            print(f"Case ID: {event.case_id}")
+            print(f"Item ID: {event.item_id}")
+            print(f"Status: {event.action}")
+            print(f"Time: {event.timestamp.isoformat()}")
         else:
             print(f"Data: {block.data}")
         print(f"Previous Hash: {block.previous_hash}")
         print(f"Hash: {block.hash}")
         print("-----------------------------")
-        
 
+    blockchain.close()
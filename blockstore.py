@@ -0,0 +1,1240 @@
+import array
+import bisect
+import fcntl
+import gc
+import itertools
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import OrderedDict
+from collections.abc import Sequence
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      blockstore.py
+    Description:    Append-only on-disk storage for the chain
+                    of custody. Every block is written once, at
+                    the end of the file, as a length-prefixed
+                    record behind a small file header. Blocks
+                    are read back lazily through mmap and an
+                    offset index kept next to the log. A block
+                    holds one custody event; case state is
+                    rebuilt by replaying the events.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# file layout:  header = magic (8 bytes) + format version (u32)
+#               record = payload length (u32) + payload bytes
+#               payload = one block record (see BLOCK below)
+#               <path>.idx = u64 offset of every record, in order
+#               <path>.head = record count (u64) + end offset (u64) +
+#                             sha256 of the last record (see BlockLog)
+MAGIC = b'BCHOCLOG'
+VERSION = 3
+HEADER = struct.Struct('<8sI')
+RECORD_LEN = struct.Struct('<I')
+HEAD = struct.Struct('<QQ32s')
+INDEX_ENTRY = struct.Struct('=Q')
+
+# fsync policies
+#   batch -- fsync once per append / append_many() call, so a single
+#            block added on its own is durable before the call returns,
+#            and a batch becomes durable as a whole (the default)
+#   close -- fsync only when the log is closed
+# 'block', the name the first policy used to go by, is still accepted.
+FSYNC_BATCH = 'batch'
+FSYNC_CLOSE = 'close'
+FSYNC_POLICIES = (FSYNC_BATCH, FSYNC_CLOSE)
+FSYNC_ALIASES = {'block': FSYNC_BATCH}
+
+
+def default_fsync_policy():
+    policy = os.environ.get('BCHOC_FSYNC', FSYNC_BATCH)
+    policy = FSYNC_ALIASES.get(policy, policy)
+    if policy not in FSYNC_POLICIES:
+        raise ValueError(f"Unknown fsync policy: {policy}")
+    return policy
+
+
+def read_version(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        return None
+    magic, version = HEADER.unpack(raw)
+    if magic != MAGIC:
+        return None
+    return version
+
+
+# (record count, end offset, head digest) last published for the log at
+# `path` (see BlockLog), or None if there is none
+def read_head(path):
+    try:
+        with open(path + '.head', 'rb') as f:
+            return HEAD.unpack(f.read(HEAD.size))
+    except (OSError, struct.error):
+        return None
+
+
+# data of the first block of the log at `path`, or None if there is none
+# yet; it never changes once written, so no lock is needed to read it
+def read_genesis(path):
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read(HEADER.size + RECORD_LEN.size + BLOCK.size)
+            if len(raw) < HEADER.size + RECORD_LEN.size + BLOCK.size or raw[:len(MAGIC)] != MAGIC:
+                return None
+            fields = BLOCK.unpack_from(raw, HEADER.size + RECORD_LEN.size)
+            return f.read(fields[5]).decode('utf-8', 'replace')
+    except OSError:
+        return None
+
+
+# block record, every field fixed width except the trailing data:
+#   previous hash (32 bytes, raw sha256), timestamp (i64, microseconds
+#   since the epoch, UTC), case id (16 bytes, UUID), item id (u32),
+#   state (12 bytes, ASCII, NUL padded), data length (u32), data
+# The hash of a block is the sha256 of exactly these bytes.
+BLOCK = struct.Struct('<32sq16sI12sI')
+GENESIS_STATE = 'INITIAL'
+# state of the blocks on the root chain of a sharded log that record the
+# heads of its shards (see shards.py)
+ANCHOR_STATE = 'ANCHOR'
+# state of the custody events that record the digests of an item's
+# evidence image (see digests.py); the item stays in the state it was in
+DIGEST_STATE = 'HASHED'
+
+
+# Times are kept as epoch microseconds (UTC), which is what blocks store.
+# datetime and hashlib cost more to import than the rest of this module,
+# so they are only imported by the functions that need them: a block's
+# timestamp and hash are worked out when they are first asked for, and
+# log entries format their times without datetime.
+def now_micros():
+    return time.time_ns() // 1000
+
+
+def to_micros(timestamp):
+    import datetime
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.astimezone()
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return (timestamp - epoch) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    import datetime
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return epoch + datetime.timedelta(microseconds=micros)
+
+
+# the time as from_micros(micros).isoformat() gives it
+def format_micros(micros):
+    second, fraction = divmod(micros, 10 ** 6)
+    t = time.gmtime(second)
+    text = (f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}'
+            f'T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}')
+    if fraction:
+        return f'{text}.{fraction:06d}+00:00'
+    return f'{text}+00:00'
+
+
+def sha256(data):
+    import hashlib
+    return hashlib.sha256(data)
+
+
+# Hashed as a blockchain system
+# A block takes the time of the event it holds unless given one.
+class ChainOfCustody:
+    def __init__(self, data, previous_hash, timestamp=None):
+        if timestamp is not None:
+            self.micros = to_micros(timestamp)
+        elif isinstance(data, CustodyEvent):
+            self.micros = data.micros
+        else:
+            self.micros = now_micros()
+        self.data = data
+        self.previous_hash = previous_hash
+        self.raw = self.encode()
+
+    @property
+    def timestamp(self):
+        return from_micros(self.micros)
+
+    @property
+    def hash(self):
+        return self.calculate_hash()
+
+    def encode(self):
+        prev = bytes.fromhex(self.previous_hash) if len(self.previous_hash) == 64 else bytes(32)
+        event = self.data
+        if isinstance(event, CustodyEvent):
+            case_id = bytes.fromhex(event.case_id.replace('-', ''))
+            fields = (case_id, event.item_id, event.action, (event.owner or '').encode('utf-8'))
+        elif isinstance(event, Anchor):
+            fields = (bytes(16), 0, ANCHOR_STATE, event.encode())
+        else:
+            fields = (bytes(16), 0, GENESIS_STATE, str(event).encode('utf-8'))
+        case_id, item_id, state, data = fields
+        return BLOCK.pack(prev, self.micros, case_id, item_id,
+                          state.encode('ascii'), len(data)) + data
+
+    def calculate_hash(self):
+        return sha256(self.raw).hexdigest()
+
+    # rebuilds a block from its stored bytes, keeping those exact bytes
+    @classmethod
+    def decode(cls, raw):
+        prev, micros, case_id, item_id, state, length = BLOCK.unpack_from(raw)
+        data = bytes(raw[BLOCK.size:BLOCK.size + length]).decode('utf-8')
+        state = state.rstrip(b'\0').decode('ascii')
+        block = cls.__new__(cls)
+        block.micros = micros
+        block.previous_hash = prev.hex()
+        if state == GENESIS_STATE:
+            block.data = data
+        elif state == ANCHOR_STATE:
+            block.data = Anchor.decode(data)
+        else:
+            block.data = CustodyEvent(case_id, item_id, state,
+                                      data or None, micros=micros)
+        block.raw = bytes(raw)
+        return block
+
+
+# The heads of the shards of a sharded log at one point in time, as
+# {shard number: (block count, sha256 hex digest of its last block)},
+# stored as one "<shard> <count> <digest>" line per shard.
+class Anchor:
+    def __init__(self, heads):
+        self.heads = heads
+
+    def encode(self):
+        return ''.join(f'{shard} {count} {digest}\n'
+                       for shard, (count, digest) in sorted(self.heads.items())).encode('ascii')
+
+    @classmethod
+    def decode(cls, text):
+        heads = {}
+        for line in text.splitlines():
+            shard, count, digest = line.split()
+            heads[int(shard)] = (int(count), digest)
+        return cls(heads)
+
+    def __str__(self):
+        return f"Anchor of {len(self.heads)} shards"
+
+
+# A case id is kept as a canonical UUID string; it may be given in any form
+# uuid.UUID accepts, or as the 16 bytes stored in a block (which skips
+# importing uuid, for the commands that only read blocks).
+def canonical_case_id(case_id):
+    if isinstance(case_id, bytes):
+        h = case_id.hex()
+        return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+    import uuid
+    return str(uuid.UUID(str(case_id)))
+
+
+# a single custody event; this is all a block carries, so the size of a
+# block does not depend on how many items its case has. `action` is the
+# state the item is in after the event (CHECKEDIN, CHECKEDOUT, DISPOSED,
+# DESTROYED or RELEASED). Case ids must be UUIDs and item ids fit in a u32.
+class CustodyEvent:
+    def __init__(self, case_id, item_id, action, owner=None, timestamp=None, micros=None):
+        self.case_id = canonical_case_id(case_id)
+        self.item_id = int(item_id)
+        if not 0 <= self.item_id < 2 ** 32:
+            raise ValueError(f"Item ID out of range: {item_id}")
+        self.action = action
+        self.owner = owner
+        if micros is None:
+            micros = now_micros() if timestamp is None else to_micros(timestamp)
+        self.micros = micros
+
+    @property
+    def timestamp(self):
+        return from_micros(self.micros)
+
+    def __repr__(self):
+        return (f"CustodyEvent({self.case_id!r}, {self.item_id!r}, {self.action!r}, "
+                f"{self.owner!r}, {format_micros(self.micros)!r})")
+
+
+# Item states are kept as small integer codes into STATES. A state that
+# is not listed (only a damaged or hand-made chain has one) is added the
+# first time it is seen, so codes are only meaningful within one process;
+# snapshots store the table they were written with.
+STATES = ['CHECKEDIN', 'CHECKEDOUT', 'DISPOSED', 'DESTROYED', 'RELEASED']
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+
+
+def state_code(state):
+    code = STATE_CODES.get(state)
+    if code is None:
+        code = STATE_CODES[state] = len(STATES)
+        STATES.append(state)
+    return code
+
+
+# The current state of one item. There is one of these per item ever
+# added, so it is a __slots__ record holding the state as a code and the
+# time of the item's last event as epoch microseconds; `status` and `time`
+# give the strings that get printed. `blocks` (the block numbers of the
+# item's events) is only filled in by ItemIndex.
+class ItemRecord:
+    __slots__ = ('item_id', 'case_id', 'code', 'micros', 'owner', 'blocks')
+
+    def __init__(self, item_id, case_id, code=0, micros=0, owner=None, blocks=None):
+        self.item_id = item_id
+        self.case_id = case_id
+        self.code = code
+        self.micros = micros
+        self.owner = owner
+        self.blocks = blocks
+
+    @property
+    def status(self):
+        return STATES[self.code]
+
+    @property
+    def time(self):
+        return format_micros(self.micros)
+
+    def record(self, event):
+        self.micros = event.micros
+        if event.action == DIGEST_STATE:
+            return
+        self.code = state_code(event.action)
+        if event.owner:
+            self.owner = event.owner
+
+    def copy(self):
+        return ItemRecord(self.item_id, self.case_id, self.code, self.micros, self.owner)
+
+    def __repr__(self):
+        return (f"ItemRecord({self.item_id!r}, {self.case_id!r}, {self.status!r}, "
+                f"{self.time!r}, {self.owner!r})")
+
+
+# current state of a case, built by replaying its custody events
+class CaseState:
+    # the StateCache this case is held in, if any; a case that is about to
+    # change leaves it first, so the cache only ever hands out cases as
+    # they are on the chain
+    cache = None
+
+    def __init__(self, case_id):
+        self.case_id = case_id
+        self.items = []
+        self.item_map = {}
+
+    def apply(self, event):
+        if self.cache is not None:
+            self.cache.release(self)
+        item = self.item_map.get(event.item_id)
+        if item is None:
+            item = self.restore(ItemRecord(event.item_id, self.case_id))
+        item.record(event)
+
+    # new item checked in to this case; returns the event to put on the chain
+    def add_item(self, item_id):
+        event = CustodyEvent(self.case_id, item_id, 'CHECKEDIN')
+        self.apply(event)
+        return event
+
+    # puts an already built item record into the case (used by snapshots)
+    def restore(self, item):
+        self.items.append(item)
+        self.item_map[item.item_id] = item
+        return item
+
+    def get_item(self, item_id):
+        return self.item_map.get(item_id)
+
+    def get_items(self):
+        return self.items
+
+
+def replay_cases(chain, case_class=CaseState):
+    cases = {}
+    for block in chain:
+        event = block.data
+        if isinstance(event, CustodyEvent):
+            case = cases.get(event.case_id)
+            if case is None:
+                case = cases[event.case_id] = case_class(event.case_id)
+            case.apply(event)
+    return cases
+
+
+# Blocks for `log`, streamed one at a time. With reverse the walk starts
+# at the end of the log, so `-r -n K` touches just the last K blocks.
+# An item's blocks alone come from the item index's cache of them.
+def iter_log(chain, items, item_id=None, reverse=False, num_entries=None,
+             since=None, until=None, status=None, case_id=None):
+    if item_id is not None and since is None and until is None and status is None and case_id is None:
+        blocks = items.history(item_id)
+        if reverse:
+            blocks = reversed(blocks)
+        yield from itertools.islice(blocks, num_entries)
+        return
+    heights = log_heights(chain, items, item_id, since, until, status, case_id)
+    if reverse:
+        heights = reversed(heights)
+    if num_entries is not None:
+        heights = itertools.islice(heights, num_entries)
+    for height in heights:
+        yield chain[height]
+
+
+# Block numbers `log` shows, in chain order, each filter answered from an
+# index so the work is proportional to what gets printed: -i from the
+# item's own blocks, --case from the blocks of the case's items, --status
+# from the set of items currently in that state (one entry per item, the
+# one that put it there) and --since/--until (epoch microseconds, both
+# inclusive) from the time index. A time range combined with the others
+# is checked against their blocks one by one.
+def log_heights(chain, items, item_id=None, since=None, until=None, status=None, case_id=None):
+    timed = since is not None or until is not None
+    if item_id is None and case_id is None and status is None:
+        return sorted(items.between(since, until)) if timed else range(len(chain))
+    candidates = None
+    if item_id is not None:
+        candidates = {item_id}
+    if case_id is not None:
+        members = set(items.case_item_ids(case_id))
+        candidates = members if candidates is None else candidates & members
+    if status is not None:
+        members = items.with_status(status)
+        candidates = members if candidates is None else candidates & members
+    heights = []
+    for candidate in candidates:
+        entry = items.get(candidate)
+        if entry is None:
+            continue
+        if status is not None:
+            heights.append(items.state_block(entry))
+        else:
+            heights.extend(entry.blocks)
+    heights.sort()
+    if timed:
+        low = -2 ** 63 if since is None else since
+        high = 2 ** 63 if until is None else until
+        heights = [height for height in heights if low <= items.block_micros(height) <= high]
+    return heights
+
+
+def format_log_entry(block):
+    event = block.data
+    if not isinstance(event, CustodyEvent):
+        return f"Item: {event}\n\n"
+    return (f"Case: {event.case_id}\nItem: {event.item_id}\nAction: {event.action}\n"
+            f"Time: {format_micros(event.micros)}\n\n")
+
+
+# formats blocks into `out` a chunk of entries per write
+def write_log(out, blocks, chunk=1024):
+    lines = []
+    for block in blocks:
+        lines.append(format_log_entry(block))
+        if len(lines) >= chunk:
+            out.write(''.join(lines))
+            lines.clear()
+    out.write(''.join(lines))
+    out.flush()
+
+
+# Record offsets of a BlockLog. The ones found in <path>.idx when the log
+# was opened are read through a read-only mmap of it, one entry at a time,
+# so opening a long log costs the same as opening a short one; the ones
+# indexed since are kept in `tail`. Slices come back as arrays.
+class OffsetIndex:
+    def __init__(self, offsets=()):
+        self.mm = None
+        self.first = 0
+        self.mapped = 0
+        self.tail = array.array('Q', offsets)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        try:
+            with open(path, 'rb') as f:
+                index.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # missing, or empty and so not mappable
+            return index
+        index.mapped = len(index.mm) // INDEX_ENTRY.size
+        return index
+
+    def __len__(self):
+        return self.mapped + len(self.tail)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("OffsetIndex slices take no step")
+            offsets = array.array('Q')
+            if start < self.mapped and start < stop:
+                end = min(stop, self.mapped)
+                offsets.frombytes(self.mm[(self.first + start) * INDEX_ENTRY.size:
+                                          (self.first + end) * INDEX_ENTRY.size])
+            offsets.extend(self.tail[max(start - self.mapped, 0):max(stop - self.mapped, 0)])
+            return offsets
+        if key < 0:
+            key += len(self)
+        if 0 <= key < self.mapped:
+            return INDEX_ENTRY.unpack_from(self.mm, (self.first + key) * INDEX_ENTRY.size)[0]
+        if key < 0:
+            raise IndexError("OffsetIndex index out of range")
+        return self.tail[key - self.mapped]
+
+    # only the ends can go: del index[n:] keeps the first n offsets, and
+    # del index[:n] drops them
+    def __delitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        if stop >= len(self):
+            if start < self.mapped:
+                self.mapped = start
+                self.tail = array.array('Q')
+            else:
+                del self.tail[start - self.mapped:]
+        elif start == 0:
+            if stop <= self.mapped:
+                self.first += stop
+                self.mapped -= stop
+            else:
+                del self.tail[:stop - self.mapped]
+                self.mapped = 0
+        else:
+            raise ValueError("OffsetIndex can only drop offsets at its ends")
+
+    # a chunk of mapped entries at a time, then the tail
+    def __iter__(self, chunk=1 << 16):
+        for start in range(0, self.mapped, chunk):
+            yield from self[start:min(start + chunk, self.mapped)]
+        yield from self.tail[:]
+
+    def append(self, offset):
+        self.tail.append(offset)
+
+    def tofile(self, f):
+        f.write(self.mm[self.first * INDEX_ENTRY.size:(self.first + self.mapped) * INDEX_ENTRY.size]
+                if self.mapped else b'')
+        self.tail.tofile(f)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.mapped = 0
+
+
+# Writers coordinate through an advisory lock on <path>.lock, held
+# exclusively for as long as the log is open. After every append a writer
+# publishes the committed length, end offset and head hash of the log in
+# <path>.head, replacing the file atomically. Readers (shared=True) take
+# no lock: they read the published head once and only look at the records
+# it covers, so they neither wait for writers nor see a half-written
+# block. A reader that finds no usable head (new log, old format, head
+# left over from another log) falls back to the lock, shared, and
+# publishes the head for the readers after it.
+class BlockLog:
+    def __init__(self, path, fsync=None, shared=False):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.head_path = path + '.head'
+        self.fsync = FSYNC_ALIASES.get(fsync, fsync) or default_fsync_policy()
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {self.fsync}")
+        self.dirty = False
+        # bytes appended since the log was opened; unlike self.end, it does
+        # not go down when drop_prefix() rewrites the file
+        self.appended = 0
+        self.mm = None
+        self.lock_file = None
+        self.cold = None
+        self.base = 0
+        self.shared = shared
+        if not (shared and self.open_published()):
+            self.open_locked()
+
+    # opens the log as of its published head; False if there is none, it
+    # does not describe the log on disk or it has no blocks to read
+    def open_published(self):
+        try:
+            with open(self.head_path, 'rb') as f:
+                count, end, head = HEAD.unpack(f.read(HEAD.size))
+            if not count or read_version(self.path) != VERSION:
+                return False
+            self.f = open(self.path, 'rb')
+        except (OSError, struct.error):
+            return False
+        self.limit = end
+        self.open_cold()
+        if count < self.base:
+            self.f.close()
+            return False
+        self.offsets = self.load_index()
+        del self.offsets[count - self.base:]
+        self.end = self.extend_index()
+        self.head = self.head_hash()
+        if self.compacted_records() or (len(self), self.end, self.head) != (count, end, head):
+            self.offsets.close()
+            self.f.close()
+            return False
+        return True
+
+    def open_locked(self):
+        path = self.path
+        self.lock_file = open(path + '.lock', 'ab')
+        fcntl.flock(self.lock_file, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        # a log without a whole record yet (missing, in an old format, or
+        # cut short before its genesis block was written) is set up as by
+        # a writer, so that the genesis block can be appended
+        if self.shared and not self.has_records():
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.shared = False
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            self.drop_index()
+            self.drop_cold()
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION))
+                f.flush()
+                os.fsync(f.fileno())
+        elif read_version(path) != VERSION:
+            from legacy import migrate_legacy
+            self.drop_index()
+            migrate_legacy(path)
+
+        self.f = open(path, 'rb' if self.shared else 'r+b')
+        self.limit = os.path.getsize(path)
+        self.open_cold()
+        self.offsets = self.load_index()
+        self.end = self.extend_index()
+        # drop a torn record left behind by a crash in the middle of an append
+        if not self.shared and self.end != self.limit:
+            self.f.truncate(self.end)
+            self.limit = self.end
+        # and blocks a compaction cut short left in both places
+        skip = self.compacted_records()
+        if skip and self.shared:
+            del self.offsets[:skip]
+        elif skip:
+            self.drop_prefix(skip)
+        self.head = self.head_hash()
+        self.publish_head()
+        self.f.seek(self.end)
+
+    def has_records(self):
+        path = self.path
+        if not os.path.exists(path) or read_version(path) != VERSION:
+            return False
+        if os.path.exists(path + '.cold.idx'):
+            return True
+        with open(path, 'rb') as f:
+            f.seek(HEADER.size)
+            raw = f.read(RECORD_LEN.size)
+            if len(raw) < RECORD_LEN.size:
+                return False
+            (length,) = RECORD_LEN.unpack(raw)
+            return len(f.read(length)) == length
+
+    def head_hash(self):
+        if not len(self):
+            return bytes(32)
+        return sha256(self.read(len(self) - 1)).digest()
+
+    def publish_head(self):
+        tmp_path = f'{self.head_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEAD.pack(len(self), self.end, self.head))
+        os.replace(tmp_path, self.head_path)
+
+    # the offset index (<path>.idx) is a flat array of u64 record offsets;
+    # it is only a cache and gets rebuilt whenever it does not match the log.
+    # Only its ends are read here: offsets past the end of the log (which
+    # a writer may have added since) are found by bisection.
+    def load_index(self):
+        offsets = OffsetIndex.load(self.index_path)
+        del offsets[bisect.bisect_left(offsets, self.limit):]
+        if offsets and (offsets[0] != HEADER.size or self.record_end(offsets[-1]) is None):
+            offsets.close()
+            offsets = OffsetIndex()
+        return offsets
+
+    # end offset of the record at `offset`, or None if it is not complete
+    def record_end(self, offset):
+        self.f.seek(offset)
+        raw = self.f.read(RECORD_LEN.size)
+        if len(raw) < RECORD_LEN.size:
+            return None
+        (length,) = RECORD_LEN.unpack(raw)
+        end = offset + RECORD_LEN.size + length
+        if end > self.limit:
+            return None
+        return end
+
+    # index whatever complete records follow the last indexed one
+    def extend_index(self):
+        known = len(self.offsets)
+        end = self.record_end(self.offsets[-1]) if self.offsets else HEADER.size
+        while True:
+            next_end = self.record_end(end)
+            if next_end is None:
+                break
+            self.offsets.append(end)
+            end = next_end
+        self.save_index(known)
+        return end
+
+    def drop_index(self):
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    # Appends the offsets from `start` on when the file holds exactly the
+    # ones before them, and otherwise writes it again under another name:
+    # readers may have the old one mapped.
+    def save_index(self, start):
+        if self.shared:
+            return
+        try:
+            stored = os.path.getsize(self.index_path)
+        except OSError:
+            stored = None
+        if start == 0 or stored != start * INDEX_ENTRY.size:
+            tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                self.offsets.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        elif start < len(self.offsets):
+            with open(self.index_path, 'ab') as f:
+                self.offsets[start:].tofile(f)
+
+    # Blocks moved to cold storage (see cold.py) are the first `base` blocks
+    # of the log; the file itself holds the ones after them.
+    def open_cold(self):
+        if self.cold is not None:
+            self.cold.close()
+        self.cold = None
+        self.base = 0
+        if os.path.exists(self.path + '.cold.idx'):
+            from cold import ColdSegments
+            self.cold = ColdSegments(self.path)
+            self.base = len(self.cold)
+
+    def drop_cold(self):
+        for suffix in ('.cold', '.cold.idx'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    # Records at the start of the file that are in cold storage as well,
+    # which only a compaction cut short leaves behind. The first record
+    # links to the block before it, and the cold index knows the hash of
+    # the last block of every segment.
+    def compacted_records(self):
+        if self.cold is None or not self.offsets:
+            return 0
+        prev = bytes(self.read_at(self.offsets[0])[:32])
+        start = 0 if prev == bytes(32) else self.cold.last_hashes().get(prev, self.base)
+        return max(self.base - start, 0)
+
+    # Rewrites the file without its first k records once they are in cold
+    # storage (see cold.compact), copying the rest a chunk at a time, and
+    # picks up the cold index that now covers them.
+    def drop_prefix(self, k, chunk=1 << 24):
+        start = self.offsets[k]
+        delta = start - HEADER.size
+        if self.mm is None or len(self.mm) < self.end:
+            self.remap()
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION))
+            for position in range(start, self.end, chunk):
+                f.write(self.mm[position:min(position + chunk, self.end)])
+            f.flush()
+            os.fsync(f.fileno())
+        self.mm.close()
+        self.mm = None
+        self.f.close()
+        os.replace(tmp_path, self.path)
+        self.f = open(self.path, 'r+b')
+        offsets = OffsetIndex(offset - delta for offset in self.offsets[k:])
+        self.offsets.close()
+        self.offsets = offsets
+        self.end = self.limit = self.end - delta
+        self.open_cold()
+        self.save_index(0)
+        self.head = self.head_hash()
+        self.publish_head()
+        self.f.seek(self.end)
+
+    def __len__(self):
+        return self.base + len(self.offsets)
+
+    # payload of the i-th block, from cold storage or the log itself
+    def read(self, i):
+        if i < 0:
+            i += len(self)
+        if i < self.base:
+            return self.cold.read(i)
+        return self.read_at(self.offsets[i - self.base])
+
+    # payload of the record at `offset`, read through a read-only mmap of the log
+    def read_at(self, offset):
+        if self.mm is None or offset + RECORD_LEN.size > len(self.mm):
+            self.remap()
+        (length,) = RECORD_LEN.unpack_from(self.mm, offset)
+        start = offset + RECORD_LEN.size
+        if start + length > len(self.mm):
+            self.remap()
+        return self.mm[start:start + length]
+
+    def remap(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.flush()
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # every payload in order; the log is mapped once up front rather than
+    # checked record by record as read() does
+    def records(self):
+        if self.cold is not None:
+            yield from self.cold.records()
+        if self.mm is None or len(self.mm) < self.end:
+            self.remap()
+        mm = self.mm
+        unpack_from = RECORD_LEN.unpack_from
+        for offset in itertools.islice(self.offsets, len(self.offsets)):
+            (length,) = unpack_from(mm, offset)
+            start = offset + RECORD_LEN.size
+            yield mm[start:start + length]
+
+    def append(self, payload):
+        return self.append_many([payload])[0]
+
+    # all payloads go out in a single write; returns their offsets
+    def append_many(self, payloads):
+        if self.shared:
+            raise PermissionError(f"{self.path} is open for reading only")
+        if not payloads:
+            return []
+        known = len(self.offsets)
+        buf = bytearray()
+        offset = self.end
+        for payload in payloads:
+            self.offsets.append(offset)
+            buf += RECORD_LEN.pack(len(payload))
+            buf += payload
+            offset += RECORD_LEN.size + len(payload)
+        # a failed write is rolled back so a batch is never half committed
+        try:
+            self.f.seek(self.end)
+            self.f.write(buf)
+            self.f.flush()
+            self.dirty = True
+            if self.fsync != FSYNC_CLOSE:
+                self.sync()
+        except BaseException:
+            del self.offsets[known:]
+            self.f.truncate(self.end)
+            raise
+        self.appended += offset - self.end
+        self.end = self.limit = offset
+        self.head = sha256(payloads[-1]).digest()
+        self.save_index(known)
+        self.publish_head()
+        return self.offsets[known:].tolist()
+
+    def sync(self):
+        if self.dirty:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.dirty = False
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.sync()
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.offsets.close()
+        self.f.close()
+        if self.cold is not None:
+            self.cold.close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+
+# read-only sequence over the blocks of a BlockLog; a block is only
+# decoded when it is accessed, and slices are views over the same log
+class LazyChain(Sequence):
+    def __init__(self, store, decode, indices=None):
+        self.store = store
+        self.decode = decode
+        self.indices = indices
+
+    def range(self):
+        if self.indices is None:
+            return range(len(self.store))
+        return self.indices
+
+    def __len__(self):
+        return len(self.range())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyChain(self.store, self.decode, self.range()[i])
+        return self.decode(self.store.read(self.range()[i]))
+
+    def __iter__(self):
+        for i in self.range():
+            yield self.decode(self.store.read(i))
+
+    def __reversed__(self):
+        for i in reversed(self.range()):
+            yield self.decode(self.store.read(i))
+
+
+# Materialized state of every case and item, snapshotted to <path>.items.
+#   items: item_id -> ItemRecord, with `blocks` the block numbers of the
+#          item's custody events
+#   cases: case_id -> item ids in the order they were added
+#   by_status: state code -> ids of the items currently in that state
+#   times: TimeIndex of every custody event
+# It is updated as blocks are appended. The snapshot is tagged with the
+# block height it reflects and the hash of the block at that height, and is
+# rewritten once it falls SNAPSHOT_INTERVAL blocks behind; on startup the
+# snapshot is loaded and only the blocks after it are replayed. A missing
+# or mismatched snapshot means a full replay. pickle is only imported once
+# a snapshot is actually read or written, which keeps it (and the re module
+# it pulls in) off the startup path of commands that never need one.
+SNAPSHOT_INTERVAL = int(os.environ.get('BCHOC_SNAPSHOT_INTERVAL', 1000))
+
+# The snapshot is stored by column rather than as pickled records: one
+# array per field, in item order, with case ids stored once and referred
+# to by position and the block numbers of all items in one flat array.
+#   (SNAPSHOT_FORMAT, height, tag, STATES, case ids, item ids, case
+#    positions, state codes, micros, {item id: owner}, block counts, blocks,
+#    time index micros, time index blocks)
+SNAPSHOT_FORMAT = 'items-v3'
+
+
+# Block numbers of the custody events ordered by block time, for range
+# queries by bisection. Blocks are appended in time order unless a clock
+# went backwards or events were imported with their own times, so adding
+# one is almost always an append.
+class TimeIndex:
+    def __init__(self, micros=None, heights=None):
+        self.micros = micros if micros is not None else array.array('q')
+        self.heights = heights if heights is not None else array.array('I')
+
+    def add(self, micros, height):
+        if not self.micros or micros >= self.micros[-1]:
+            self.micros.append(micros)
+            self.heights.append(height)
+        else:
+            i = bisect.bisect_right(self.micros, micros)
+            self.micros.insert(i, micros)
+            self.heights.insert(i, height)
+
+    # block numbers with since <= time <= until (either may be None)
+    def between(self, since=None, until=None):
+        low = 0 if since is None else bisect.bisect_left(self.micros, since)
+        high = len(self.micros) if until is None else bisect.bisect_right(self.micros, until)
+        return self.heights[low:high]
+
+
+# Bounded LRU cache of state rebuilt from the chain, keyed by (kind, id):
+#   ('item', item_id) -> (block height, the item's blocks decoded, oldest
+#                        first), for log -i
+#   ('case', case_id) -> (block height, CaseState), for get_case
+# Each entry carries the height of the chain it was built at and a rough
+# size in bytes; the cache holds at most CACHE_ENTRIES entries and
+# CACHE_MB megabytes, whichever is reached first, and evicts the least
+# recently used. ItemIndex.apply() invalidates exactly the item and case
+# an appended block touches, so everything else stays cached across
+# appends (which is what a long-running server gets out of it).
+CACHE_ENTRIES = int(os.environ.get('BCHOC_CACHE_ENTRIES', 1024))
+CACHE_MB = float(os.environ.get('BCHOC_CACHE_MB', 64))
+
+# rough bytes a decoded block and a case's item record take in memory
+BLOCK_COST = 600
+ITEM_COST = 250
+
+
+class StateCache:
+    def __init__(self, max_entries=CACHE_ENTRIES, max_mb=CACHE_MB):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, height, value, size):
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        self.drop(key)
+        self.entries[key] = (height, value, size)
+        self.bytes += size
+        if isinstance(value, CaseState):
+            value.cache = self
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+        height, value, size = entry
+        self.bytes -= size
+        if isinstance(value, CaseState):
+            value.cache = None
+        return True
+
+    def invalidate(self, key):
+        if self.drop(key):
+            self.invalidations += 1
+
+    # a cached case that its holder is changing
+    def release(self, case):
+        key = ('case', case.case_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is case:
+            self.invalidate(key)
+        case.cache = None
+
+    def clear(self):
+        for key in list(self.entries):
+            self.drop(key)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+
+class ItemIndex:
+    def __init__(self, store, chain, interval=SNAPSHOT_INTERVAL):
+        self.store = store
+        self.chain = chain
+        self.path = store.path + '.items'
+        self.interval = interval
+        self.items = {}
+        self.cases = {}
+        self.by_status = {}
+        self.times = TimeIndex()
+        self.height = 0
+        self.saved_height = 0
+        self.loaded = False
+        self.cache = StateCache()
+
+    # the snapshot is only read (and caught up with the chain) once a
+    # command actually looks something up, so commands that never do skip it.
+    # Loading creates a record per item and none of them can be part of a
+    # reference cycle, so the garbage collector, which would keep rescanning
+    # all the records made so far, is paused meanwhile.
+    def catch_up(self):
+        if self.loaded and self.height == len(self.chain):
+            return
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            if not self.loaded:
+                self.loaded = True
+                self.load()
+            for height in range(self.height, len(self.chain)):
+                self.apply(height, self.chain[height])
+        finally:
+            if collecting:
+                gc.enable()
+
+    def tag(self, height):
+        if height == 0:
+            return ''
+        return sha256(self.store.read(height - 1)).hexdigest()
+
+    def load(self):
+        import pickle
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (OSError, EOFError, ValueError, AttributeError, pickle.UnpicklingError):
+            return
+        if not (isinstance(snapshot, tuple) and snapshot[0] == SNAPSHOT_FORMAT):
+            return
+        (_, height, tag, states, case_ids, item_ids, case_positions,
+         codes, micros, owners, counts, heights, times, time_heights) = snapshot
+        if height > len(self.store) or tag != self.tag(height):
+            return
+        codes = codes.translate(bytes(state_code(state) for state in states).ljust(256, b'\0'))
+        self.items = items = {}
+        self.cases = cases = {case_id: [] for case_id in case_ids}
+        self.by_status = by_status = {}
+        start = 0
+        for n, item_id in enumerate(item_ids):
+            case_id = case_ids[case_positions[n]]
+            end = start + counts[n]
+            items[item_id] = ItemRecord(item_id, case_id, codes[n], micros[n],
+                                        owners.get(item_id), heights[start:end].tolist())
+            cases[case_id].append(item_id)
+            by_status.setdefault(codes[n], set()).add(item_id)
+            start = end
+        self.times = TimeIndex(times, time_heights)
+        self.height = self.saved_height = height
+
+    def update(self, height, block):
+        self.extend(height, [block])
+
+    # applies blocks just appended at `height` onwards; the snapshot is
+    # rewritten at most once per call, however many blocks there are, and
+    # not at all with save=False (for callers appending many batches in a
+    # row, which leave it to checkpoint() once they are done)
+    def extend(self, height, blocks, save=True):
+        if not self.loaded:
+            self.catch_up()
+        for n, block in enumerate(blocks):
+            if height + n >= self.height:
+                self.apply(height + n, block)
+        if save and self.height - self.saved_height >= self.interval:
+            self.save()
+
+    def apply(self, height, block):
+        event = block.data
+        if isinstance(event, CustodyEvent):
+            entry = self.items.get(event.item_id)
+            if entry is None:
+                # one shared string per case instead of one per item
+                case_id = sys.intern(event.case_id)
+                entry = self.items[event.item_id] = ItemRecord(event.item_id, case_id, blocks=[])
+                self.cases.setdefault(case_id, []).append(event.item_id)
+            else:
+                self.by_status[entry.code].discard(event.item_id)
+            if self.cache.entries:
+                self.cache.invalidate(('item', event.item_id))
+                self.cache.invalidate(('case', entry.case_id))
+            entry.record(event)
+            self.by_status.setdefault(entry.code, set()).add(event.item_id)
+            entry.blocks.append(height)
+            self.times.add(entry.micros, height)
+        self.height = height + 1
+
+    def get(self, item_id):
+        self.catch_up()
+        return self.items.get(item_id)
+
+    def __contains__(self, item_id):
+        self.catch_up()
+        return item_id in self.items
+
+    def case_item_ids(self, case_id):
+        self.catch_up()
+        return self.cases.get(case_id, [])
+
+    # ids of the items currently in `state`
+    def with_status(self, state):
+        self.catch_up()
+        return self.by_status.get(STATE_CODES.get(state), set())
+
+    def between(self, since=None, until=None):
+        self.catch_up()
+        return self.times.between(since, until)
+
+    def block_micros(self, height):
+        return BLOCK.unpack_from(self.store.read(height))[1]
+
+    # the block that put an item in the state it is in: its last block,
+    # unless digests were recorded for it since
+    def state_block(self, entry):
+        for height in reversed(entry.blocks):
+            if BLOCK.unpack_from(self.store.read(height))[4].rstrip(b'\0') != DIGEST_STATE.encode('ascii'):
+                return height
+        return entry.blocks[0]
+
+    # the item's blocks, decoded, oldest first; () for an unknown item
+    def history(self, item_id):
+        self.catch_up()
+        key = ('item', item_id)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached[1]
+        entry = self.items.get(item_id)
+        if entry is None:
+            return ()
+        blocks = tuple(self.chain[height] for height in entry.blocks)
+        self.cache.put(key, self.height, blocks, BLOCK_COST * len(blocks))
+        return blocks
+
+    # Rebuilds one case from the snapshot, touching only that case's items.
+    # The case is cached, and the next call for it returns the same object
+    # for as long as neither the chain nor the caller changes the case.
+    def get_case(self, case_id, case_class=CaseState):
+        self.catch_up()
+        key = ('case', case_id)
+        cached = self.cache.get(key)
+        if cached is not None and type(cached[1]) is case_class:
+            return cached[1]
+        if case_id not in self.cases:
+            return None
+        case = self.build_case(case_id, case_class)
+        self.cache.put(key, self.height, case, ITEM_COST * (len(case.items) + 1))
+        return case
+
+    def build_case(self, case_id, case_class):
+        case = case_class(case_id)
+        for item_id in self.cases[case_id]:
+            case.restore(self.items[item_id].copy())
+        return case
+
+    # every case, built afresh rather than through the cache, which they
+    # would only flush
+    def get_cases(self, case_class=CaseState):
+        self.catch_up()
+        return {case_id: self.build_case(case_id, case_class) for case_id in self.cases}
+
+    # writes the snapshot if it is missing or too far behind the chain
+    def checkpoint(self):
+        if self.loaded and (self.saved_height == 0 or self.height - self.saved_height >= self.interval):
+            self.save()
+
+    def save(self):
+        import pickle
+        records = self.items.values()
+        case_ids = list(self.cases)
+        positions = {case_id: n for n, case_id in enumerate(case_ids)}
+        snapshot = (
+            SNAPSHOT_FORMAT, self.height, self.tag(self.height), tuple(STATES), case_ids,
+            array.array('I', self.items),
+            array.array('I', [positions[record.case_id] for record in records]),
+            bytes([record.code for record in records]),
+            array.array('q', [record.micros for record in records]),
+            {record.item_id: record.owner for record in records if record.owner},
+            array.array('I', [len(record.blocks) for record in records]),
+            array.array('I', itertools.chain.from_iterable(record.blocks for record in records)),
+            self.times.micros,
+            self.times.heights,
+        )
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.saved_height = self.height
@@ -0,0 +1,159 @@
+import array
+import bisect
+import hashlib
+import os
+import struct
+from blockstore import RECORD_LEN
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      cold.py
+    Description:    Compressed cold storage for the old blocks
+                    of a block log. Sealed segments of blocks are
+                    compressed one by one with zlib or lzma and
+                    moved out of the log into a file of their
+                    own, with an index of where every segment
+                    starts, so one block is read back by
+                    decompressing just its segment.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# <path>.cold      compressed segments, back to back; each one holds the
+#                  records of its blocks as the log does (u32 length +
+#                  payload) before compression
+# <path>.cold.idx  header, then one SEGMENT entry per segment, in order:
+#                  block count, codec, offset and length in <path>.cold,
+#                  length uncompressed, sha256 of the segment's last block
+# A segment is appended to <path>.cold before the index that points at it
+# is replaced, and the blocks are only dropped from the log after that,
+# so a crash anywhere leaves every block in at least one of the two
+# (BlockLog.compacted_records() sorts out blocks left in both).
+COLD_MAGIC = b'BCHOCOLD'
+COLD_VERSION = 1
+COLD_HEADER = struct.Struct('<8sI')
+SEGMENT = struct.Struct('<IBQII32s')
+
+# blocks per segment
+COLD_SEGMENT_SIZE = int(os.environ.get('BCHOC_COLD_SEGMENT_SIZE', 4096))
+
+CODECS = ('zlib', 'lzma')
+
+
+# stdlib codecs only, imported when a segment is first (de)compressed
+def compress(codec, raw):
+    if codec == 'lzma':
+        import lzma
+        return lzma.compress(raw, preset=6)
+    import zlib
+    return zlib.compress(raw, 6)
+
+
+def decompress(codec, raw):
+    if codec == 'lzma':
+        import lzma
+        return lzma.decompress(raw)
+    import zlib
+    return zlib.decompress(raw)
+
+
+class ColdSegments:
+    def __init__(self, path):
+        self.path = path + '.cold'
+        self.index_path = path + '.cold.idx'
+        self.segments = self.load_index()
+        # first block number of every segment, and one past the last
+        self.starts = array.array('Q', [0])
+        for segment in self.segments:
+            self.starts.append(self.starts[-1] + segment[0])
+        self.f = open(self.path, 'rb') if self.segments else None
+        # the last segment decompressed, as (number, payloads)
+        self.cached = (None, None)
+
+    def load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return []
+        if len(raw) < COLD_HEADER.size or COLD_HEADER.unpack_from(raw) != (COLD_MAGIC, COLD_VERSION):
+            raise ValueError(f"{self.index_path} is not a cold segment index")
+        return [SEGMENT.unpack_from(raw, offset)
+                for offset in range(COLD_HEADER.size, len(raw) - SEGMENT.size + 1, SEGMENT.size)]
+
+    def __len__(self):
+        return self.starts[-1]
+
+    # sha256 of the last block of every segment, for finding where a log
+    # that was being compacted starts
+    def last_hashes(self):
+        return {segment[5]: self.starts[n + 1] for n, segment in enumerate(self.segments)}
+
+    def segment(self, n):
+        if self.cached[0] != n:
+            count, codec, offset, length, raw_length, _ = self.segments[n]
+            raw = decompress(CODECS[codec], os.pread(self.f.fileno(), length, offset))
+            if len(raw) != raw_length:
+                raise ValueError(f"Cold segment {n} of {self.path} is damaged")
+            payloads = []
+            position = 0
+            unpack_from = RECORD_LEN.unpack_from
+            while position < len(raw):
+                (size,) = unpack_from(raw, position)
+                position += RECORD_LEN.size
+                payloads.append(raw[position:position + size])
+                position += size
+            self.cached = (n, payloads)
+        return self.cached[1]
+
+    def read(self, i):
+        n = bisect.bisect_right(self.starts, i) - 1
+        return self.segment(n)[i - self.starts[n]]
+
+    def records(self):
+        for n in range(len(self.segments)):
+            yield from self.segment(n)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+        self.cached = (None, None)
+
+
+# Moves every full segment of `store` (a BlockLog open for writing) that
+# lies before its newest `keep` blocks into cold storage, compressed with
+# `codec`. Returns (blocks moved, bytes they took in the log, bytes they
+# take compressed).
+def compact(store, keep, codec='zlib', segment_size=COLD_SEGMENT_SIZE):
+    cold_blocks = store.base
+    sealable = max(len(store) - max(keep, 1) - cold_blocks, 0) // segment_size
+    if not sealable:
+        return 0, 0, 0
+    entries = []
+    with open(store.path + '.cold', 'ab') as f:
+        offset = f.seek(0, os.SEEK_END)
+        for n in range(sealable):
+            start = cold_blocks + n * segment_size
+            payloads = [store.read(i) for i in range(start, start + segment_size)]
+            raw = b''.join(RECORD_LEN.pack(len(payload)) + payload for payload in payloads)
+            packed = compress(codec, raw)
+            f.write(packed)
+            entries.append(SEGMENT.pack(segment_size, CODECS.index(codec), offset, len(packed),
+                                        len(raw), hashlib.sha256(payloads[-1]).digest()))
+            offset += len(packed)
+        f.flush()
+        os.fsync(f.fileno())
+    index_path = store.path + '.cold.idx'
+    try:
+        with open(index_path, 'rb') as f:
+            index = f.read()
+    except FileNotFoundError:
+        index = COLD_HEADER.pack(COLD_MAGIC, COLD_VERSION)
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(index + b''.join(entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, index_path)
+
+    moved = sealable * segment_size
+    before = store.offsets[moved] - store.offsets[0]
+    store.drop_prefix(moved)
+    return moved, before, sum(SEGMENT.unpack(entry)[3] for entry in entries)
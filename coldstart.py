@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      coldstart.py
+    Description:    Cold-start check for the bchoc CLI. Runs
+                    the cheap commands in fresh interpreters
+                    against a scratch chain and reports their
+                    wall-clock time and what `python -X
+                    importtime` says they import. Exits with
+                    status 1 when a command is over budget.
+                    The budget is for what the CLI adds on top
+                    of the interpreter's own startup, which it
+                    can do nothing about and which varies a
+                    lot from machine to machine.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# commands with a cold-start budget; the chain is created before timing
+COMMANDS = (['init'], ['log', '-r', '-n', '1'])
+
+
+def child_env():
+    # time the CLI as it runs once installed, with its bytecode cached
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def run(argv, cwd, extra=()):
+    return subprocess.run([sys.executable, *extra, *argv], cwd=cwd, env=child_env(),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+
+def wall_times(argv, cwd, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(argv, cwd)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+# (cumulative microseconds, module) for every top-level import of one run
+def import_times(argv, cwd):
+    stderr = run(argv, cwd, ('-X', 'importtime')).stderr.decode()
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            modules.append((int(cumulative), name.strip()))
+    return sorted(modules, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the cold start of the bchoc CLI')
+    parser.add_argument('--script', default='gradescope.py', help='CLI to measure')
+    parser.add_argument('--runs', type=int, default=20, help='runs per command')
+    parser.add_argument('--budget', type=float, default=25.0,
+                        help='budget per command, in ms of median wall-clock time over `python -c pass`')
+    args = parser.parse_args()
+    script = os.path.join(HERE, args.script)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        run([script, 'init'], cwd)
+        # warm the bytecode cache and the page cache before timing
+        run([script, 'log'], cwd)
+        floor = statistics.median(wall_times(['-c', 'pass'], cwd, args.runs))
+        print(f"interpreter startup (python -c pass): {floor:.1f} ms")
+        for command in COMMANDS:
+            times = wall_times([script, *command], cwd, args.runs)
+            median = statistics.median(times)
+            over = median - floor > args.budget
+            failed = failed or over
+            print(f"\n{args.script} {' '.join(command)}: median {median:.1f} ms "
+                  f"(+{median - floor:.1f} ms over the interpreter, budget +{args.budget:.0f} ms), "
+                  f"min {min(times):.1f} ms{' -- OVER BUDGET' if over else ''}")
+            for cumulative, name in import_times([script, *command], cwd)[:8]:
+                print(f"  {cumulative / 1000:7.1f} ms  import {name}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
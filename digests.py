@@ -0,0 +1,108 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      digests.py
+    Description:    Hashing of evidence images on intake. The
+                    image is read once, in large buffers reused
+                    from a small pool, and every buffer is fed to
+                    MD5, SHA-1 and SHA-256 at the same time, each
+                    in a thread of its own, while the next
+                    buffers are being read.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# name printed and used in digest file names -> hashlib name
+ALGORITHMS = (('MD5', 'md5'), ('SHA-1', 'sha1'), ('SHA-256', 'sha256'))
+
+# digests written to <name>-<image file name>.txt, as the image analyzer
+# (rawMBR_GPT_analyzer) writes them: lowercase hex, no newline
+DIGEST_FILES = ('MD5', 'SHA-256')
+
+# bytes per read, and how many buffers the reads and the hashing share
+HASH_BUFFER_MB = int(os.environ.get('BCHOC_HASH_BUFFER_MB', 8))
+HASH_BUFFERS = 4
+
+
+class ImageDigests:
+    def __init__(self, path, digests, size, seconds):
+        self.path = path
+        self.digests = digests
+        self.size = size
+        self.seconds = seconds
+
+    def rate(self):
+        return self.size / self.seconds / 2 ** 20 if self.seconds else 0.0
+
+    # what a custody event for the image records
+    def record(self):
+        fields = ' '.join(f'{name}={digest}' for name, digest in self.digests.items())
+        return f'{fields} size={self.size} image={os.path.basename(self.path)}'
+
+
+# Reads the image at `path` once and returns its ImageDigests. hashlib lets
+# go of the GIL while it hashes a large buffer, so the hashes run side by
+# side and alongside the reads. A buffer goes back to the pool once every
+# hash has taken it in; reads wait for a free buffer, so memory stays at
+# `buffers` x `buffer_mb` however large the image is.
+def hash_image(path, buffer_mb=HASH_BUFFER_MB, buffers=HASH_BUFFERS):
+    hashes = {name: hashlib.new(algorithm) for name, algorithm in ALGORITHMS}
+    views = [memoryview(bytearray(buffer_mb * 2 ** 20)) for _ in range(buffers)]
+    free = queue.Queue()
+    for n in range(buffers):
+        free.put(n)
+    inboxes = {name: queue.Queue() for name in hashes}
+    # hashes still to take in each buffer
+    pending = [0] * buffers
+    lock = threading.Lock()
+
+    def digest(name):
+        update = hashes[name].update
+        inbox = inboxes[name]
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            n, length = item
+            update(views[n][:length])
+            with lock:
+                pending[n] -= 1
+                if not pending[n]:
+                    free.put(n)
+
+    workers = [threading.Thread(target=digest, args=(name,), daemon=True) for name in hashes]
+    for worker in workers:
+        worker.start()
+    start = time.perf_counter()
+    size = 0
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                n = free.get()
+                length = f.readinto(views[n])
+                if not length:
+                    break
+                size += length
+                pending[n] = len(hashes)
+                for inbox in inboxes.values():
+                    inbox.put((n, length))
+    finally:
+        for inbox in inboxes.values():
+            inbox.put(None)
+        for worker in workers:
+            worker.join()
+    seconds = time.perf_counter() - start
+    return ImageDigests(path, {name: h.hexdigest() for name, h in hashes.items()}, size, seconds)
+
+
+# writes the DIGEST_FILES for `image` into `directory`; returns their paths
+def write_digest_files(image, directory='.'):
+    paths = []
+    for name in DIGEST_FILES:
+        path = os.path.join(directory, f'{name}-{os.path.basename(image.path)}.txt')
+        with open(path, 'w') as f:
+            f.write(image.digests[name])
+        paths.append(path)
+    return paths
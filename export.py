@@ -0,0 +1,119 @@
+import hashlib
+import itertools
+import json
+import re
+from blockstore import BLOCK, GENESIS_STATE, canonical_case_id, from_micros, log_heights
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      export.py
+    Description:    Bulk export of the custody events as CSV or
+                    NDJSON, for other systems. Events are read
+                    straight from the block records, one at a
+                    time, and written out in large chunks, so an
+                    export of the whole chain runs in constant
+                    memory.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# one row per custody event; hash is the sha256 of the block record, which
+# is what the next block's previous_hash must be
+COLUMNS = ('block', 'time', 'case_id', 'item_id', 'action', 'owner', 'hash', 'previous_hash')
+
+# rows formatted per write
+CHUNK = 4096
+
+
+# (block number, record) of every block in `heights`, or of the whole log
+def records(store, heights=None):
+    if heights is None:
+        return enumerate(store.records())
+    return ((height, store.read(height)) for height in heights)
+
+
+# Block times formatted the way `log` prints them. Consecutive blocks are
+# mostly within the same second, so the date and time up to the second is
+# formatted once per second and only the microseconds per block.
+class TimeFormatter:
+    def __init__(self):
+        self.second = None
+        self.prefix = None
+
+    def __call__(self, micros):
+        second, fraction = divmod(micros, 10 ** 6)
+        if second != self.second:
+            self.second = second
+            self.prefix = from_micros(second * 10 ** 6).isoformat()[:-len('+00:00')]
+        if fraction:
+            return f'{self.prefix}.{fraction:06d}+00:00'
+        return f'{self.prefix}+00:00'
+
+
+# One tuple of COLUMNS per custody event (the genesis block is skipped),
+# decoded from the record fields directly rather than through
+# ChainOfCustody.decode. A case's id is formatted once per export.
+def event_rows(store, heights=None):
+    cases = {}
+    format_time = TimeFormatter()
+    unpack_from = BLOCK.unpack_from
+    sha256 = hashlib.sha256
+    for height, raw in records(store, heights):
+        prev, micros, case_id, item_id, state, length = unpack_from(raw)
+        state = state.rstrip(b'\0').decode('ascii')
+        if state == GENESIS_STATE:
+            continue
+        case = cases.get(case_id)
+        if case is None:
+            case = cases[case_id] = canonical_case_id(case_id)
+        owner = raw[BLOCK.size:BLOCK.size + length].decode('utf-8') if length else ''
+        yield (height, format_time(micros), case, item_id, state, owner,
+               sha256(raw).hexdigest(), prev.hex())
+
+
+# RFC 4180 quoting, for the only columns that can hold arbitrary text
+needs_quotes = re.compile('[,"\r\n]').search
+
+
+def csv_field(text):
+    if needs_quotes(text):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+# Rows are formatted by hand rather than through the csv and json modules,
+# which are several times slower per row; only the action and owner can
+# hold text that needs quoting or escaping.
+def format_csv(chunk):
+    return ''.join(
+        f'{height},{time},{case},{item_id},{csv_field(action)},{csv_field(owner)},{digest},{prev}\n'
+        for height, time, case, item_id, action, owner, digest, prev in chunk)
+
+
+def format_ndjson(chunk):
+    quote = json.encoder.encode_basestring_ascii
+    return ''.join(
+        f'{{"block":{height},"time":"{time}","case_id":"{case}","item_id":{item_id},'
+        f'"action":{quote(action)},"owner":{quote(owner) if owner else "null"},'
+        f'"hash":"{digest}","previous_hash":"{prev}"}}\n'
+        for height, time, case, item_id, action, owner, digest, prev in chunk)
+
+
+# Writes the events `log` would show for the same filters to `out`, in
+# chain order, a chunk of rows per write, and returns how many there were.
+# With no filter the log is read front to back; otherwise only the
+# matching blocks are read.
+def export_events(out, store, items, fmt='csv', item_id=None, since=None, until=None,
+                  status=None, case_id=None):
+    filtered = any(value is not None for value in (item_id, since, until, status, case_id))
+    heights = log_heights(store, items, item_id, since, until, status, case_id) if filtered else None
+    rows = event_rows(store, heights)
+    format_chunk = format_csv if fmt == 'csv' else format_ndjson
+    if fmt == 'csv':
+        out.write(','.join(COLUMNS) + '\n')
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK))
+        out.write(format_chunk(chunk))
+        count += len(chunk)
+        if len(chunk) < CHUNK:
+            break
+    out.flush()
+    return count
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
-import datetime
-import hashlib
+import itertools
 import os
-import pickle
-import argparse
+import sys
+import types
+from blockstore import DIGEST_STATE, FSYNC_CLOSE, HEADER, STATES, VERSION, BlockLog, CaseState, ChainOfCustody, CustodyEvent, ItemIndex, LazyChain, canonical_case_id, iter_log, read_genesis, read_version, to_micros, write_log
+from metrics import Session
 '''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     Authors:        MinhHien Luong
     File Name:      blockchain.py
@@ -12,182 +13,614 @@ import argparse
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 '''
 
+BLOCKS_FILE = 'blocks.bin'
+GENESIS_DATA = 'Genesis Block'
+# where a running server listens (server.socket_path(BLOCKS_FILE)); kept
+# here so that finding no server does not cost importing the server
+SOCKET_FILE = BLOCKS_FILE + '.sock'
+
+# commands that only read the chain; they read the published head
+# without waiting for writers
+READ_COMMANDS = ('log', 'verify', 'prove', 'export', 'stats', 'sync')
+
+# commands that never open the chain
+LOCAL_COMMANDS = ('check-proof',)
+
+# commands that only work on a chain that is not sharded
+UNSHARDED_COMMANDS = ('export', 'prove', 'sync')
+
+# state -> (what the command does, what it reports having done)
+ACTION_NAMES = {
+    'CHECKEDOUT': ('check out', 'Checked out'),
+    'CHECKEDIN': ('check in', 'Checked in'),
+    'DISPOSED': ('remove', 'Removed'),
+    'DESTROYED': ('remove', 'Removed'),
+    'RELEASED': ('remove', 'Removed'),
+}
+
 # case's data
-class Case:
-    def __init__(self, case_id):
-        self.case_id = case_id
-        self.items = []
-
-
-    def add(self, i):
-        a = False
-        print(f"Case: {case_id}")
-        time = datetime.datetime.now().isoformat()
-        for block in bl.get_chain():
-            if isinstance(block.data, Case):
-                case = block.data
-                for item in case.get_items():
-                    if (item['item_id'] == i):
-                        print("VERIFY ISSUE: duplicate block added")
-                        a = True
-                    if a:
-                        break
-        self.items.append({
-        'item_id': i,
-        'status': 'CHECKEDIN',
-        'time': time,})
-        print(f"Added item: {i}")
-        print(f"Status: CHECKEDIN")
-        print(f"Time of action: {time}")
-
-    def get_items(self):
-        return self.items
-
-# Hashed as a blockchain system
-class ChainOfCustody:
-    def __init__(self, data, previous_hash):
-        self.timestamp = datetime.datetime.now()
-        self.data = data
-        self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self):
-        sha = hashlib.sha256()
-        sha.update(str(self.timestamp).encode('utf-8') +
-                   str(self.data).encode('utf-8') +
-                   str(self.previous_hash).encode('utf-8'))
-        return sha.hexdigest()
+class Case(CaseState):
+    pass
 
 # each block's properties set up
 class Blockchain:
-    def __init__(self):
-        self.blocks_file = 'blocks.bin'
-        if os.path.exists(self.blocks_file):
-            with open(self.blocks_file, 'rb') as f:
-                self.chain = pickle.load(f)
-        else:
-            self.chain = [self.create_genesis_block()]
-            with open(self.blocks_file, 'wb') as f:
-                pickle.dump(self.chain, f)
+    sharded = False
+
+    def __init__(self, fsync=None, shared=False, path=BLOCKS_FILE):
+        self.blocks_file = path
+        self.store = BlockLog(self.blocks_file, fsync, shared)
+        self.chain = LazyChain(self.store, ChainOfCustody.decode)
+        self.created = not len(self.store)
+        if self.created:
+            self.store.append(self.create_genesis_block().raw)
+        self.items = ItemIndex(self.store, self.chain)
 
     def create_genesis_block(self):
-        return ChainOfCustody("Genesis Block", "0")
+        return ChainOfCustody(GENESIS_DATA, "0")
 
     def add_block(self, new_data):
+        self.add_blocks([new_data])
+
+    # chains all the new blocks and appends them in one write (and one fsync);
+    # `save` is passed on to ItemIndex.extend
+    def add_blocks(self, new_data, save=True):
         previous_hash = self.chain[-1].hash
-        new_block = ChainOfCustody(new_data, previous_hash)
-        self.chain.append(new_block)
-        with open(self.blocks_file, 'wb') as f:
-            pickle.dump(self.chain, f)
+        blocks = []
+        for data in new_data:
+            block = ChainOfCustody(data, previous_hash)
+            blocks.append(block)
+            previous_hash = block.hash
+        height = len(self.store)
+        self.store.append_many([block.raw for block in blocks])
+        self.items.extend(height, blocks, save)
+
+    # new items are checked and added under the lock this chain holds as a
+    # writer already; a sharded chain takes one across its shards
+    def reserve_items(self):
+        import contextlib
+        return contextlib.nullcontext()
+
+    # checks every item against the chain and against each other, then
+    # commits them all together; nothing is written if any item is rejected
+    def add_items(self, case_id, item_ids):
+        events = [CustodyEvent(case_id, item_id, 'CHECKEDIN') for item_id in item_ids]
+        seen = set()
+        for event in events:
+            if event.item_id in self.items or event.item_id in seen:
+                raise ValueError(f"Duplicate item ID: {event.item_id}")
+            seen.add(event.item_id)
+        self.add_blocks(events)
+        return events
+
+    # moves an item that is already on the chain to a new state, if the
+    # move is allowed from the state it is in now
+    def change_status(self, item_id, action, owner=None):
+        from verify import TRANSITIONS
+        entry = self.items.get(item_id)
+        if entry is None:
+            raise ValueError(f"Item ID not found: {item_id}")
+        if action not in TRANSITIONS.get(entry.status, ()):
+            if entry.status == 'CHECKEDOUT':
+                raise ValueError(f"Cannot {ACTION_NAMES[action][0]} a checked out item. Must check it in first.")
+            raise ValueError(f"Cannot {ACTION_NAMES[action][0]} an item that is {entry.status}.")
+        if action == 'RELEASED' and not owner:
+            raise ValueError("Owner info is required to release an item.")
+        event = CustodyEvent(entry.case_id, item_id, action, owner)
+        self.add_block(event)
+        return event
+
+    # records the digests of the item's evidence image (ImageDigests.record())
+    # as a custody event, which leaves the item in the state it is in
+    def record_digests(self, item_id, digests):
+        from verify import REMOVED_STATES
+        entry = self.items.get(item_id)
+        if entry is None:
+            raise ValueError(f"Item ID not found: {item_id}")
+        if entry.status in REMOVED_STATES:
+            raise ValueError(f"Cannot record digests for an item that is {entry.status}.")
+        event = CustodyEvent(entry.case_id, item_id, DIGEST_STATE, digests)
+        self.add_block(event)
+        return event
+
+    def close(self):
+        self.items.checkpoint()
+        self.store.close()
 
     def get_chain(self):
         return self.chain
 
     def get_cases(self):
-        cases = {}
-        for block in self.chain:
-            if isinstance(block.data, Case):
-                cases[block.data.case_id] = block.data
-        return cases
+        return self.items.get_cases(Case)
 
     def get_case(self, case_id):
-        for block in self.chain:
-            if isinstance(block.data, Case) and block.data.case_id == case_id:
-                return block.data
-        return None
+        return self.items.get_case(case_id, Case)
     
-    def log(self, item_id=None, reverse=False, num_entries=None):
-        blocks = self.chain
-        if item_id:
-            blocks=[block for block in self.chain 
-                    if isinstance(block.data, Case) and any(item['item_id'] == item_id for item in block.data_items)]
-        if reverse:
-            blocks = reversed(blocks)
-        if num_entries is not None:
-            blocks = list(blocks)[:num_entries]
-        for block in blocks:
-            data = block.data
-            if isinstance(data, Case):
-                for item in data.items:
-                    if item_id is None or item['item_id'] == item_id:
-                        print(f"Case: {data.case_id}\nItem: {item['item_id']}\nAction: {item['status']}\nTime: {item['time']}\n")
+    def log(self, item_id=None, reverse=False, num_entries=None, out=None,
+            since=None, until=None, status=None, case_id=None):
+        blocks = iter_log(self.chain, self.items, item_id, reverse, num_entries,
+                          since, until, status, case_id)
+        write_log(out or sys.stdout, blocks)
+
+    def verify(self, full=False, jobs=1):
+        from verify import verify_chain
+        return verify_chain(self.store, full=full, jobs=jobs)
 
 # commands parser
 def get_parser():
+    import argparse
+    from verify import REMOVED_STATES
     parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true', help='print how long each phase of the command took')
+    parser.add_argument('--cprofile', metavar='FILE', help='write cProfile stats of the command to FILE')
     subparsers = parser.add_subparsers(dest='command')
 
     # create the parser for the "init" command
     parser_init = subparsers.add_parser('init', help='initialize the blockchain')
+    parser_init.add_argument('--shards', type=int, help='spread the cases over this many shards, which can be written to in parallel')
     #parser_init.add_argument('filename', help='the filename of the blockchain')
 
     # create the parser for the "add" command
     parser_add = subparsers.add_parser('add', help='add a new block to the blockchain')
     parser_add.add_argument('-c', '--case-id', required=True, help='the ID of the case to add the evidence to')
-    parser_add.add_argument('-i', '--item-id', required=True, help='the ID of the evidence item being added')
+    parser_add.add_argument('-i', '--item-id', required=True, type=int, nargs='+', action='extend', help='the ID(s) of the evidence items being added')
+
+    # create the parser for the "import" command
+    parser_import = subparsers.add_parser('import', help='add the items listed in a CSV intake manifest')
+    parser_import.add_argument('manifest', help="CSV file of case_id,item_id[,owner] rows ('-' for standard input)")
+    parser_import.add_argument('--strict', action='store_true', help='import nothing if any row is rejected')
+
+    # create the parser for the "checkout" / "checkin" commands
+    parser_checkout = subparsers.add_parser('checkout', help='check out an evidence item')
+    parser_checkout.add_argument('-i', '--item-id', required=True, type=int, help='the ID of the evidence item')
+    parser_checkin = subparsers.add_parser('checkin', help='check in an evidence item')
+    parser_checkin.add_argument('-i', '--item-id', required=True, type=int, help='the ID of the evidence item')
+
+    # create the parser for the "remove" command
+    parser_remove = subparsers.add_parser('remove', help='remove an evidence item from further action')
+    parser_remove.add_argument('-i', '--item-id', required=True, type=int, help='the ID of the evidence item')
+    parser_remove.add_argument('-y', '--why', required=True, choices=REMOVED_STATES, help='the reason for the removal')
+    parser_remove.add_argument('-o', '--owner', help='who the item was released to (required for RELEASED)')
+
+    # create the parser for the "hash" command
+    parser_hash = subparsers.add_parser('hash', help='hash an evidence image with MD5, SHA-1 and SHA-256 in one pass')
+    parser_hash.add_argument('image', help='the image file')
+    parser_hash.add_argument('-i', '--item-id', type=int, help='record the digests as a custody event of this evidence item')
+    parser_hash.add_argument('-d', '--digest-dir', default='.', help='directory to write the MD5- and SHA-256- digest files to (default: the current one)')
+    parser_hash.add_argument('--buffer-mb', type=int, help='size of each read buffer, in MB (default: 8)')
 
     # create the parser for the "log" command
     parser_log = subparsers.add_parser('log', help='display the blockchain entries')
-    parser_log.add_argument('-i', '--item-id', help='the ID of the evidence item being displayed')
+    add_filter_arguments(parser_log)
     parser_log.add_argument('-r', '--reverse', action='store_true', help='reverse the order of the block entries')
-    parser_log.add_argument('-n', '--num-entries', type=int, help='number of block entries to show')
+    parser_log.add_argument('-n', '--num-entries', type=non_negative, help='number of block entries to show')
+
+    # create the parser for the "export" command
+    parser_export = subparsers.add_parser('export', help='write the custody events out as CSV or NDJSON')
+    add_filter_arguments(parser_export)
+    parser_export.add_argument('--format', default='csv', choices=('csv', 'ndjson'), help='output format (default: csv)')
+    parser_export.add_argument('-o', '--output', help='file to write to instead of standard output')
+
+    # create the parser for the "verify" command
+    parser_verify = subparsers.add_parser('verify', help='check the blockchain for errors')
+    parser_verify.add_argument('--full', action='store_true', help='re-check every block, ignoring the last checkpoint')
+    parser_verify.add_argument('-j', '--jobs', type=int, default=1, help='number of processes to check the chain with')
+
+    # create the parser for the "prove" / "check-proof" commands
+    parser_prove = subparsers.add_parser('prove', help="print Merkle inclusion proofs for an item's blocks, or the chain's Merkle root")
+    parser_prove.add_argument('-i', '--item-id', type=int, help='the ID of the evidence item to prove')
+    parser_check = subparsers.add_parser('check-proof', help='check a proof written by prove, without the chain')
+    parser_check.add_argument('proof', help="the proof file ('-' for standard input)")
+    parser_check.add_argument('--root', help='the chain root the proof must be for')
+
+    # create the parser for the "compact" command
+    parser_compact = subparsers.add_parser('compact', help='move old blocks into compressed cold storage')
+    parser_compact.add_argument('--keep', type=int, default=10000, help='number of newest blocks to leave uncompressed (default: 10000)')
+    parser_compact.add_argument('--codec', default='zlib', choices=('zlib', 'lzma'), help='compression to use (default: zlib)')
+
+    # create the parser for the "sync" command
+    parser_sync = subparsers.add_parser('sync', help='copy the blocks a backup copy of the blockchain is missing to it')
+    parser_sync.add_argument('dest', help='the backup blockchain file, or a directory to keep it in (created if missing)')
+
+    # create the parser for the "anchor" command
+    subparsers.add_parser('anchor', help='record the head of every shard on the root chain (sharded chains only)')
+
+    # create the parser for the "stats" command
+    subparsers.add_parser('stats', help='show the hits, misses and evictions of the case and item state cache (of the server, when one is running)')
+
+    # create the parser for the "serve" command
+    subparsers.add_parser('serve', help='keep the blockchain loaded and serve other bchoc commands over a Unix socket')
 
     return parser
 
-# main driver
-if __name__ == '__main__':
-    
-    # initialization and local objs
-    bl = Blockchain()
 
-    # parser
-    parser = get_parser()
-    args = parser.parse_args()
+# block selection shared by 'log' and 'export'
+def add_filter_arguments(parser):
+    parser.add_argument('-i', '--item-id', type=int, help='only entries for this evidence item')
+    parser.add_argument('--since', type=since_time, help='only entries at or after this ISO 8601 date/time (UTC unless given)')
+    parser.add_argument('--until', type=until_time, help='only entries at or before this ISO 8601 date/time (a date covers the whole day)')
+    parser.add_argument('--status', choices=STATES[:5], help='only items currently in this state, with the entry that put them there')
+    parser.add_argument('--case', dest='case_id', type=canonical_case_id, help='only entries for items of this case')
+
+
+# --since/--until take an ISO 8601 date or date and time, in epoch
+# microseconds once parsed; a time without a zone is UTC, like the times
+# log prints, and a bare date for --until runs to the end of that day
+def since_time(text):
+    import datetime
+    moment = datetime.datetime.fromisoformat(text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return to_micros(moment)
+
+
+def until_time(text):
+    micros = since_time(text)
+    if len(text) <= len('YYYY-MM-DD'):
+        micros += 24 * 60 * 60 * 10 ** 6 - 1
+    return micros
+
+
+# -n takes a count, so a negative one is a usage error
+def non_negative(text):
+    import argparse
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {value}")
+    return value
+
+
+# The commands run most often, 'init' and 'log' with nothing but -r and
+# -n, are recognised by hand: building the argparse tree (and importing
+# argparse) costs more than everything else those commands do. Anything
+# else, including every mistake, goes through get_parser() as usual.
+def parse_fast(argv):
+    if argv == ['init']:
+        return types.SimpleNamespace(command='init')
+    if argv[:1] != ['log']:
+        return None
+    args = types.SimpleNamespace(command='log', item_id=None, reverse=False, num_entries=None,
+                                 since=None, until=None, status=None, case_id=None)
+    rest = argv[1:]
+    while rest:
+        flag = rest.pop(0)
+        if flag in ('-r', '--reverse'):
+            args.reverse = True
+        elif flag in ('-n', '--num-entries') and rest and rest[0].isdigit():
+            args.num_entries = int(rest.pop(0))
+        else:
+            return None
+    return args
+
+
+def parse_args(argv):
+    return parse_fast(argv) or get_parser().parse_args(argv)
+
+# runs one command against `bl`, writing what it prints to `out`;
+# returns the exit status. `digests`, for a hash command, are ones hashed
+# already; `stdin`, the text of a manifest read from stdin by the client
+def run_command(bl, argv, out, digests=None, stdin=None):
+    args = parse_args(argv)
+    status = 0
 
     # 'init' command
     if args.command == "init":
-        if os.path.exists('blocks.bin'):
-            print('Blockchain file found with INITIAL block.')
+        if bl.created:
+            out.write('Blockchain file not found. Created INITIAL block.\n')
         else:
-            bl.create_genesis_block()
-            print('Blockchain file not found. Created INITIAL block.')
+            out.write('Blockchain file found with INITIAL block.\n')
 
     # 'add' command
     if args.command == 'add':
-        if args.case_id and args.item_id:
-            case = bl.get_case(args.case_id)
-            if case:
-                for item_id in args.item_id:
-                    case.add(item_id)
-                    
+        try:
+            events = bl.add_items(args.case_id, args.item_id)
+        except ValueError as e:
+            out.write(f"Error: {e}\n")
+            status = 1
+        else:
+            for event in events:
+                out.write(f"Case: {event.case_id}\nAdded item: {event.item_id}\nStatus: {event.action}\nTime of action: {event.timestamp.isoformat()}\n\n")
+
+    # 'import' command
+    if args.command == 'import':
+        import io
+        from manifest import import_manifest
+        try:
+            # 'utf-8-sig' drops the byte order mark spreadsheets start CSV files with
+            if args.manifest == '-' and stdin is not None:
+                added, rejected = import_manifest(bl, io.StringIO(stdin, newline=''), out, args.strict)
+            elif args.manifest == '-':
+                f = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+                added, rejected = import_manifest(bl, f, out, args.strict)
+            else:
+                with open(args.manifest, newline='', encoding='utf-8-sig') as f:
+                    added, rejected = import_manifest(bl, f, out, args.strict)
+        except (OSError, UnicodeDecodeError) as e:
+            out.write(f"Error: Cannot read manifest {args.manifest}: {e}\n")
+            status = 1
+        else:
+            status = 1 if rejected else 0
+
+    # 'checkout' / 'checkin' / 'remove' commands
+    if args.command in ('checkout', 'checkin', 'remove'):
+        action = {'checkout': 'CHECKEDOUT', 'checkin': 'CHECKEDIN'}.get(args.command) or args.why
+        try:
+            event = bl.change_status(args.item_id, action, getattr(args, 'owner', None))
+        except ValueError as e:
+            out.write(f"Error: {e}\n")
+            status = 1
+        else:
+            out.write(f"Case: {event.case_id}\n{ACTION_NAMES[action][1]} item: {event.item_id}\nStatus: {event.action}\n")
+            if event.owner:
+                out.write(f"Owner info: {event.owner}\n")
+            out.write(f"Time of action: {event.timestamp.isoformat()}\n")
+
+    # 'hash' command
+    if args.command == 'hash':
+        digests = digests or hash_image_file(args, out)
+        if digests is None:
+            status = 1
+        elif args.item_id is not None:
+            try:
+                event = bl.record_digests(args.item_id, digests)
+            except ValueError as e:
+                out.write(f"Error: {e}\n")
+                status = 1
+            else:
+                out.write(f"Case: {event.case_id}\nRecorded digests for item: {event.item_id}\n"
+                          f"Action: {event.action}\nTime of action: {event.timestamp.isoformat()}\n")
 
     # 'log' command
     if args.command == 'log':
-        cases = bl.get_cases()
-        item_id = args.item_id
-        reverse = args.reverse
-        num_entries = args.num_entries
-        if item_id:
-            for case_id in cases:
-                case = cases[case_id]
-                items = case.get_items()
-                for item in items:
-                    if item['item_id'] == item_id:
-                        print(f"Case: {case.case_id}\nItem: {item_id}\nAction: {item['status']}\nTime: {item['time']}\n")
-                        break
-                else:
-                    continue
-                break
+        bl.log(args.item_id, args.reverse, args.num_entries, out,
+               args.since, args.until, args.status, args.case_id)
+
+    if bl.sharded and args.command in UNSHARDED_COMMANDS:
+        out.write(f"Error: {args.command} does not work on a sharded blockchain yet.\n")
+        return 1
+
+    # 'export' command
+    if args.command == 'export':
+        from export import export_events
+        filters = (args.item_id, args.since, args.until, args.status, args.case_id)
+        if args.output is None:
+            export_events(out, bl.store, bl.items, args.format, *filters)
+        else:
+            with open(args.output, 'w', encoding='utf-8', newline='', buffering=1 << 20) as f:
+                count = export_events(f, bl.store, bl.items, args.format, *filters)
+            out.write(f"Exported {count} events to {args.output}\n")
+
+    # 'prove' command
+    if args.command == 'prove':
+        import json
+        from merkle import SegmentRoots
+        roots = SegmentRoots(bl.store)
+        if args.item_id is None:
+            out.write(f"Chain root: {roots.chain_root().hex()}\nBlocks in chain: {len(bl.store)}\n")
+            return status
+        entry = bl.items.get(args.item_id)
+        try:
+            if entry is None:
+                raise ValueError(f"Item ID not found: {args.item_id}")
+            proof = roots.prove(entry.blocks)
+        except ValueError as e:
+            out.write(f"Error: {e}\n")
+            status = 1
+        else:
+            proof['item_id'] = args.item_id
+            out.write(json.dumps(proof, indent=1) + '\n')
+
+    # 'verify' command
+    if args.command == 'verify':
+        result = bl.verify(args.full, args.jobs)
+        out.write(result.report() + '\n')
+        if not result.clean():
+            status = 1
+
+    # 'compact' command
+    if args.command == 'compact':
+        from cold import compact
+        stores = [bl.writer(shard).store for shard in range(bl.count)] if bl.sharded else [bl.store]
+        moved = before = after = 0
+        for store in stores:
+            blocks, raw_bytes, packed_bytes = compact(store, args.keep, args.codec)
+            moved, before, after = moved + blocks, before + raw_bytes, after + packed_bytes
+        if moved:
+            out.write(f"Compressed {moved} blocks with {args.codec}: {before} bytes -> {after} bytes "
+                      f"({after / before:.1%}).\n")
+        else:
+            out.write("Nothing to compress.\n")
+        cold = sum(store.base for store in stores)
+        out.write(f"Blocks in cold storage: {cold} of {sum(len(store) for store in stores)}\n")
+
+    # 'sync' command
+    if args.command == 'sync':
+        from sync import sync
+        dest = args.dest
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(BLOCKS_FILE))
+        try:
+            had, copied = sync(bl.store, dest)
+        except (OSError, ValueError) as e:
+            out.write(f"Error: {e}\n")
+            status = 1
+        else:
+            if copied:
+                out.write(f"Copied {copied} blocks to {dest} (blocks {had} to {had + copied - 1}).\n")
+            else:
+                out.write(f"{dest} is up to date.\n")
+            out.write(f"Blocks in backup: {had + copied}\nHead: {bl.store.head.hex()}\n")
+
+    # 'anchor' command
+    if args.command == 'anchor':
+        if bl.sharded:
+            anchor = bl.anchor()
+            out.write(f"Anchored {len(anchor.heads)} shards, {sum(count for count, _ in anchor.heads.values())} blocks.\n")
+        else:
+            out.write("Error: The blockchain is not sharded.\n")
+            status = 1
+
+    # 'stats' command
+    if args.command == 'stats':
+        stats = cache_stats(bl)
+        lookups = stats['hits'] + stats['misses']
+        ratio = f" ({stats['hits'] / lookups:.1%} hits)" if lookups else ''
+        out.write(f"State cache: {stats['entries']} entries, {stats['bytes'] / 2 ** 20:.1f} MB\n"
+                  f"Lookups: {lookups}{ratio}\n"
+                  f"Hits: {stats['hits']}\nMisses: {stats['misses']}\n"
+                  f"Evictions: {stats['evictions']}\nInvalidations: {stats['invalidations']}\n")
+
+    return status
+
+# counters of the state cache of `bl` (summed over the open shards of a
+# sharded chain)
+def cache_stats(bl):
+    if bl.sharded:
+        chains = [chain for chain in itertools.chain(bl.writers.values(), bl.readers.values())
+                  if isinstance(chain, Blockchain)]
+    else:
+        chains = [bl]
+    totals = {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+    for chain in chains:
+        for name, value in chain.items.cache.stats().items():
+            totals[name] += value
+    return totals
+
+# Hashes the image of a 'hash' command, writes its digest files and reports
+# the digests and the throughput on `out`; returns the text a custody event
+# records of them, or None if the image could not be read.
+def hash_image_file(args, out):
+    from digests import HASH_BUFFER_MB, hash_image, write_digest_files
+    try:
+        image = hash_image(args.image, args.buffer_mb or HASH_BUFFER_MB)
+        paths = write_digest_files(image, args.digest_dir)
+    except OSError as e:
+        out.write(f"Error: Cannot hash image {args.image}: {e}\n")
+        return None
+    for name, digest in image.digests.items():
+        out.write(f"{name}: {digest}\n")
+    out.write(f"Hashed {image.size} bytes in {image.seconds:.2f} s ({image.rate():.1f} MB/s)\n"
+              f"Wrote {' and '.join(paths)}\n")
+    out.flush()
+    return image.record()
+
+# checks a proof file; needs nothing but the file
+def run_local(args, out):
+    import json
+    from merkle import check_proof
+    try:
+        if args.proof == '-':
+            proof = json.load(sys.stdin)
         else:
-            blocks = bl.get_chain()
-            if reverse:
-                blocks.reverse()
-            if num_entries:
-                blocks = blocks[-num_entries:]
-            for block in blocks:
-                if isinstance(block.data, Case):
-                    print(f"Case: {block.data.case_id}\n")
-                else:
-                    print(f"Item: {block.data}\n")
-
-    # example use
+            with open(args.proof) as f:
+                proof = json.load(f)
+        return check_proof(proof, out, args.root)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        out.write(f"Error: Cannot read proof {args.proof}: {e}\n")
+        return 1
+
+# The chain a command works on: a ShardedChain when the genesis block of
+# the file names shards (or 'init --shards' is creating them), otherwise a
+# Blockchain. The shards module is only imported for a sharded chain.
+def open_chain(args):
+    shards = getattr(args, 'shards', None)
+    if args.command == 'init' and shards is not None and not os.path.exists(BLOCKS_FILE):
+        from shards import ShardedChain, create
+        if shards < 1:
+            get_parser().error('--shards must be at least 1')
+        create(BLOCKS_FILE, shards, Blockchain)
+        bl = ShardedChain(BLOCKS_FILE, shards, Blockchain)
+        bl.created = True
+        return bl
+    genesis = read_genesis(BLOCKS_FILE)
+    if genesis not in (None, GENESIS_DATA):
+        from shards import ShardedChain, shard_count
+        shards = shard_count(genesis)
+        if shards is not None:
+            return ShardedChain(BLOCKS_FILE, shards, Blockchain)
+    return Blockchain(shared=args.command in READ_COMMANDS)
+
+# main driver
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    session = Session(argv, getattr(args, 'profile', False), getattr(args, 'cprofile', None))
+
+    # an image is hashed by the process it was named to, server or not; only
+    # recording the digests on the chain goes on like any other command,
+    # with the digests passed along beside the command line
+    digests = None
+    if args.command == 'hash':
+        digests = hash_image_file(args, sys.stdout)
+        if digests is None:
+            return 1
+        if args.item_id is None:
+            return 0
+
+    if args.command == 'serve':
+        from server import serve
+        if read_genesis(BLOCKS_FILE) not in (None, GENESIS_DATA):
+            print("Error: serve does not work on a sharded blockchain yet.")
+            return 1
+        bl = Blockchain(fsync=FSYNC_CLOSE)
+        serve(bl, run_command, SOCKET_FILE)
+        return 0
+
+    session.start()
+    try:
+        # --shards only applies to a chain 'init' creates; an existing one
+        # must have been created with as many shards already
+        if args.command == 'init' and getattr(args, 'shards', None) is not None and os.path.exists(BLOCKS_FILE):
+            from shards import shard_count
+            shards = shard_count(read_genesis(BLOCKS_FILE))
+            if shards != args.shards:
+                kind = 'is not sharded' if shards is None else f'has {shards} shards'
+                print(f"Error: {BLOCKS_FILE} already exists and {kind}; "
+                      f"--shards only applies when creating a chain.")
+                return 1
+
+        # with a server running, hand the command over to it; the server
+        # holds the lock, so this process could not run it anyway, and a
+        # profile then covers the client's side of the command
+        stdin = None
+        if os.path.exists(SOCKET_FILE) and args.command not in LOCAL_COMMANDS:
+            from server import request
+            # the server cannot read this process's stdin; a manifest piped
+            # in is read here and sent along with the command
+            if args.command == 'import' and args.manifest == '-':
+                try:
+                    stdin = sys.stdin.buffer.read().decode('utf-8-sig')
+                except UnicodeDecodeError as e:
+                    print(f"Error: Cannot read manifest -: {e}")
+                    return 1
+            response = request(SOCKET_FILE, argv, digests, stdin)
+            if response is not None:
+                status, output = response
+                sys.stdout.write(output)
+                return status
+
+        # an existing chain only needs its header looked at for 'init'
+        if args.command == 'init' and os.path.exists(BLOCKS_FILE) and \
+                os.path.getsize(BLOCKS_FILE) > HEADER.size and read_version(BLOCKS_FILE) == VERSION:
+            print('Blockchain file found with INITIAL block.')
+            return 0
+        if args.command in LOCAL_COMMANDS:
+            return run_local(args, sys.stdout)
+
+        # otherwise work on the file directly, under the advisory lock (a
+        # file that cannot be opened, such as an old chain that cannot be
+        # converted, is reported rather than raised)
+        try:
+            bl = open_chain(args)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+        try:
+            return run_command(bl, argv, sys.stdout, digests, stdin)
+        finally:
+            session.add_counters(cache_stats(bl), 'cache_')
+            bl.close()
+    finally:
+        session.stop()
+
+if __name__ == '__main__':
+    sys.exit(main())
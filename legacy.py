@@ -0,0 +1,201 @@
+import io
+import os
+import pickle
+import uuid
+from blockstore import HEADER, MAGIC, RECORD_LEN, VERSION, ChainOfCustody, CustodyEvent, read_version
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      legacy.py
+    Description:    One-shot conversion of chains written by
+                    older versions of the scripts (pickled
+                    blocks) into the current block log. Only
+                    imported when such a file is opened.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# Older files stored pickled blocks: the whole mutable Case in every
+# block, first as one pickled list (no header) and then as version 1 of
+# this log, and one pickled CustodyEvent per block in version 2. They are
+# read with stand-in classes, so it does not matter which script wrote them.
+class LegacyBlock:
+    pass
+
+
+class LegacyCase:
+    pass
+
+
+class LegacyEvent:
+    pass
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == 'ChainOfCustody':
+            return LegacyBlock
+        if name == 'Case':
+            return LegacyCase
+        if name == 'CustodyEvent':
+            return LegacyEvent
+        return super().find_class(module, name)
+
+
+# Case ids used to be free text; the block log stores them as UUIDs. An id
+# that is not one is mapped to the UUID5 of its text in this namespace, so
+# the same old id always becomes the same case.
+LEGACY_CASE_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'bchoc:legacy-case-id')
+
+
+# the case id to store for an old one; ids that had to be mapped are
+# added to `mapped`
+def legacy_case_id(case_id, mapped):
+    try:
+        return str(uuid.UUID(str(case_id)))
+    except ValueError:
+        mapped[str(case_id)] = str(uuid.uuid5(LEGACY_CASE_NAMESPACE, str(case_id)))
+        return mapped[str(case_id)]
+
+
+# Item ids are stored as u32s, but the old scripts took any text. An id
+# that is not a whole number in that range is mapped to the low 32 bits of
+# the UUID5 of its text in this namespace, hashed again with a counter
+# while the number is taken by another id of the chain, so the same old
+# chain always converts the same way.
+LEGACY_ITEM_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'bchoc:legacy-item-id')
+
+
+def whole_item_id(item_id):
+    try:
+        number = int(str(item_id).strip())
+    except ValueError:
+        return None
+    return number if 0 <= number < 2 ** 32 else None
+
+
+# the item id to store for an old one; ids that had to be mapped are added
+# to `mapped`, and the numbers they get to `taken`, which starts out with
+# every whole-number id of the chain
+def legacy_item_id(item_id, mapped, taken):
+    number = whole_item_id(item_id)
+    if number is not None:
+        return number
+    text = str(item_id)
+    if text not in mapped:
+        n = 0
+        number = uuid.uuid5(LEGACY_ITEM_NAMESPACE, text).int % 2 ** 32
+        while number in taken:
+            n += 1
+            number = uuid.uuid5(LEGACY_ITEM_NAMESPACE, f'{text}#{n}').int % 2 ** 32
+        taken.add(number)
+        mapped[text] = number
+    return mapped[text]
+
+
+def legacy_blocks(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            yield from LegacyUnpickler(f).load()
+            return
+        f.seek(HEADER.size)
+        while True:
+            raw = f.read(RECORD_LEN.size)
+            if len(raw) < RECORD_LEN.size:
+                return
+            (length,) = RECORD_LEN.unpack(raw)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield LegacyUnpickler(io.BytesIO(payload)).load()
+
+
+# every item id an old block mentions, as it was stored
+def legacy_item_ids(block):
+    data = block.data
+    if isinstance(data, LegacyEvent):
+        return [data.item_id]
+    if isinstance(data, LegacyCase):
+        return [item['item_id'] for item in data.items]
+    return []
+
+
+# one-shot conversion of an old chain into block records. Every item that
+# shows up in a Case snapshot, or whose status differs from the previous
+# snapshot, becomes one event (two for an item first seen past CHECKEDIN).
+# The original file is kept as <path>.v<version>.bak (<path>.pickle.bak for
+# the headerless format). Whatever the conversion had to make up is listed
+# in <backup>.notes: case and item ids mapped to ones the block log can
+# store, and the check-ins added in front of items first seen past
+# CHECKEDIN. Nothing is touched if the chain cannot be converted.
+def migrate_legacy(path):
+    version = read_version(path)
+    backup_path = path + (f'.v{version}.bak' if version else '.pickle.bak')
+    blocks = list(legacy_blocks(path))
+    taken = {number for block in blocks for number in map(whole_item_id, legacy_item_ids(block))}
+    taken.discard(None)
+    chain = []
+    statuses = {}
+    mapped = {}
+    mapped_items = {}
+    added = []
+    for block in blocks:
+        data = block.data
+        if isinstance(data, LegacyEvent):
+            event = CustodyEvent(legacy_case_id(data.case_id, mapped),
+                                 legacy_item_id(data.item_id, mapped_items, taken),
+                                 data.action, data.owner, data.timestamp)
+            chain.append(ChainOfCustody(event, chain[-1].hash, event.timestamp))
+            continue
+        if not isinstance(data, LegacyCase):
+            if not chain:
+                chain.append(ChainOfCustody(data, "0", block.timestamp))
+            continue
+        if not chain:
+            chain.append(ChainOfCustody("Genesis Block", "0", block.timestamp))
+        case_id = legacy_case_id(data.case_id, mapped)
+        for item in data.items:
+            item_id = legacy_item_id(item['item_id'], mapped_items, taken)
+            if statuses.get(item_id) == item['status']:
+                continue
+            # the scripts shared one Case between all their blocks, so a
+            # snapshot can show an item already past CHECKEDIN the first
+            # time it appears; the check-in it went through comes first
+            if item_id not in statuses and item['status'] != 'CHECKEDIN':
+                event = CustodyEvent(case_id, item_id, 'CHECKEDIN', timestamp=block.timestamp)
+                added.append((len(chain), event))
+                chain.append(ChainOfCustody(event, chain[-1].hash, event.timestamp))
+            statuses[item_id] = item['status']
+            event = CustodyEvent(case_id, item_id, item['status'], timestamp=block.timestamp)
+            chain.append(ChainOfCustody(event, chain[-1].hash, event.timestamp))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION))
+        for block in chain:
+            f.write(RECORD_LEN.pack(len(block.raw)))
+            f.write(block.raw)
+        f.flush()
+        os.fsync(f.fileno())
+    if mapped or mapped_items or added:
+        write_notes(backup_path + '.notes', os.path.basename(path), os.path.basename(backup_path),
+                    mapped, mapped_items, added)
+    os.replace(path, backup_path)
+    os.replace(tmp_path, path)
+    return len(chain)
+
+
+def write_notes(notes_path, name, backup_name, mapped, mapped_items, added):
+    sections = []
+    if mapped:
+        sections.append([f"Case IDs of {backup_name} that are not UUIDs, and the UUIDs {name} stores them as:"]
+                        + [f"{case_id} -> {mapped[case_id]}" for case_id in sorted(mapped)])
+    if mapped_items:
+        sections.append([f"Item IDs of {backup_name} that are not whole numbers from 0 to {2 ** 32 - 1}, "
+                         f"and the numbers {name} stores them as:"]
+                        + [f"{item_id} -> {mapped_items[item_id]}" for item_id in sorted(mapped_items)])
+    if added:
+        sections.append([f"Check-ins {name} records that {backup_name} does not. Each of these items was "
+                         f"first seen past CHECKEDIN, so a check-in was put just before the block that "
+                         f"first shows it:"]
+                        + [f"Block {height}: case {event.case_id}, item {event.item_id}, CHECKEDIN, "
+                           f"time {event.timestamp.isoformat()}" for height, event in added])
+    with open(notes_path, 'w') as f:
+        f.write('\n\n'.join('\n'.join(lines) for lines in sections) + '\n')
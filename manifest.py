@@ -0,0 +1,90 @@
+import csv
+import time
+import uuid
+from blockstore import CustodyEvent
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      manifest.py
+    Description:    Bulk import of evidence intake manifests:
+                    CSV files of (case_id, item_id, owner) rows,
+                    one per item handed in. The manifest is read
+                    once, row by row; every good row becomes a
+                    CHECKEDIN event and the events are appended
+                    in large batches.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# the optional first row naming the columns; owner may be left out
+COLUMNS = ('case_id', 'item_id', 'owner')
+
+# events per append (one write and one fsync); the item snapshot is only
+# written once, when the chain is closed after the import
+IMPORT_BATCH = 10000
+
+
+# (line number, event or None, what is wrong with the row or None) for
+# every row of the manifest. Item ids are checked against `known` (the
+# items already on the chain) and against the rows before them.
+def read_manifest(f, known):
+    seen = set()
+    # case id as written -> its 16 bytes; parsing a UUID costs more than
+    # the rest of a row, and a manifest repeats a few cases many times
+    cases = {}
+    reader = csv.reader(f)
+    for row in reader:
+        line = reader.line_num
+        if not row or not ''.join(row).strip():
+            continue
+        if line == 1 and tuple(field.strip().lower() for field in row) in (COLUMNS, COLUMNS[:2]):
+            continue
+        if len(row) not in (2, 3):
+            yield line, None, f"Expected case_id,item_id[,owner], got {len(row)} fields."
+            continue
+        case_id, item_id = row[0].strip(), row[1].strip()
+        owner = row[2].strip() if len(row) == 3 else ''
+        try:
+            case_bytes = cases.get(case_id)
+            if case_bytes is None:
+                case_bytes = cases[case_id] = uuid.UUID(case_id).bytes
+            event = CustodyEvent(case_bytes, item_id, 'CHECKEDIN', owner or None)
+        except ValueError:
+            yield line, None, f"Invalid case ID or item ID: {case_id!r}, {item_id!r}"
+            continue
+        if event.item_id in known or event.item_id in seen:
+            yield line, None, f"Duplicate item ID: {event.item_id}"
+            continue
+        seen.add(event.item_id)
+        yield line, event, None
+
+
+# Adds the items of the manifest `f` to `bl` and reports on `out` what
+# was rejected and how fast it went; returns (items added, rows rejected).
+# Good rows go in even when others are rejected, unless `strict` is set,
+# in which case nothing is written if any row is bad (and the events are
+# held in memory until the whole manifest has been checked). The rows are
+# checked and added under bl.reserve_items().
+def import_manifest(bl, f, out, strict=False, batch=IMPORT_BATCH):
+    start = time.perf_counter()
+    pending = []
+    added = rejected = 0
+    with bl.reserve_items():
+        for line, event, reason in read_manifest(f, bl.items):
+            if event is None:
+                out.write(f"Line {line}: {reason}\n")
+                rejected += 1
+                continue
+            pending.append(event)
+            if not strict and len(pending) >= batch:
+                bl.add_blocks(pending, save=False)
+                added += len(pending)
+                pending = []
+        if strict and rejected:
+            pending = []
+        for n in range(0, len(pending), batch):
+            bl.add_blocks(pending[n:n + batch], save=False)
+        added += len(pending)
+    elapsed = time.perf_counter() - start
+    rate = f" ({added / elapsed:.0f} items/s)" if added and elapsed else ''
+    out.write(f"Imported {added} items in {elapsed:.2f} s{rate}; rejected {rejected} rows.\n")
+    if strict and rejected:
+        out.write("Nothing was imported: --strict is set and the manifest has bad rows.\n")
+    return added, rejected
@@ -0,0 +1,240 @@
+import hashlib
+import os
+import struct
+from blockstore import ChainOfCustody, format_log_entry
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      merkle.py
+    Description:    Merkle roots over fixed-size segments of the
+                    block log, and inclusion proofs built from
+                    them. A proof carries one block, the sibling
+                    hashes up to its segment root and from there
+                    up to the root of the whole chain, so it can
+                    be checked without the rest of the chain.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# blocks per segment; every full segment's root is kept in <path>.roots
+SEGMENT_SIZE = int(os.environ.get('BCHOC_SEGMENT_SIZE', 1024))
+
+# <path>.roots = segment size (u32) + leaf hash of the genesis block (so
+#                roots left over from another log are not used) + the
+#                32-byte root of every full segment, in order
+ROOTS_HEADER = struct.Struct('<I32s')
+
+PROOF_FORMAT = 'bchoc-proof-v2'
+
+# The root of the chain covers the segment size and the number of blocks
+# as well as the tree over the segment roots: the shape of the tree, and
+# so where a block sits in it, depends on both, and a proof could
+# otherwise move a block by naming different ones.
+CHAIN_ROOT = struct.Struct('<IQ')
+
+
+# Leaves and inner nodes are hashed with different prefixes, so that an
+# inner node can never be passed off as a block.
+def leaf_hash(payload):
+    return hashlib.sha256(b'\0' + payload).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(b'\1' + left + right).digest()
+
+
+# Every level of the tree over `hashes`, leaves first. Nodes are paired
+# left to right; the odd one out at the end of a level moves up unchanged
+# (it is not paired with itself, which would let two different lists of
+# leaves have the same root).
+def tree_levels(hashes):
+    levels = [list(hashes)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                       for i in range(0, len(level), 2)])
+    return levels
+
+
+def tree_root(hashes):
+    return tree_levels(hashes)[-1][0]
+
+
+# sibling hashes from leaf `index` up to the root, each as ('L' or 'R',
+# hex digest) for the side the sibling is on
+def audit_path(levels, index):
+    path = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            path.append(('L' if sibling < index else 'R', level[sibling].hex()))
+        index //= 2
+    return path
+
+
+# the sides ('L' or 'R') audit_path gives for leaf `index` of a tree with
+# `count` leaves
+def path_sides(count, index):
+    sides = []
+    while count > 1:
+        sibling = index ^ 1
+        if sibling < count:
+            sides.append('L' if sibling < index else 'R')
+        index //= 2
+        count = -(-count // 2)
+    return sides
+
+
+def path_root(digest, path):
+    for side, sibling in path:
+        sibling = bytes.fromhex(sibling)
+        digest = node_hash(sibling, digest) if side == 'L' else node_hash(digest, sibling)
+    return digest
+
+
+class SegmentRoots:
+    def __init__(self, store, segment_size=SEGMENT_SIZE):
+        self.store = store
+        self.path = store.path + '.roots'
+        self.segment_size = segment_size
+        self.roots = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return []
+        if len(raw) < ROOTS_HEADER.size or not len(self.store):
+            return []
+        segment_size, genesis = ROOTS_HEADER.unpack_from(raw)
+        if segment_size != self.segment_size or genesis != leaf_hash(self.store.read(0)):
+            return []
+        full = len(self.store) // self.segment_size
+        return [raw[offset:offset + 32]
+                for offset in range(ROOTS_HEADER.size, len(raw) - 31, 32)][:full]
+
+    def save(self):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(ROOTS_HEADER.pack(self.segment_size, leaf_hash(self.store.read(0))))
+            f.write(b''.join(self.roots))
+        os.replace(tmp_path, self.path)
+
+    def segment_count(self):
+        return -(-len(self.store) // self.segment_size)
+
+    def leaves(self, segment):
+        start = segment * self.segment_size
+        stop = min(start + self.segment_size, len(self.store))
+        return [leaf_hash(self.store.read(i)) for i in range(start, stop)]
+
+    # adds the roots of the segments filled since the last call; the first
+    # call on a chain hashes all of it, later ones only the new segments
+    def catch_up(self):
+        full = len(self.store) // self.segment_size
+        if len(self.roots) >= full:
+            return
+        for segment in range(len(self.roots), full):
+            self.roots.append(tree_root(self.leaves(segment)))
+        self.save()
+
+    # the root of every segment, the last one (if it is not full yet) hashed
+    # on the spot
+    def segment_roots(self):
+        self.catch_up()
+        roots = list(self.roots)
+        if len(roots) < self.segment_count():
+            roots.append(tree_root(self.leaves(len(roots))))
+        return roots
+
+    def chain_root(self):
+        return chain_root_hash(self.segment_size, len(self.store), tree_root(self.segment_roots()))
+
+    # One proof per block in `heights`. Only the segments holding those
+    # blocks are read; each is checked against the root recorded for it
+    # earlier, so a block rewritten since shows up here.
+    def prove(self, heights):
+        roots = self.segment_roots()
+        top = tree_levels(roots)
+        proofs = []
+        segments = {}
+        for height in heights:
+            segment, index = divmod(height, self.segment_size)
+            if segment not in segments:
+                levels = tree_levels(self.leaves(segment))
+                if levels[-1][0] != roots[segment]:
+                    raise ValueError(f"Segment {segment} no longer matches its Merkle root: "
+                                     f"blocks {segment * self.segment_size} to "
+                                     f"{(segment + 1) * self.segment_size - 1} were changed.")
+                segments[segment] = levels
+            proofs.append({
+                'height': height,
+                'block': bytes(self.store.read(height)).hex(),
+                'segment': segment,
+                'path': audit_path(segments[segment], index),
+                'segment_root': roots[segment].hex(),
+                'root_path': audit_path(top, segment),
+            })
+        return {
+            'format': PROOF_FORMAT,
+            'segment_size': self.segment_size,
+            'blocks': len(self.store),
+            'root': chain_root_hash(self.segment_size, len(self.store), top[-1][0]).hex(),
+            'events': proofs,
+        }
+
+
+def chain_root_hash(segment_size, blocks, top):
+    return hashlib.sha256(b'\2' + CHAIN_ROOT.pack(segment_size, blocks) + top).digest()
+
+
+# What is wrong with one event of a proof of a chain of `blocks` blocks
+# in segments of `segment_size` against `root`, or None. Both audit paths
+# must take the turns that lead to the block's height, so the proof shows
+# where in the chain the block is as well as that it is there.
+def check_event(event, segment_size, blocks, root):
+    height = event['height']
+    if not isinstance(height, int) or not 0 <= height < blocks:
+        return f"Block is not one of the {blocks} blocks of the chain."
+    segment, index = divmod(height, segment_size)
+    if event['segment'] != segment:
+        return f"Block is in segment {segment}, not segment {event['segment']}."
+    leaves = min(segment_size, blocks - segment * segment_size)
+    if [side for side, _ in event['path']] != path_sides(leaves, index):
+        return "Audit path does not lead to this block of its segment."
+    if [side for side, _ in event['root_path']] != path_sides(-(-blocks // segment_size), segment):
+        return "Audit path does not lead to this segment of the chain."
+    digest = path_root(leaf_hash(bytes.fromhex(event['block'])), event['path'])
+    if digest.hex() != event['segment_root']:
+        return "Block does not hash to its segment root."
+    top = path_root(digest, event['root_path'])
+    if chain_root_hash(segment_size, blocks, top).hex() != root:
+        return "Segment root does not hash to the chain root."
+    return None
+
+
+# Checks a proof written by `prove` and writes what it proves to `out`.
+# The proof only shows that its blocks are in the chain whose root it
+# names; `root`, when given, is the root the caller trusts (as printed by
+# `prove` on a chain known to be good), and the proof must name it.
+# Returns the exit status.
+def check_proof(proof, out, root=None):
+    problems = []
+    if proof.get('format') != PROOF_FORMAT:
+        problems.append(f"Unknown proof format: {proof.get('format')}")
+    elif root is not None and proof['root'] != root.lower():
+        problems.append(f"Proof is for chain root {proof['root']}, not {root.lower()}.")
+    elif not all(isinstance(proof.get(key), int) and proof[key] > 0 for key in ('segment_size', 'blocks')):
+        problems.append("Proof does not give a segment size and a number of blocks.")
+    else:
+        for event in proof['events']:
+            reason = check_event(event, proof['segment_size'], proof['blocks'], proof['root'])
+            if reason is not None:
+                problems.append(f"Block {event['height']}: {reason}")
+                continue
+            block = ChainOfCustody.decode(bytes.fromhex(event['block']))
+            out.write(f"Block: {event['height']}\n{format_log_entry(block)}")
+    out.write(f"Chain root: {proof.get('root')}\nBlocks in chain: {proof.get('blocks')}\n")
+    if problems:
+        out.write("State of proof: INVALID\n" + ''.join(f"{problem}\n" for problem in problems))
+        return 1
+    out.write("State of proof: VALID\n")
+    return 0
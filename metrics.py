@@ -0,0 +1,181 @@
+import os
+import sys
+import time
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      metrics.py
+    Description:    Opt-in timings and counters for one bchoc
+                    command, broken down by phase (load, decode,
+                    index, hash, serialize, write, fsync, ...),
+                    printed as a summary and/or appended as a
+                    JSON line to a metrics file, plus a cProfile
+                    dump of the whole command.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# switches (the command line flags of gradescope.py set the same things):
+#   BCHOC_PROFILE=1        print the phase summary to stderr  (--profile)
+#   BCHOC_METRICS=<path>   append the phases as one JSON line to <path>
+#   BCHOC_CPROFILE=<path>  dump cProfile stats of the command to <path>
+#                          (read them with python -m pstats <path>)  (--cprofile)
+#
+# Nothing is instrumented unless one of them is on: enable() wraps the
+# methods listed in PHASES at runtime, so a normal run pays nothing for
+# this. Phase times are inclusive, and phases nest (the first index lookup
+# includes replaying the blocks, a write includes its fsync), so they do
+# not add up to the wall time.
+
+# (phase, module, class or None for a module function, attribute)
+PHASES = (
+    ('load', 'blockstore', 'BlockLog', '__init__'),
+    ('read', 'blockstore', 'BlockLog', 'read'),
+    ('decode', 'blockstore', 'ChainOfCustody', 'decode'),
+    ('hash', 'blockstore', 'ChainOfCustody', 'calculate_hash'),
+    ('serialize', 'blockstore', 'ChainOfCustody', 'encode'),
+    ('write', 'blockstore', 'BlockLog', 'append_many'),
+    ('fsync', 'blockstore', 'BlockLog', 'sync'),
+    ('publish_head', 'blockstore', 'BlockLog', 'publish_head'),
+    ('snapshot_load', 'blockstore', 'ItemIndex', 'load'),
+    ('snapshot_save', 'blockstore', 'ItemIndex', 'save'),
+    ('replay', 'blockstore', 'ItemIndex', 'apply'),
+    ('index_lookup', 'blockstore', 'ItemIndex', 'get'),
+    ('index_lookup', 'blockstore', 'ItemIndex', '__contains__'),
+    ('index_lookup', 'blockstore', 'ItemIndex', 'get_case'),
+    ('verify', 'verify', None, 'verify_chain'),
+    ('merkle', 'merkle', 'SegmentRoots', 'prove'),
+    ('merkle', 'merkle', 'SegmentRoots', 'chain_root'),
+)
+
+# phase -> [calls, seconds]; counter -> value
+phases = {}
+counters = {}
+enabled = False
+
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+
+def timed(phase, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            entry = phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+    wrapper.__wrapped__ = fn
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+
+# byte counters, on top of the phase timings
+def counted_read(fn):
+    def read(self, i):
+        payload = fn(self, i)
+        count('bytes_read', len(payload))
+        return payload
+    return read
+
+
+def counted_append(fn):
+    def append_many(self, payloads):
+        start = self.end
+        offsets = fn(self, payloads)
+        count('bytes_written', self.end - start)
+        count('blocks_written', len(offsets))
+        return offsets
+    return append_many
+
+
+def enable():
+    global enabled
+    if enabled:
+        return
+    enabled = True
+    for phase, module_name, class_name, attribute in PHASES:
+        module = sys.modules.get(module_name) or __import__(module_name)
+        owner = getattr(module, class_name) if class_name else module
+        original = owner.__dict__[attribute] if class_name else getattr(module, attribute)
+        if isinstance(original, classmethod):
+            wrapped = classmethod(timed(phase, original.__func__))
+        else:
+            if (class_name, attribute) == ('BlockLog', 'read'):
+                original = counted_read(original)
+            elif (class_name, attribute) == ('BlockLog', 'append_many'):
+                original = counted_append(original)
+            wrapped = timed(phase, original)
+        setattr(owner, attribute, wrapped)
+
+
+def summary(wall):
+    lines = [f"{'phase':16} {'calls':>10} {'total ms':>12}"]
+    for phase, (calls, seconds) in sorted(phases.items(), key=lambda item: -item[1][1]):
+        lines.append(f"{phase:16} {calls:10} {seconds * 1000:12.3f}")
+    lines.append(f"{'wall':16} {'':10} {wall * 1000:12.3f}")
+    for name, value in sorted(counters.items()):
+        lines.append(f"{name:27} {value:12}")
+    return '\n'.join(lines)
+
+
+def record(path, argv, wall):
+    import json
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'pid': os.getpid(),
+        'argv': argv,
+        'wall_seconds': wall,
+        'phases': {phase: {'calls': calls, 'seconds': seconds}
+                   for phase, (calls, seconds) in phases.items()},
+        'counters': counters,
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+# Measures one command: start() before it runs and stop() once it is done.
+# `profile` and `cprofile` come from the command line and add to whatever
+# the environment asks for.
+class Session:
+    def __init__(self, argv, profile=False, cprofile=None):
+        self.argv = argv
+        self.profile = profile or os.environ.get('BCHOC_PROFILE', '') not in ('', '0')
+        self.metrics_path = os.environ.get('BCHOC_METRICS')
+        self.cprofile_path = cprofile or os.environ.get('BCHOC_CPROFILE')
+        self.profiler = None
+        self.start_time = None
+
+    def active(self):
+        return bool(self.profile or self.metrics_path or self.cprofile_path)
+
+    # counters the command kept itself (such as the state cache's), added
+    # to the summary under `prefix`
+    def add_counters(self, values, prefix=''):
+        if self.start_time is None:
+            return
+        for name, value in values.items():
+            count(prefix + name, value)
+
+    def start(self):
+        if not self.active():
+            return
+        if self.profile or self.metrics_path:
+            enable()
+        if self.cprofile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        if self.start_time is None:
+            return
+        wall = time.perf_counter() - self.start_time
+        self.start_time = None
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.cprofile_path)
+        if self.profile:
+            print(summary(wall), file=sys.stderr)
+        if self.metrics_path:
+            record(self.metrics_path, self.argv, wall)
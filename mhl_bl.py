@@ -1,8 +1,8 @@
-import datetime
-import hashlib
 import os
-import pickle
 import argparse
+import sys
+from blockstore import BlockLog, CaseState, ChainOfCustody, ItemIndex, LazyChain, iter_log, write_log
+from metrics import Session
 '''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     Authors:        MinhHien Luong
     File Name:      blockchain.py
@@ -12,47 +12,18 @@ import argparse
 '''
 
 # case's data
-class Case:
-    def __init__(self, case_id):
-        self.case_id = case_id
-        self.items = []
-
-    def add_item(self, item_id):
-        self.items.append({
-            'item_id': item_id,
-            'status': 'CHECKEDIN',
-            'time': datetime.datetime.now().isoformat(),
-        })
-
-    def get_items(self):
-        return self.items
-
-# Hashed as a blockchain system
-class ChainOfCustody:
-    def __init__(self, data, previous_hash):
-        self.timestamp = datetime.datetime.now()
-        self.data = data
-        self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self):
-        sha = hashlib.sha256()
-        sha.update(str(self.timestamp).encode('utf-8') +
-                   str(self.data).encode('utf-8') +
-                   str(self.previous_hash).encode('utf-8'))
-        return sha.hexdigest()
+class Case(CaseState):
+    pass
 
 # each block's properties set up
 class Blockchain:
-    def __init__(self):
+    def __init__(self, fsync=None):
         self.blocks_file = 'blocks.bin'
-        if os.path.exists(self.blocks_file):
-            with open(self.blocks_file, 'rb') as f:
-                self.chain = pickle.load(f)
-        else:
-            self.chain = [self.create_genesis_block()]
-            with open(self.blocks_file, 'wb') as f:
-                pickle.dump(self.chain, f)
+        self.store = BlockLog(self.blocks_file, fsync)
+        self.chain = LazyChain(self.store, ChainOfCustody.decode)
+        if not len(self.store):
+            self.store.append(self.create_genesis_block().raw)
+        self.items = ItemIndex(self.store, self.chain)
 
     def create_genesis_block(self):
         return ChainOfCustody("Genesis Block", "0")
@@ -60,41 +31,32 @@ class Blockchain:
     def add_block(self, new_data):
         previous_hash = self.chain[-1].hash
         new_block = ChainOfCustody(new_data, previous_hash)
-        self.chain.append(new_block)
-        with open(self.blocks_file, 'wb') as f:
-            pickle.dump(self.chain, f)
+        self.store.append(new_block.raw)
+        self.items.update(len(self.store) - 1, new_block)
+
+    def close(self):
+        self.items.checkpoint()
+        self.store.close()
 
     def get_chain(self):
         return self.chain
 
     def get_cases(self):
-        cases = {}
-        for block in self.chain:
-            if isinstance(block.data, Case):
-                cases[block.data.case_id] = block.data
-        return cases
+        return self.items.get_cases(Case)
 
     def get_case(self, case_id):
-        for block in self.chain:
-            if isinstance(block.data, Case) and block.data.case_id == case_id:
-                return block.data
-        return None
+        return self.items.get_case(case_id, Case)
     
-    def log(self, item_id=None, reverse=False, num_entries=None):
-        blocks = self.chain
-        if item_id:
-            blocks=[block for block in self.chain 
-                    if isinstance(block.data, Case) and any(item['item_id'] == item_id for item in block.data_items)]
-        if reverse:
-            blocks = reversed(blocks)
-        if num_entries is not None:
-            blocks = list(blocks)[:num_entries]
-        for block in blocks:
-            data = block.data
-            if isinstance(data, Case):
-                for item in data.items:
-                    if item_id is None or item['item_id'] == item_id:
-                        print(f"Case: {data.case_id}\nItem: {item['item_id']}\nAction: {item['status']}\nTime: {item['time']}\n")
+    def log(self, item_id=None, reverse=False, num_entries=None, out=None):
+        blocks = iter_log(self.chain, self.items, item_id, reverse, num_entries)
+        write_log(out or sys.stdout, blocks)
+
+# -n takes a count, so a negative one is a usage error
+def non_negative(text):
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, not {value}")
+    return value
 
 # commands parser
 def get_parser():
@@ -108,21 +70,29 @@ def get_parser():
     # create the parser for the "add" command
     parser_add = subparsers.add_parser('add', help='add a new block to the blockchain')
     parser_add.add_argument('-c', '--case-id', required=True, help='the ID of the case to add the evidence to')
-    parser_add.add_argument('-i', '--item-id', required=True, help='the ID of the evidence item being added')
+    parser_add.add_argument('-i', '--item-id', type=int, nargs='+', required=True, help='the ID(s) of the evidence item(s) being added')
 
     # create the parser for the "log" command
     parser_log = subparsers.add_parser('log', help='display the blockchain entries')
-    parser_log.add_argument('-i', '--item-id', help='the ID of the evidence item being displayed')
+    parser_log.add_argument('-i', '--item-id', type=int, help='the ID of the evidence item being displayed')
     parser_log.add_argument('-r', '--reverse', action='store_true', help='reverse the order of the block entries')
-    parser_log.add_argument('-n', '--num-entries', type=int, help='number of block entries to show')
+    parser_log.add_argument('-n', '--num-entries', type=non_negative, help='number of block entries to show')
 
     return parser
 
 # main driver
 if __name__ == '__main__':
     
+    # timings, when BCHOC_PROFILE / BCHOC_METRICS / BCHOC_CPROFILE ask for them
+    session = Session(sys.argv[1:])
+    session.start()
+
     # initialization and local objs
-    bl = Blockchain()
+    try:
+        bl = Blockchain()
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
     # parser
     parser = get_parser()
@@ -137,15 +107,26 @@ if __name__ == '__main__':
             print('Blockchain file not found. Created INITIAL block.')
 
     # 'add' command
+    status = 0
     if args.command == 'add':
-        if args.case_id and args.item_id:
+        # nothing is written if an item is on the chain already or given twice
+        duplicate = None
+        seen = set()
+        for item_id in args.item_id:
+            if item_id in bl.items or item_id in seen:
+                duplicate = item_id
+                break
+            seen.add(item_id)
+        if duplicate is not None:
+            print(f"Error: Duplicate item ID: {duplicate}")
+            status = 1
+        elif args.case_id and args.item_id:
             case = bl.get_case(args.case_id)
             if case:
                 for item_id in args.item_id:
-                    case.add_item(item_id)
-                    bl.add_block(case)
+                    bl.add_block(case.add_item(item_id))
                     item = case.get_items()[-1]
-                    print(f"Case: {case.case_id}\nAdded item: {item['item_id']}\nStatus: {item['status']}\nTime of action: {item['time']}\n")
+                    print(f"Case: {case.case_id}\nAdded item: {item.item_id}\nStatus: {item.status}\nTime of action: {item.time}\n")
             else:
                 print (f"Error: Case with ID {args.case_id} not found.")
         else:
@@ -153,31 +134,10 @@ if __name__ == '__main__':
 
     # 'log' command
     if args.command == 'log':
-        cases = bl.get_cases()
-        item_id = args.item_id
-        reverse = args.reverse
-        num_entries = args.num_entries
-        if item_id:
-            for case_id in cases:
-                case = cases[case_id]
-                items = case.get_items()
-                for item in items:
-                    if item['item_id'] == item_id:
-                        print(f"Case: {case.case_id}\nItem: {item_id}\nAction: {item['status']}\nTime: {item['time']}\n")
-                        break
-                else:
-                    continue
-                break
-        else:
-            blocks = bl.get_chain()
-            if reverse:
-                blocks.reverse()
-            if num_entries:
-                blocks = blocks[-num_entries:]
-            for block in blocks:
-                if isinstance(block.data, Case):
-                    print(f"Case: {block.data.case_id}\n")
-                else:
-                    print(f"Item: {block.data}\n")
+        bl.log(args.item_id, args.reverse, args.num_entries)
+
+    bl.close()
+    session.stop()
+    sys.exit(status)
 
     # example use
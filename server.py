@@ -0,0 +1,154 @@
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      server.py
+    Description:    Optional resident server for bchoc. It keeps
+                    one Blockchain (and its indexes) in memory
+                    and runs commands sent by thin CLI clients
+                    over a local Unix socket, one writer at a
+                    time, with group commit of the fsyncs.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# wire format, one JSON object per line each way:
+#   client -> server   {"argv": [...]}, with "digests": "<...>" added for a
+#                      hash command, the image having been hashed by the
+#                      client, and "stdin": "<...>" for an import of a
+#                      manifest piped in to the client
+#   server -> client   {"status": <exit status>, "output": "<stdout text>"}
+
+
+def socket_path(blocks_file):
+    return blocks_file + '.sock'
+
+
+# Group commit: commands append without fsyncing and then wait here until
+# their bytes are durable. The first waiter fsyncs everything appended so
+# far; whoever arrives while that fsync runs is covered by the next one,
+# so concurrent writers share fsyncs instead of queueing one each.
+# Progress is counted in bytes appended (BlockLog.appended), which only
+# goes up; the end of the file goes down when a compaction drops blocks.
+# `lock` is the one commands run under: the file is looked up under it,
+# as a compaction replaces it.
+class GroupCommit:
+    def __init__(self, store, lock):
+        self.store = store
+        self.lock = lock
+        self.cond = threading.Condition()
+        self.synced = store.appended
+        self.syncing = False
+
+    def wait(self, appended):
+        with self.cond:
+            while self.synced < appended:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.syncing = True
+                self.cond.release()
+                try:
+                    with self.lock:
+                        target = self.store.appended
+                        fd = os.dup(self.store.f.fileno())
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                finally:
+                    self.cond.acquire()
+                    self.syncing = False
+                    self.cond.notify_all()
+                self.synced = max(self.synced, target)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        message = json.loads(line)
+        out = io.StringIO()
+        try:
+            # commands never read the server's own stdin
+            status = self.server.run(message['argv'], out, message.get('digests'), message.get('stdin', ''))
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            out.write(f"Error: {e}\n")
+            status = 1
+        reply = {'status': status, 'output': out.getvalue()}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # `run(bl, argv, out, digests, stdin)` executes one command and returns its exit status
+    def __init__(self, path, bl, run):
+        self.bl = bl
+        self.runner = run
+        self.lock = threading.Lock()
+        self.commit = GroupCommit(bl.store, self.lock)
+        super().__init__(path, CommandHandler)
+
+    def run(self, argv, out, digests=None, stdin=None):
+        with self.lock:
+            status = self.runner(self.bl, argv, out, digests, stdin)
+            appended = self.bl.store.appended
+        self.commit.wait(appended)
+        return status
+
+
+# runs until SIGINT/SIGTERM; the chain must have been opened with
+# fsync='close', since durability is handled by GroupCommit
+def serve(bl, run, path):
+    if os.path.exists(path):
+        if request(path, None) is not None:
+            raise RuntimeError(f"A server is already listening on {path}")
+        os.remove(path)
+    server = CommandServer(path, bl, run)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        with server.lock:
+            bl.close()
+
+
+# Sends argv, and the digests of an image already hashed or the text read
+# from stdin for the command, to the server at `path` and returns (status,
+# output), or None when no server is listening there. argv=None only
+# probes the socket.
+def request(path, argv, digests=None, stdin=None):
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock, sock.makefile('rwb') as f:
+        if argv is None:
+            return 0, ''
+        message = {'argv': argv}
+        if digests is not None:
+            message['digests'] = digests
+        if stdin is not None:
+            message['stdin'] = stdin
+        f.write(json.dumps(message).encode('utf-8') + b'\n')
+        f.flush()
+        reply = json.loads(f.readline())
+    return reply['status'], reply['output']
@@ -0,0 +1,341 @@
+import contextlib
+import fcntl
+import hashlib
+import heapq
+import itertools
+import os
+import sys
+from blockstore import Anchor, BlockLog, ChainOfCustody, LazyChain, canonical_case_id, log_heights, read_head, write_log
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      shards.py
+    Description:    Optional sharding of the chain of custody.
+                    Cases are spread by a hash of their id over a
+                    fixed number of shards, each its own block log
+                    with its own lock, so writers working on
+                    cases in different shards commit in parallel.
+                    A small root chain records the shard heads
+                    from time to time, which ties the shards
+                    together into one tamper-evident whole.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# layout:  <path>                       root chain: a genesis block naming
+#                                       the shard count, then anchor blocks
+#          <path>.shards/NNNN.bin       shard NNNN, an ordinary block log
+#                                       (with its own .idx, .head, .lock, ...)
+#          <path>.items.lock            held while new items are checked
+#                                       against every shard and added
+SHARDED_GENESIS = 'Genesis Block, shards: '
+
+# a writer anchors the shards once its shard has this many blocks the
+# last anchor does not cover
+ANCHOR_INTERVAL = int(os.environ.get('BCHOC_ANCHOR_INTERVAL', 1000))
+
+
+# shard count of the log at `path`, given its genesis data (see
+# blockstore.read_genesis), or None if the log is not sharded
+def shard_count(genesis):
+    if genesis is None or not genesis.startswith(SHARDED_GENESIS):
+        return None
+    return int(genesis[len(SHARDED_GENESIS):])
+
+
+def shard_path(path, shard):
+    return os.path.join(path + '.shards', f'{shard:04d}.bin')
+
+
+# the shard a case (a canonical case id) lives in
+def shard_of(case_id, shards):
+    digest = hashlib.sha256(case_id.encode('ascii')).digest()
+    return int.from_bytes(digest[:4], 'little') % shards
+
+
+# Creates a sharded log with `shards` empty shards at `path`, which must
+# not hold a log yet. `chain_class` opens one chain (Blockchain).
+def create(path, shards, chain_class, fsync=None):
+    os.makedirs(path + '.shards', exist_ok=True)
+    for shard in range(shards):
+        chain_class(fsync, path=shard_path(path, shard)).close()
+    root = BlockLog(path, fsync)
+    try:
+        if not len(root):
+            root.append(ChainOfCustody(f'{SHARDED_GENESIS}{shards}', '0').raw)
+    finally:
+        root.close()
+
+
+# Every anchor on the root chain, oldest first, as (block number, Anchor
+# or None if the block is not a well-formed anchor)
+def anchors(root):
+    chain = LazyChain(root, ChainOfCustody.decode)
+    for height in range(1, len(root)):
+        try:
+            block = chain[height]
+        except (ValueError, UnicodeDecodeError):
+            yield height, None
+            continue
+        yield height, block.data if isinstance(block.data, Anchor) else None
+
+
+# The same commands as Blockchain, over a sharded log. Shards are opened
+# as readers, which take no lock; the shard a command writes to is
+# reopened as a writer, under that shard's lock only, and whatever the
+# command decided from the reader is checked again under the lock (by
+# the Blockchain methods that do the writing). A new item could be added
+# to two shards at once, though, so adding items also takes a lock of its
+# own for every shard (see reserve_items). The root chain is only locked
+# for the moment it takes to append an anchor.
+class ShardedChain:
+    sharded = True
+
+    def __init__(self, path, shards, chain_class, fsync=None):
+        self.path = path
+        self.count = shards
+        self.chain_class = chain_class
+        self.fsync = fsync
+        self.created = False
+        self.readers = {}
+        self.writers = {}
+        self.reserved = False
+        self.items = ShardedItems(self)
+
+    def reader(self, shard):
+        chain = self.writers.get(shard) or self.readers.get(shard)
+        if chain is None:
+            chain = self.readers[shard] = self.chain_class(self.fsync, shared=True,
+                                                           path=shard_path(self.path, shard))
+        return chain
+
+    # a reader that fell back to the lock holds it shared, and this
+    # process asking for it exclusively on top would wait for itself
+    def writer(self, shard):
+        if shard not in self.writers:
+            reader = self.readers.pop(shard, None)
+            if reader is not None:
+                reader.close()
+            self.writers[shard] = self.chain_class(self.fsync, path=shard_path(self.path, shard))
+        return self.writers[shard]
+
+    def shard_of(self, case_id):
+        return shard_of(case_id, self.count)
+
+    # the shard holding `item_id`, or None
+    def locate(self, item_id):
+        for shard in range(self.count):
+            if item_id in self.reader(shard).items:
+                return shard
+        return None
+
+    # events go to the shards of their cases, one append per shard; events
+    # adding new items must have been checked under reserve_items
+    def add_blocks(self, new_data, save=True):
+        by_shard = {}
+        for data in new_data:
+            by_shard.setdefault(self.shard_of(data.case_id), []).append(data)
+        for shard, events in sorted(by_shard.items()):
+            self.writer(shard).add_blocks(events, save)
+
+    # Held while new items are checked against every shard and appended,
+    # so that no other writer adds the same item id to another shard in
+    # between. The shards are read afresh once the lock is taken: a
+    # writer publishes its shard's head before letting go of the lock.
+    @contextlib.contextmanager
+    def reserve_items(self):
+        if self.reserved:
+            yield
+            return
+        with open(self.path + '.items.lock', 'ab') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for shard in [shard for shard in self.readers if shard != 'root']:
+                self.readers.pop(shard).close()
+            self.reserved = True
+            try:
+                yield
+            finally:
+                self.reserved = False
+
+    def add_items(self, case_id, item_ids):
+        shard = self.shard_of(canonical_case_id(case_id))
+        with self.reserve_items():
+            for item_id in item_ids:
+                if item_id in self.items:
+                    raise ValueError(f"Duplicate item ID: {item_id}")
+            return self.writer(shard).add_items(case_id, item_ids)
+
+    def change_status(self, item_id, action, owner=None):
+        shard = self.locate(item_id)
+        if shard is None:
+            raise ValueError(f"Item ID not found: {item_id}")
+        return self.writer(shard).change_status(item_id, action, owner)
+
+    def record_digests(self, item_id, digests):
+        shard = self.locate(item_id)
+        if shard is None:
+            raise ValueError(f"Item ID not found: {item_id}")
+        return self.writer(shard).record_digests(item_id, digests)
+
+    # The blocks of every shard merged by time (a stable merge, so shard
+    # order settles ties). Shard genesis blocks are left out; without
+    # filters the root genesis block opens the log, as in an unsharded one.
+    def log(self, item_id=None, reverse=False, num_entries=None, out=None,
+            since=None, until=None, status=None, case_id=None):
+        filtered = any(value is not None for value in (item_id, since, until, status, case_id))
+        if case_id is not None:
+            shards = [self.shard_of(case_id)]
+        elif item_id is not None:
+            shards = [shard for shard in [self.locate(item_id)] if shard is not None]
+        else:
+            shards = range(self.count)
+        streams = [self.shard_blocks(self.reader(shard), reverse, item_id, since, until, status, case_id)
+                   for shard in shards]
+        blocks = heapq.merge(*streams, key=lambda block: block.micros, reverse=reverse)
+        if not filtered:
+            genesis = [LazyChain(self.root(), ChainOfCustody.decode)[0]]
+            blocks = itertools.chain(blocks, genesis) if reverse else itertools.chain(genesis, blocks)
+        if num_entries is not None:
+            blocks = itertools.islice(blocks, num_entries)
+        write_log(out or sys.stdout, blocks)
+
+    @staticmethod
+    def shard_blocks(shard, reverse, *filters):
+        item_id, since, until, status, case_id = filters
+        if item_id is not None and since is None and until is None and status is None and case_id is None:
+            blocks = shard.items.history(item_id)
+            yield from reversed(blocks) if reverse else blocks
+            return
+        heights = log_heights(shard.chain, shard.items, *filters)
+        if heights and heights[0] == 0:
+            heights = heights[1:]
+        if reverse:
+            heights = reversed(heights)
+        for height in heights:
+            yield shard.chain[height]
+
+    def root(self):
+        if 'root' not in self.readers:
+            self.readers['root'] = BlockLog(self.path, self.fsync, shared=True)
+        return self.readers['root']
+
+    # (block count, head digest) of a shard as of now: this command's own
+    # for a shard it writes to, otherwise the last head published for it
+    # (never older than what an anchor appended before this one recorded)
+    def head(self, shard):
+        if shard in self.writers:
+            store = self.writers[shard].store
+            return len(store), store.head.hex()
+        published = read_head(shard_path(self.path, shard))
+        if published is None:
+            store = self.reader(shard).store
+            return len(store), store.head.hex()
+        count, end, digest = published
+        return count, digest.hex()
+
+    # {shard: (block count, head digest)} as of the last anchor
+    def anchored(self):
+        root = self.root()
+        if len(root) < 2:
+            return {}
+        block = ChainOfCustody.decode(root.read(len(root) - 1))
+        return block.data.heads if isinstance(block.data, Anchor) else {}
+
+    # Appends an anchor with the current head of every shard to the root
+    # chain; with `due` only when a shard written to by this command has
+    # grown by ANCHOR_INTERVAL blocks since the last anchor. Returns the
+    # anchor, or None if none was needed.
+    def anchor(self, due=False):
+        if due:
+            anchored = self.anchored()
+            if all(len(self.writers[shard].store) - anchored.get(shard, (1, None))[0] < ANCHOR_INTERVAL
+                   for shard in self.writers):
+                return None
+        reader = self.readers.pop('root', None)
+        if reader is not None:
+            reader.close()
+        root = BlockLog(self.path, self.fsync)
+        try:
+            heads = {shard: self.head(shard) for shard in range(self.count)}
+            previous = ChainOfCustody.decode(root.read(len(root) - 1))
+            block = ChainOfCustody(Anchor(heads), previous.hash)
+            root.append(block.raw)
+        finally:
+            root.close()
+        return block.data
+
+    def verify(self, full=False, jobs=1):
+        return verify_shards(self, full, jobs)
+
+    def close(self):
+        try:
+            if self.writers:
+                self.anchor(due=True)
+        finally:
+            for chain in itertools.chain(self.writers.values(), self.readers.values()):
+                chain.close()
+            self.writers.clear()
+            self.readers.clear()
+
+
+# item lookups across every shard, for the duplicate checks
+class ShardedItems:
+    def __init__(self, chain):
+        self.chain = chain
+
+    def get(self, item_id):
+        shard = self.chain.locate(item_id)
+        return None if shard is None else self.chain.reader(shard).items.get(item_id)
+
+    def __contains__(self, item_id):
+        return self.chain.locate(item_id) is not None
+
+
+# Verifies the root chain and every shard as block logs of their own, then
+# what holds them together: every case is in the shard its id hashes to,
+# no item is in two shards, and every anchor matches the shards it
+# recorded (and no shard has shrunk since an earlier anchor).
+def verify_shards(chain, full=False, jobs=1):
+    from verify import VerifyResult, verify_chain
+    root = chain.root()
+    stores = [root] + [chain.reader(shard).store for shard in range(chain.count)]
+    count = sum(len(store) for store in stores)
+    checked = 0
+    for store in stores:
+        result = verify_chain(store, full, jobs)
+        checked += result.checked
+        if not result.clean():
+            return VerifyResult(count, checked, result.bad_block, result.reason)
+
+    owners = {}
+    for shard in range(chain.count):
+        items = chain.reader(shard).items
+        items.catch_up()
+        for case_id, item_ids in items.cases.items():
+            if chain.shard_of(case_id) != shard:
+                first = min(items.get(item_id).blocks[0] for item_id in item_ids)
+                return VerifyResult(count, checked, block_hash(items.store, first),
+                                    f"Case {case_id} is in shard {shard}, not shard {chain.shard_of(case_id)}.")
+            for item_id in item_ids:
+                if item_id in owners:
+                    first = items.get(item_id).blocks[0]
+                    return VerifyResult(count, checked, block_hash(items.store, first),
+                                        f"Duplicate item {item_id} in shards {owners[item_id]} and {shard}.")
+                owners[item_id] = shard
+
+    latest = {}
+    for height, anchor in anchors(root):
+        digest = block_hash(root, height)
+        if anchor is None:
+            return VerifyResult(count, checked, digest, f"Root block {height} is not an anchor.")
+        for shard, (length, head) in anchor.heads.items():
+            if not 0 <= shard < chain.count:
+                return VerifyResult(count, checked, digest, f"Anchor names shard {shard}, which does not exist.")
+            store = stores[shard + 1]
+            if length < latest.get(shard, 0) or length > len(store) or \
+                    hashlib.sha256(store.read(length - 1)).hexdigest() != head:
+                return VerifyResult(count, checked, digest,
+                                    f"Shard {shard} does not match its anchor at root block {height}.")
+            latest[shard] = length
+    return VerifyResult(count, checked)
+
+
+def block_hash(store, height):
+    return hashlib.sha256(store.read(height)).hexdigest()
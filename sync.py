@@ -0,0 +1,88 @@
+import hashlib
+import os
+from blockstore import BlockLog
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      sync.py
+    Description:    Incremental mirroring of the block log to a
+                    backup copy. The two logs are compared by
+                    block hash to find how much of the chain the
+                    copy already has, and only the blocks after
+                    that are copied, checked and appended, so a
+                    sync costs as much as what was added since
+                    the last one.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# blocks copied per append (one write and one fsync on the copy)
+SYNC_BATCH = 4096
+
+
+def block_digest(store, i):
+    return hashlib.sha256(store.read(i)).digest()
+
+
+# Number of leading blocks `source` and `dest` (BlockLogs) have in common.
+# Every block holds the hash of the one before it, so two logs that agree
+# on block i agree on every block up to it and the point where they part
+# is found by bisection, reading O(log n) blocks. A copy that is simply
+# behind, the usual case, is settled by comparing its head alone.
+def common_prefix(source, dest):
+    shared = min(len(source), len(dest))
+    if not shared or block_digest(source, shared - 1) == block_digest(dest, shared - 1):
+        return shared
+    low, high = 0, shared - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if block_digest(source, middle - 1) == block_digest(dest, middle - 1):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+# Checks blocks about to be appended at `start` to a log whose last block
+# hashes to `previous`: each must be well formed and point at the block
+# before it. Returns the hash of the last one.
+def check_arrivals(start, payloads, previous):
+    from verify import parse_block
+    for n, payload in enumerate(payloads):
+        fields = parse_block(payload)
+        if fields is None:
+            raise ValueError(f"Block {start + n} is damaged; nothing after block {start - 1} was copied.")
+        if fields[0] != previous:
+            raise ValueError(f"Block {start + n} does not follow the block before it; "
+                             f"nothing after block {start - 1} was copied.")
+        previous = hashlib.sha256(payload).digest()
+    return previous
+
+
+# Brings the log at `path` (created if missing) up to date with `source`, a
+# BlockLog open for reading, and returns (blocks the copy already had,
+# blocks copied). The copy is locked as a writer meanwhile. A copy holding
+# blocks the source does not, whether it has diverged or is ahead, is left
+# alone. Copied blocks are checked for layout and links as they arrive
+# and the copy's new head is read back and compared with the source's;
+# state transitions are left to 'verify' on the copy, which picks up from
+# its own checkpoint.
+def sync(source, path, fsync=None, batch=SYNC_BATCH):
+    if os.path.exists(path) and os.path.samefile(source.path, path):
+        raise ValueError(f"{path} is the chain itself.")
+    dest = BlockLog(path, fsync)
+    try:
+        count = len(source)
+        common = common_prefix(source, dest)
+        if common < len(dest):
+            if common == count:
+                raise ValueError(f"{path} is ahead of this chain: it has {len(dest)} blocks, this chain {count}.")
+            raise ValueError(f"{path} has diverged from this chain at block {common}; nothing was copied.")
+        previous = dest.head
+        for start in range(common, count, batch):
+            payloads = [bytes(source.read(i)) for i in range(start, min(start + batch, count))]
+            previous = check_arrivals(start, payloads, previous)
+            dest.append_many(payloads)
+        dest.sync()
+        if count and block_digest(dest, count - 1) != block_digest(source, count - 1):
+            raise ValueError(f"Block {count - 1} of {path} does not match this chain after copying.")
+        return common, count - common
+    finally:
+        dest.close()
@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      conftest.py
+    Description:    Shared setup for the checks of the block
+                    log: the scripts are imported from the
+                    directory above, and every check runs in a
+                    scratch directory of its own.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blockstore import BlockLog, ChainOfCustody, CustodyEvent  # noqa: E402
+
+CASE_ID = '65cc391d-6568-4dcc-a3f1-86a2f04140f1'
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / 'blocks.bin')
+
+
+# the payloads of a chain holding the genesis block, then a block for
+# each of `events`
+def event_payloads(events):
+    block = ChainOfCustody('Genesis Block', '0')
+    payloads = [block.raw]
+    for event in events:
+        block = ChainOfCustody(event, block.hash)
+        payloads.append(block.raw)
+    return payloads
+
+
+# the payloads of a chain of `count` blocks: the genesis block, then one
+# check-in of a new item per block
+def chain_payloads(count):
+    return event_payloads([CustodyEvent(CASE_ID, item_id, 'CHECKEDIN') for item_id in range(1, count)])
+
+
+# writes a chain of the genesis block and `events` to a new log at `path`
+def write_events(path, events):
+    payloads = event_payloads(events)
+    store = BlockLog(path)
+    store.append_many(payloads)
+    store.close()
+    return payloads
+
+
+# writes a chain of `count` blocks to a new log at `path`; returns its payloads
+def write_chain(path, count):
+    payloads = chain_payloads(count)
+    store = BlockLog(path)
+    store.append_many(payloads)
+    store.close()
+    return payloads
+
+
+def read_all(store):
+    return [bytes(store.read(i)) for i in range(len(store))]
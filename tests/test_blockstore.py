@@ -0,0 +1,135 @@
+import os
+from blockstore import HEAD, HEADER, INDEX_ENTRY, MAGIC, RECORD_LEN, VERSION, BlockLog
+from conftest import chain_payloads, read_all, write_chain
+from verify import verify_chain
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_blockstore.py
+    Description:    Checks of the block log on disk: recovery
+                    from a record half written by a crash,
+                    readers opening the log from its published
+                    head or falling back to the lock, and an
+                    offset index that no longer matches the log.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+
+# a record cut short, as a crash in the middle of an append leaves it
+def tear(path):
+    with open(path, 'ab') as f:
+        f.write(RECORD_LEN.pack(100) + b'half a block')
+
+
+def test_reopened_log_reads_back_what_was_appended(path):
+    payloads = write_chain(path, 5)
+    store = BlockLog(path)
+    assert read_all(store) == payloads
+    assert verify_chain(store).clean()
+    store.close()
+
+
+def test_writer_truncates_half_written_record(path):
+    payloads = write_chain(path, 5)
+    size = os.path.getsize(path)
+    tear(path)
+    store = BlockLog(path)
+    assert read_all(store) == payloads
+    assert os.path.getsize(path) == size
+    extra = chain_payloads(6)[5:]
+    store.append_many(extra)
+    store.close()
+    store = BlockLog(path, shared=True)
+    assert read_all(store) == payloads + extra
+    store.close()
+
+
+def test_reader_skips_half_written_record(path):
+    payloads = write_chain(path, 5)
+    tear(path)
+    store = BlockLog(path, shared=True)
+    assert read_all(store) == payloads
+    store.close()
+    # a reader leaves the file to the next writer
+    assert os.path.getsize(path) > store.end
+
+
+def test_reader_opens_from_published_head_without_lock(path):
+    payloads = write_chain(path, 5)
+    store = BlockLog(path, shared=True)
+    assert store.lock_file is None
+    assert read_all(store) == payloads
+    store.close()
+
+
+def test_reader_sees_log_as_of_published_head(path):
+    payloads = write_chain(path, 5)
+    with open(path + '.head', 'rb') as f:
+        head = f.read()
+    store = BlockLog(path)
+    store.append_many(chain_payloads(7)[5:])
+    store.close()
+    # a writer that has appended but not yet published its head
+    with open(path + '.head', 'wb') as f:
+        f.write(head)
+    store = BlockLog(path, shared=True)
+    assert store.lock_file is None
+    assert read_all(store) == payloads
+    store.close()
+
+
+def test_reader_falls_back_from_head_of_another_log(path):
+    write_chain(path, 5)
+    with open(path + '.head', 'rb') as f:
+        head = f.read()
+    for suffix in ('', '.idx', '.head'):
+        os.remove(path + suffix)
+    # same number and size of blocks, different contents
+    payloads = write_chain(path, 5)
+    with open(path + '.head', 'wb') as f:
+        f.write(head)
+    store = BlockLog(path, shared=True)
+    assert store.lock_file is not None
+    assert read_all(store) == payloads
+    store.close()
+
+
+def test_reader_falls_back_from_head_past_end_of_log(path):
+    payloads = write_chain(path, 5)
+    with open(path + '.head', 'rb') as f:
+        count, end, head = HEAD.unpack(f.read())
+    with open(path + '.head', 'wb') as f:
+        f.write(HEAD.pack(count + 1, end + 100, head))
+    store = BlockLog(path, shared=True)
+    assert store.lock_file is not None
+    assert read_all(store) == payloads
+    store.close()
+
+
+def test_reader_sets_up_log_with_no_records(path):
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION))
+    store = BlockLog(path, shared=True)
+    assert len(store) == 0
+    payloads = chain_payloads(1)
+    store.append_many(payloads)
+    store.close()
+    store = BlockLog(path, shared=True)
+    assert read_all(store) == payloads
+    store.close()
+
+
+def test_index_past_end_of_log_is_written_again(path):
+    payloads = write_chain(path, 5)
+    store = BlockLog(path, shared=True)
+    end = store.offsets[-1]
+    store.close()
+    # the last record is gone but the index still has its offset
+    os.truncate(path, end)
+    extra = chain_payloads(6)[5:]
+    store = BlockLog(path)
+    assert len(store) == 4
+    store.append_many(extra)
+    store.close()
+    assert os.path.getsize(path + '.idx') == 5 * INDEX_ENTRY.size
+    store = BlockLog(path, shared=True)
+    assert read_all(store) == payloads[:4] + extra
+    store.close()
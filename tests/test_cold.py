@@ -0,0 +1,144 @@
+import os
+import threading
+from blockstore import FSYNC_CLOSE, BlockLog
+from cold import compact
+from conftest import chain_payloads, read_all, write_chain
+from server import GroupCommit
+from verify import verify_chain
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_cold.py
+    Description:    Checks of cold storage: blocks moved out of
+                    the log read back the same, and a compaction
+                    cut short between writing the cold index and
+                    dropping the blocks from the log is sorted
+                    out by the next reader and writer. Writes
+                    after a compaction are still made durable,
+                    and readers opened before one are not
+                    disturbed by it.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+SEGMENT_SIZE = 4
+
+
+# compacts the log at `path` but stops before the blocks moved are
+# dropped from it, as a crash at that point would
+def compact_cut_short(path, monkeypatch):
+    store = BlockLog(path)
+    with monkeypatch.context() as patch:
+        patch.setattr(BlockLog, 'drop_prefix', lambda self, k, chunk=None: None)
+        moved = compact(store, 3, segment_size=SEGMENT_SIZE)[0]
+    store.close()
+    return moved
+
+
+def test_compacted_blocks_read_back_the_same(path):
+    payloads = write_chain(path, 20)
+    store = BlockLog(path)
+    moved, before, after = compact(store, 3, segment_size=SEGMENT_SIZE)
+    assert (moved, store.base) == (16, 16)
+    assert read_all(store) == payloads
+    assert verify_chain(store, full=True).clean()
+    store.close()
+    store = BlockLog(path, shared=True)
+    assert read_all(store) == payloads
+    assert list(map(bytes, store.records())) == payloads
+    store.close()
+
+
+def test_compaction_picks_up_after_earlier_one(path):
+    payloads = write_chain(path, 10)
+    store = BlockLog(path)
+    compact(store, 1, segment_size=SEGMENT_SIZE)
+    extra = chain_payloads(20)[10:]
+    store.append_many(extra)
+    assert compact(store, 3, segment_size=SEGMENT_SIZE)[0] == 8
+    assert store.base == 16
+    assert read_all(store) == payloads + extra
+    store.close()
+
+
+def test_reader_skips_blocks_left_by_interrupted_compaction(path, monkeypatch):
+    payloads = write_chain(path, 20)
+    size = os.path.getsize(path)
+    assert compact_cut_short(path, monkeypatch) == 16
+    # the published head no longer describes the log with its cold blocks
+    store = BlockLog(path, shared=True)
+    assert store.lock_file is not None
+    assert len(store) == 20
+    assert read_all(store) == payloads
+    assert verify_chain(store, full=True).clean()
+    store.close()
+    # and leaves the file as it is
+    assert os.path.getsize(path) == size
+
+
+def test_writer_drops_blocks_left_by_interrupted_compaction(path, monkeypatch):
+    payloads = write_chain(path, 20)
+    size = os.path.getsize(path)
+    compact_cut_short(path, monkeypatch)
+    store = BlockLog(path)
+    assert store.compacted_records() == 0
+    assert len(store) == 20
+    assert read_all(store) == payloads
+    store.close()
+    assert os.path.getsize(path) < size
+    store = BlockLog(path, shared=True)
+    assert store.lock_file is None
+    assert read_all(store) == payloads
+    assert verify_chain(store, full=True).clean()
+    store.close()
+
+
+def test_reader_opened_before_compaction_reads_on(path):
+    payloads = write_chain(path, 20)
+    reader = BlockLog(path, shared=True)
+    assert reader.lock_file is None and reader.offsets.mapped == 20
+    store = BlockLog(path)
+    compact(store, 3, segment_size=SEGMENT_SIZE)
+    store.close()
+    # the log and its index were both replaced, not written over
+    assert read_all(reader) == payloads
+    assert list(map(bytes, reader.records())) == payloads
+    reader.close()
+
+
+def test_group_commit_syncs_appends_after_compaction(path, monkeypatch):
+    payloads = write_chain(path, 20)
+    store = BlockLog(path, FSYNC_CLOSE)
+    commit = GroupCommit(store, threading.Lock())
+    extra = chain_payloads(22)[20:]
+    store.append_many(extra[:1])
+    commit.wait(store.appended)
+    compact(store, 3, segment_size=SEGMENT_SIZE)
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: synced.append(os.fstat(fd).st_ino) or fsync(fd))
+    store.append_many(extra[1:])
+    commit.wait(store.appended)
+    # the file the log is in now, not the one compaction replaced
+    assert synced == [os.stat(path).st_ino]
+    store.close()
+    store = BlockLog(path, shared=True)
+    assert read_all(store) == payloads + extra
+    store.close()
+
+
+def test_parallel_verify_past_cold_blocks_matches_serial(path):
+    write_chain(path, 60)
+    store = BlockLog(path)
+    compact(store, 20, segment_size=SEGMENT_SIZE)
+    offset = store.offsets[-10] + 4 + 40
+    store.close()
+    # damage the case id of a block the compaction left in the log
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'\xff')
+    store = BlockLog(path, shared=True)
+    assert store.base == 40
+    serial = verify_chain(store, full=True)
+    parallel = verify_chain(store, full=True, jobs=2)
+    assert not serial.clean()
+    assert (parallel.bad_block, parallel.reason, parallel.checked) == \
+        (serial.bad_block, serial.reason, serial.checked)
+    store.close()
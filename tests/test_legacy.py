@@ -0,0 +1,118 @@
+import datetime
+import os
+import pickle
+import uuid
+from blockstore import BlockLog, ChainOfCustody as Block
+from conftest import CASE_ID
+from legacy import LEGACY_CASE_NAMESPACE, LEGACY_ITEM_NAMESPACE
+from verify import verify_chain
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_legacy.py
+    Description:    Checks of the conversion of chains written
+                    by the original scripts, which pickled the
+                    whole chain with the shared Case in every
+                    block, into the block log, and the notes it
+                    leaves on what it had to make up.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+
+# stand-ins for the classes the original scripts pickled; only their
+# names and attributes matter to the conversion
+class ChainOfCustody:
+    def __init__(self, data, timestamp):
+        self.data = data
+        self.previous_hash = '0'
+        self.timestamp = timestamp
+        self.hash = '0'
+
+
+class Case:
+    def __init__(self, case_id, items):
+        self.case_id = case_id
+        self.items = [{'item_id': item_id, 'status': status, 'time': ''} for item_id, status in items]
+
+
+# writes the chain the original scripts would have, one Case snapshot
+# per entry of `snapshots` after the genesis block
+def write_legacy(path, case_id, snapshots):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    chain = [ChainOfCustody('Genesis Block', start)]
+    for n, items in enumerate(snapshots, 1):
+        chain.append(ChainOfCustody(Case(case_id, items), start + datetime.timedelta(minutes=n)))
+    with open(path, 'wb') as f:
+        pickle.dump(chain, f)
+
+
+# (case id, item id, action) of every block after the genesis block
+def events(store):
+    blocks = [Block.decode(store.read(i)) for i in range(1, len(store))]
+    return [(block.data.case_id, block.data.item_id, block.data.action) for block in blocks]
+
+
+def test_old_chain_is_converted_and_kept(path):
+    write_legacy(path, CASE_ID, [[(1, 'CHECKEDIN')],
+                                 [(1, 'CHECKEDOUT'), (2, 'CHECKEDIN')],
+                                 [(1, 'CHECKEDIN'), (2, 'CHECKEDIN')]])
+    with open(path, 'rb') as f:
+        original = f.read()
+    store = BlockLog(path)
+    assert events(store) == [(CASE_ID, 1, 'CHECKEDIN'), (CASE_ID, 1, 'CHECKEDOUT'),
+                             (CASE_ID, 2, 'CHECKEDIN'), (CASE_ID, 1, 'CHECKEDIN')]
+    assert verify_chain(store).clean()
+    store.close()
+    with open(path + '.pickle.bak', 'rb') as f:
+        assert f.read() == original
+
+
+def test_item_first_seen_past_check_in_is_checked_in_first(path):
+    write_legacy(path, CASE_ID, [[(1, 'CHECKEDOUT')]])
+    store = BlockLog(path)
+    assert events(store) == [(CASE_ID, 1, 'CHECKEDIN'), (CASE_ID, 1, 'CHECKEDOUT')]
+    assert verify_chain(store).clean()
+    store.close()
+    # the check-in was made up, so the notes say so
+    with open(path + '.pickle.bak.notes') as f:
+        notes = f.read()
+    assert f'Block 1: case {CASE_ID}, item 1, CHECKEDIN, time 2024-01-01T00:01:00+00:00' in notes
+
+
+def test_case_id_that_is_not_a_uuid_is_mapped(path):
+    write_legacy(path, 'case42', [[(1, 'CHECKEDIN')]])
+    store = BlockLog(path)
+    mapped = str(uuid.uuid5(LEGACY_CASE_NAMESPACE, 'case42'))
+    assert events(store) == [(mapped, 1, 'CHECKEDIN')]
+    store.close()
+    with open(path + '.pickle.bak.notes') as f:
+        assert f'case42 -> {mapped}' in f.read()
+
+
+def test_item_id_that_is_not_a_number_is_mapped(path):
+    write_legacy(path, CASE_ID, [[('abc', 'CHECKEDIN'), (7, 'CHECKEDIN')],
+                                 [('abc', 'CHECKEDOUT'), (7, 'CHECKEDIN')]])
+    store = BlockLog(path)
+    mapped = uuid.uuid5(LEGACY_ITEM_NAMESPACE, 'abc').int % 2 ** 32
+    assert events(store) == [(CASE_ID, mapped, 'CHECKEDIN'), (CASE_ID, 7, 'CHECKEDIN'),
+                             (CASE_ID, mapped, 'CHECKEDOUT')]
+    assert verify_chain(store).clean()
+    store.close()
+    with open(path + '.pickle.bak.notes') as f:
+        assert f'abc -> {mapped}' in f.read()
+
+
+def test_mapped_item_id_keeps_clear_of_ids_on_the_chain(path):
+    # the number 'abc' would map to is taken by an item added later on
+    taken = uuid.uuid5(LEGACY_ITEM_NAMESPACE, 'abc').int % 2 ** 32
+    write_legacy(path, CASE_ID, [[('abc', 'CHECKEDIN')], [('abc', 'CHECKEDIN'), (taken, 'CHECKEDIN')]])
+    store = BlockLog(path)
+    mapped = uuid.uuid5(LEGACY_ITEM_NAMESPACE, 'abc#1').int % 2 ** 32
+    assert events(store) == [(CASE_ID, mapped, 'CHECKEDIN'), (CASE_ID, taken, 'CHECKEDIN')]
+    assert verify_chain(store).clean()
+    store.close()
+
+
+def test_conversion_that_needed_nothing_made_up_has_no_notes(path):
+    write_legacy(path, CASE_ID, [[(1, 'CHECKEDIN')]])
+    BlockLog(path).close()
+    assert os.path.exists(path + '.pickle.bak')
+    assert not os.path.exists(path + '.pickle.bak.notes')
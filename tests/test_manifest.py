@@ -0,0 +1,58 @@
+import os
+import threading
+import gradescope
+from conftest import CASE_ID
+from gradescope import Blockchain, run_command
+from server import CommandServer, request
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_manifest.py
+    Description:    Checks of importing intake manifests: files
+                    saved by spreadsheets, --strict, and a
+                    manifest piped in to a client of the server.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+# as Excel's "CSV UTF-8" saves it: a byte order mark, then CRLF lines
+MANIFEST = f'\ufeffcase_id,item_id,owner\r\n{CASE_ID},1,Alice\r\n{CASE_ID},2,\r\n'.encode('utf-8')
+
+
+def logged_items(capsys):
+    capsys.readouterr()
+    gradescope.main(['log'])
+    return [line for line in capsys.readouterr().out.splitlines() if line.startswith('Item: ')]
+
+
+def test_manifest_saved_by_a_spreadsheet_is_imported(path, capsys):
+    with open('manifest.csv', 'wb') as f:
+        f.write(MANIFEST)
+    assert gradescope.main(['import', 'manifest.csv', '--strict']) == 0
+    assert 'Imported 2 items' in capsys.readouterr().out
+    assert logged_items(capsys) == ['Item: Genesis Block', 'Item: 1', 'Item: 2']
+
+
+def test_strict_import_with_a_bad_row_imports_nothing(path, capsys):
+    with open('manifest.csv', 'wb') as f:
+        f.write(MANIFEST + f'{CASE_ID},x\r\n'.encode('utf-8'))
+    assert gradescope.main(['import', 'manifest.csv', '--strict']) == 1
+    assert 'Nothing was imported' in capsys.readouterr().out
+    assert logged_items(capsys) == ['Item: Genesis Block']
+
+
+def test_manifest_piped_to_a_client_reaches_the_server(path):
+    bl = Blockchain(fsync='close')
+    server = CommandServer(gradescope.SOCKET_FILE, bl, run_command)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        status, output = request(gradescope.SOCKET_FILE, ['import', '-'], stdin=MANIFEST.decode('utf-8-sig'))
+        assert status == 0 and 'Imported 2 items' in output
+        # with nothing sent, the server reads no stdin of its own
+        status, output = request(gradescope.SOCKET_FILE, ['import', '-'])
+        assert status == 0 and 'Imported 0 items' in output
+        assert len(bl.store) == 3
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        os.remove(gradescope.SOCKET_FILE)
+        bl.close()
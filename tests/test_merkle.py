@@ -0,0 +1,102 @@
+import copy
+import io
+import os
+import pytest
+from blockstore import BlockLog
+from conftest import write_chain
+from merkle import SegmentRoots, audit_path, check_proof, leaf_hash, path_sides, tree_levels
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_merkle.py
+    Description:    Checks of Merkle inclusion proofs: a proof of
+                    a block checks out against the chain root,
+                    and one with its block, its position in the
+                    chain or the chain's size changed does not.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+SEGMENT_SIZE = 4
+
+
+def prove(path, heights, count=11):
+    write_chain(path, count)
+    store = BlockLog(path, shared=True)
+    roots = SegmentRoots(store, SEGMENT_SIZE)
+    proof = roots.prove(heights)
+    root = roots.chain_root().hex()
+    store.close()
+    return proof, root
+
+
+def check(proof, root):
+    out = io.StringIO()
+    return check_proof(proof, out, root), out.getvalue()
+
+
+def test_path_sides_match_audit_paths():
+    for count in range(1, 20):
+        levels = tree_levels([leaf_hash(bytes([n])) for n in range(count)])
+        for index in range(count):
+            assert path_sides(count, index) == [side for side, _ in audit_path(levels, index)]
+
+
+def test_proof_checks_out_against_chain_root(path):
+    proof, root = prove(path, [1, 5, 10])
+    assert proof['root'] == root
+    status, output = check(proof, root)
+    assert status == 0
+    assert output.count('Block: ') == 3 and 'State of proof: VALID' in output
+
+
+def test_proof_for_another_root_is_invalid(path):
+    proof, root = prove(path, [5])
+    status, output = check(proof, '0' * 64)
+    assert status == 1 and 'not 000' in output
+
+
+def test_changed_block_is_invalid(path):
+    proof, root = prove(path, [5])
+    block = bytearray.fromhex(proof['events'][0]['block'])
+    block[-1] ^= 1
+    proof['events'][0]['block'] = block.hex()
+    assert check(proof, root)[0] == 1
+
+
+def test_moved_block_is_invalid(path):
+    proof, root = prove(path, [1, 5, 10])
+    for change in ({'height': 1001}, {'height': 1005}, {'height': 1010}, {'segment': 42}):
+        for n in range(3):
+            forged = copy.deepcopy(proof)
+            forged['events'][n].update(change)
+            status, output = check(forged, root)
+            assert status == 1 and 'State of proof: INVALID' in output
+    forged = copy.deepcopy(proof)
+    forged['blocks'] = 7
+    assert check(forged, root)[0] == 1
+
+
+def test_other_block_count_cannot_move_last_block(path):
+    # with 3 blocks in a segment, block 2 has the same audit path as block
+    # 1 of a segment of 2; the block count in the root tells them apart
+    proof, root = prove(path, [10], count=11)
+    assert [side for side, _ in proof['events'][0]['path']] == path_sides(2, 1)
+    forged = copy.deepcopy(proof)
+    forged['blocks'] = 10
+    forged['events'][0]['height'] = 9
+    status, output = check(forged, root)
+    assert status == 1 and 'does not hash to the chain root' in output
+
+
+def test_proof_shows_block_rewritten_since_roots_were_kept(path):
+    write_chain(path, 11)
+    store = BlockLog(path, shared=True)
+    SegmentRoots(store, SEGMENT_SIZE).chain_root()
+    offset = store.offsets[2] + 4 + 40
+    store.close()
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'\xff')
+    os.remove(path + '.head')
+    store = BlockLog(path, shared=True)
+    with pytest.raises(ValueError, match='Segment 0 no longer matches'):
+        SegmentRoots(store, SEGMENT_SIZE).prove([2])
+    store.close()
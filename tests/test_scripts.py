@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import gradescope
+from blockstore import BLOCK, BlockLog
+from conftest import CASE_ID
+from verify import verify_chain
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_scripts.py
+    Description:    Checks of adding items with the older
+                    scripts, mhl_bl.py and bchoc.py, which write
+                    to the same block log as gradescope.py.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def script(name, *argv):
+    return subprocess.run([sys.executable, os.path.join(SCRIPTS, name), *argv],
+                          capture_output=True, text=True)
+
+
+def item_ids(path):
+    store = BlockLog(path, shared=True)
+    try:
+        assert verify_chain(store, full=True).clean()
+        return [BLOCK.unpack_from(store.read(i))[3] for i in range(1, len(store))]
+    finally:
+        store.close()
+
+
+def test_mhl_add_takes_whole_item_ids(path):
+    gradescope.main(['add', '-c', CASE_ID, '-i', '5'])
+    result = script('mhl_bl.py', 'add', '-c', CASE_ID, '-i', '12', '34')
+    assert result.returncode == 0
+    assert item_ids(path) == [5, 12, 34]
+
+
+def test_mhl_add_rejects_items_on_the_chain_or_given_twice(path):
+    gradescope.main(['add', '-c', CASE_ID, '-i', '5'])
+    assert script('mhl_bl.py', 'add', '-c', CASE_ID, '-i', '6', '5').returncode == 1
+    assert script('mhl_bl.py', 'add', '-c', CASE_ID, '-i', '7', '7').returncode == 1
+    assert script('mhl_bl.py', 'add', '-c', CASE_ID, '-i', 'x').returncode == 2
+    assert item_ids(path) == [5]
+
+
+def test_bchoc_add_skips_items_on_the_chain(path):
+    gradescope.main(['add', '-c', CASE_ID, '-i', '5'])
+    result = script('bchoc.py', 'add', '-c', CASE_ID, '-i', '8', '-i', '8', '-i', '5')
+    assert result.stdout.count('Duplicate item ID') == 2
+    assert item_ids(path) == [5, 8]
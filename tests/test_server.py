@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+import pytest
+import gradescope
+from blockstore import FSYNC_CLOSE, BlockLog
+from conftest import CASE_ID, chain_payloads
+from gradescope import Blockchain, run_command
+from server import CommandServer, GroupCommit, request, serve
+from verify import verify_chain
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_server.py
+    Description:    Checks of the resident server: commands sent
+                    by clients, at once or one after another, run
+                    as they would on their own, and group commit
+                    makes every write durable before its reply
+                    while writers share the fsyncs.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+
+# a server on the chain in the current directory, run on a thread;
+# yields its Blockchain
+@pytest.fixture
+def server(path):
+    bl = Blockchain(fsync=FSYNC_CLOSE)
+    server = CommandServer(gradescope.SOCKET_FILE, bl, run_command)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        yield bl
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        os.remove(gradescope.SOCKET_FILE)
+        bl.close()
+
+
+# counts the fsyncs made from here on
+@pytest.fixture
+def fsyncs(monkeypatch):
+    calls = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, 'fsync', lambda fd: calls.append(fd) or fsync(fd))
+    return calls
+
+
+def send(*argv):
+    return request(gradescope.SOCKET_FILE, list(argv))
+
+
+def verified(path):
+    store = BlockLog(path, shared=True)
+    try:
+        return verify_chain(store, full=True)
+    finally:
+        store.close()
+
+
+def test_commands_run_on_the_server_as_they_do_locally(server, path, capsys):
+    status, output = send('add', '-c', CASE_ID, '-i', '1', '-i', '2')
+    assert status == 0 and output.count('Status: CHECKEDIN') == 2
+    status, output = send('add', '-c', CASE_ID, '-i', '2')
+    assert status == 1 and 'Duplicate item ID' in output
+    assert send('checkout', '-i', '1')[0] == 0
+    # a client goes through the server whenever one is listening
+    capsys.readouterr()
+    assert gradescope.main(['log', '-r', '-n', '1']) == 0
+    assert 'Item: 1\nAction: CHECKEDOUT' in capsys.readouterr().out
+    assert len(server.store) == 4
+    assert verified(path).clean()
+
+
+def test_concurrent_clients_each_get_their_own_reply(server, path):
+    results = {}
+
+    def add(item_id):
+        results[item_id] = send('add', '-c', CASE_ID, '-i', str(item_id))
+
+    threads = [threading.Thread(target=add, args=(item_id,)) for item_id in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for item_id, (status, output) in results.items():
+        assert status == 0 and f'Added item: {item_id}\n' in output
+    assert len(server.store) == 9
+    assert verified(path).clean()
+
+
+def test_concurrent_clients_add_an_item_once(server, path):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(send('add', '-c', CASE_ID, '-i', '7')))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(status for status, _ in results) == [0] + [1] * 5
+    assert len(server.store) == 2
+
+
+def test_writes_are_durable_before_the_reply(server, fsyncs):
+    status, _ = send('add', '-c', CASE_ID, '-i', '1')
+    assert status == 0 and len(fsyncs) == 1
+    # commands that write nothing do not fsync
+    assert send('log')[0] == 0
+    assert len(fsyncs) == 1
+
+
+def test_writers_waiting_on_an_fsync_share_the_next_one(path, fsyncs, monkeypatch):
+    payloads = chain_payloads(6)
+    store = BlockLog(path, FSYNC_CLOSE)
+    store.append_many(payloads[:1])
+    store.sync()
+    lock = threading.Lock()
+    commit = GroupCommit(store, lock)
+    del fsyncs[:]
+    started = threading.Event()
+    release = threading.Event()
+    fsync = os.fsync
+
+    # the first fsync does not finish until the other writers are waiting
+    def slow_fsync(fd):
+        if not started.is_set():
+            started.set()
+            release.wait()
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', slow_fsync)
+
+    # each writer adds the next block, whichever order they run in
+    def write():
+        with lock:
+            store.append(payloads[len(store)])
+            appended = store.appended
+        commit.wait(appended)
+
+    first = threading.Thread(target=write)
+    first.start()
+    started.wait()
+    others = [threading.Thread(target=write) for _ in payloads[2:]]
+    for thread in others:
+        thread.start()
+    while len(store) < 6:
+        time.sleep(0.001)
+    release.set()
+    for thread in [first] + others:
+        thread.join()
+    # one fsync for the first writer, one for the four that came after it
+    assert len(fsyncs) == 2
+    assert commit.synced == store.appended
+    store.close()
+    assert verified(path).clean()
+
+
+def test_second_server_on_the_same_chain_is_refused(server):
+    with pytest.raises(RuntimeError, match='already listening'):
+        serve(None, run_command, gradescope.SOCKET_FILE)
@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import uuid
+import gradescope
+from blockstore import BlockLog
+from gradescope import Blockchain
+from shards import ShardedChain, create, shard_of
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_shards.py
+    Description:    Checks of the sharded chain: writers adding
+                    the same item to cases in different shards at
+                    once, verification of the shards and their
+                    anchors, and 'init --shards' on a chain that
+                    is there already.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+SHARDS = 4
+
+
+# one case id for each of the first `count` shards
+def cases_in_shards(count):
+    cases = {}
+    n = 0
+    while any(shard not in cases for shard in range(count)):
+        case_id = str(uuid.UUID(int=n))
+        cases.setdefault(shard_of(case_id, SHARDS), case_id)
+        n += 1
+    return [cases[shard] for shard in range(count)]
+
+
+# Adds `item_id` to `case_id` in a process of its own. Every shard is
+# looked at before the barrier, so both writers have seen the item
+# missing everywhere before either of them adds it.
+def add_item(path, case_id, item_id, barrier, results):
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    try:
+        assert item_id not in chain.items
+        barrier.wait()
+        try:
+            chain.add_items(case_id, [item_id])
+        except ValueError:
+            results.put(False)
+        else:
+            results.put(True)
+    finally:
+        chain.close()
+
+
+def test_same_item_is_added_to_one_shard_only(path):
+    create(path, SHARDS, Blockchain)
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    cases = cases_in_shards(2)
+    for item_id in range(1, 6):
+        barrier = context.Barrier(2)
+        workers = [context.Process(target=add_item, args=(path, case_id, item_id, barrier, results))
+                   for case_id in cases]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert sorted(results.get() for _ in workers) == [False, True]
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    assert chain.verify(full=True).clean()
+    chain.close()
+
+
+def test_item_in_two_shards_fails_verify(path):
+    create(path, SHARDS, Blockchain)
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    first, second = cases_in_shards(2)
+    chain.add_items(first, [7])
+    # written past the cross-shard check, as a second writer racing the
+    # first one could have
+    chain.writer(1).add_items(second, [7])
+    chain.close()
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    result = chain.verify(full=True)
+    assert result.reason == "Duplicate item 7 in shards 0 and 1."
+    chain.close()
+
+
+def test_anchors_tie_shards_together(path):
+    create(path, SHARDS, Blockchain)
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    for n, case_id in enumerate(cases_in_shards(SHARDS)):
+        chain.add_items(case_id, [n + 1])
+    anchor = chain.anchor()
+    assert sum(count for count, _ in anchor.heads.values()) == 2 * SHARDS
+    chain.close()
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    assert chain.verify(full=True).clean()
+    chain.close()
+    # a shard cut short after it was anchored no longer matches the anchor
+    shard_path = f'{path}.shards/0000.bin'
+    store = BlockLog(shard_path, shared=True)
+    end = store.offsets[-1]
+    store.close()
+    os.truncate(shard_path, end)
+    chain = ShardedChain(path, SHARDS, Blockchain)
+    assert chain.verify(full=True).reason == "Shard 0 does not match its anchor at root block 1."
+    chain.close()
+
+
+def test_init_shards_on_existing_chain_is_an_error(path, capsys):
+    assert gradescope.main(['init']) == 0
+    assert gradescope.main(['init', '--shards', '2']) == 1
+    assert 'is not sharded' in capsys.readouterr().out
+
+
+def test_init_shards_on_chain_with_other_count_is_an_error(path, capsys):
+    assert gradescope.main(['init', '--shards', '2']) == 0
+    assert gradescope.main(['init', '--shards', '2']) == 0
+    assert gradescope.main(['init', '--shards', '3']) == 1
+    assert 'has 2 shards' in capsys.readouterr().out
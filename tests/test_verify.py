@@ -0,0 +1,253 @@
+import hashlib
+import os
+import struct
+import pytest
+import gradescope
+from blockstore import RECORD_LEN, BlockLog, CustodyEvent
+from conftest import CASE_ID, chain_payloads, write_chain, write_events
+from verify import verify_chain
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      test_verify.py
+    Description:    Checks of verify: what it reports for a
+                    broken link, a damaged or tampered block and
+                    each illegal state change, when it trusts
+                    or ignores its checkpoint, and that verify -j
+                    reports the same first failure as verify.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+OTHER_CASE = '0b7f2a3c-5d4e-4f60-8a91-b2c3d4e5f607'
+
+# where fields sit in a block payload (see BLOCK in blockstore.py)
+ITEM_ID_AT = 56
+STATE_AT = 60
+LENGTH_AT = 72
+
+
+def verify(path, full=False, jobs=1):
+    store = BlockLog(path, shared=True)
+    try:
+        return verify_chain(store, full=full, jobs=jobs)
+    finally:
+        store.close()
+
+
+# writes `data` over the payload of block i, `position` bytes in
+def overwrite(path, i, position, data):
+    store = BlockLog(path, shared=True)
+    offset = store.offsets[i] + RECORD_LEN.size + position
+    store.close()
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+# removes the log at `path` along with its index and head, but not the
+# checkpoint
+def remove_log(path):
+    for suffix in ('', '.idx', '.head'):
+        os.remove(path + suffix)
+
+
+def block_hash(path, i):
+    store = BlockLog(path, shared=True)
+    try:
+        return hashlib.sha256(store.read(i)).hexdigest()
+    finally:
+        store.close()
+
+
+def test_chain_as_written_is_clean(path):
+    write_chain(path, 6)
+    result = verify(path)
+    assert result.clean() and (result.count, result.checked) == (6, 6)
+    assert 'State of blockchain: CLEAN' in result.report()
+
+
+def test_broken_link_is_reported_at_its_block(path):
+    write_chain(path, 6)
+    overwrite(path, 3, 0, bytes(32))
+    result = verify(path)
+    assert result.reason == "Parent block: NOT FOUND"
+    assert (result.bad_block, result.checked) == (block_hash(path, 3), 4)
+
+
+def test_tampered_block_no_longer_links_to_the_next(path):
+    write_chain(path, 6)
+    overwrite(path, 2, ITEM_ID_AT, struct.pack('<I', 99))
+    result = verify(path)
+    assert result.reason == "Parent block: NOT FOUND"
+    assert (result.bad_block, result.checked) == (block_hash(path, 3), 4)
+
+
+def test_block_with_wrong_length_is_reported(path):
+    write_chain(path, 6)
+    overwrite(path, 2, LENGTH_AT, struct.pack('<I', 5))
+    result = verify(path)
+    assert result.reason == "Block contents do not match block checksum."
+    assert result.checked == 3
+
+
+def test_damaged_genesis_block_is_reported(path):
+    write_chain(path, 3)
+    overwrite(path, 0, STATE_AT, b'CHECKEDIN\0\0\0')
+    result = verify(path)
+    assert result.reason == "Initial block is missing or damaged."
+    assert result.checked == 1
+
+
+@pytest.mark.parametrize('actions, reason', [
+    (['CHECKEDIN', 'CHECKEDIN'], "Duplicate item or item checked in twice."),
+    (['CHECKEDOUT'], "Item was never added to the chain."),
+    (['HASHED'], "Item was never added to the chain."),
+    (['CHECKEDIN', 'DISPOSED', 'CHECKEDOUT'], "Item checked out or checked in after removal from chain."),
+    (['CHECKEDIN', 'DESTROYED', 'HASHED'], "Digests recorded for an item after its removal from chain."),
+    (['CHECKEDIN', 'CHECKEDOUT', 'DISPOSED'], "Invalid state change: CHECKEDOUT -> DISPOSED."),
+    (['CHECKEDIN', 'RELEASED'], "Item released without owner information."),
+])
+def test_illegal_state_change_is_reported(path, actions, reason):
+    # item 2 is checked in first, so the failure is not at the first event
+    events = [CustodyEvent(CASE_ID, 2, 'CHECKEDIN')]
+    events += [CustodyEvent(CASE_ID, 1, action) for action in actions]
+    write_events(path, events)
+    result = verify(path)
+    assert result.reason == reason
+    assert (result.bad_block, result.checked) == (block_hash(path, len(events)), len(events) + 1)
+
+
+def test_legal_state_changes_are_clean(path):
+    actions = ['CHECKEDIN', 'CHECKEDOUT', 'CHECKEDIN', 'HASHED', 'CHECKEDOUT', 'CHECKEDIN']
+    events = [CustodyEvent(CASE_ID, 1, action) for action in actions]
+    events.append(CustodyEvent(CASE_ID, 1, 'RELEASED', 'Alice'))
+    write_events(path, events)
+    assert verify(path).clean()
+
+
+def test_event_for_item_of_another_case_is_reported(path):
+    write_events(path, [CustodyEvent(CASE_ID, 1, 'CHECKEDIN'), CustodyEvent(OTHER_CASE, 1, 'CHECKEDOUT')])
+    result = verify(path)
+    assert result.reason == f"Item belongs to case {CASE_ID}, not case {OTHER_CASE}."
+    assert result.checked == 3
+
+
+def test_checkpoint_covers_blocks_already_verified(path):
+    write_chain(path, 6)
+    assert verify(path).checked == 6
+    assert gradescope.main(['add', '-c', CASE_ID, '-i', '99']) == 0
+    result = verify(path)
+    assert result.clean() and (result.count, result.checked) == (7, 1)
+    # a block from another chain, read on its own, still has to link up
+    store = BlockLog(path)
+    store.append_many(chain_payloads(9)[8:])
+    store.close()
+    result = verify(path)
+    assert result.reason == "Parent block: NOT FOUND" and result.checked == 1
+
+
+def test_checkpoint_is_ignored_once_the_log_is_rewritten(path):
+    write_chain(path, 6)
+    assert verify(path).clean()
+    # as long as the chain it was saved for, but with a duplicate at the end
+    remove_log(path)
+    events = [CustodyEvent(CASE_ID, item_id, 'CHECKEDIN') for item_id in (1, 2, 3, 4, 1)]
+    write_events(path, events)
+    result = verify(path)
+    assert result.reason == "Duplicate item or item checked in twice."
+    assert result.checked == 6
+
+
+def test_checkpoint_is_ignored_once_the_log_is_cut_short(path):
+    write_chain(path, 6)
+    assert verify(path).clean()
+    store = BlockLog(path, shared=True)
+    end = store.offsets[4]
+    store.close()
+    os.truncate(path, end)
+    result = verify(path)
+    assert result.clean() and (result.count, result.checked) == (4, 4)
+
+
+def test_full_rechecks_blocks_under_the_checkpoint(path, capsys):
+    write_chain(path, 6)
+    assert gradescope.main(['verify']) == 0
+    overwrite(path, 2, ITEM_ID_AT, struct.pack('<I', 99))
+    capsys.readouterr()
+    # the checkpoint still matches the last block, so nothing is read
+    assert gradescope.main(['verify']) == 0
+    assert 'State of blockchain: CLEAN' in capsys.readouterr().out
+    assert gradescope.main(['verify', '--full']) == 1
+    output = capsys.readouterr().out
+    assert 'State of blockchain: ERROR' in output
+    assert f'Bad block: {block_hash(path, 3)}' in output and 'Parent block: NOT FOUND' in output
+
+
+# 30 blocks: the genesis block, then a check-in of items 1..29, with
+# `changes` ({block: event}) put in place of some of them
+def seam_chain(path, changes=None):
+    events = [CustodyEvent(CASE_ID, item_id, 'CHECKEDIN') for item_id in range(1, 30)]
+    for i, event in (changes or {}).items():
+        events[i - 1] = event
+    return write_events(path, events)
+
+
+def assert_same_failure(path, full=True):
+    serial = verify(path, full=full)
+    assert not serial.clean()
+    for jobs in (2, 3, 4):
+        parallel = verify(path, full=full, jobs=jobs)
+        assert (parallel.bad_block, parallel.reason, parallel.checked, parallel.count) == \
+            (serial.bad_block, serial.reason, serial.checked, serial.count)
+    return serial
+
+
+# with 3 jobs the 30 blocks are split at blocks 10 and 20
+@pytest.mark.parametrize('bad', [1, 9, 10, 11, 20, 29])
+def test_parallel_verify_finds_broken_link_where_serial_does(path, bad):
+    seam_chain(path)
+    overwrite(path, bad, 0, bytes(32))
+    assert assert_same_failure(path).checked == bad + 1
+
+
+@pytest.mark.parametrize('bad', [9, 19, 28])
+def test_parallel_verify_finds_tampered_block_where_serial_does(path, bad):
+    seam_chain(path)
+    overwrite(path, bad, ITEM_ID_AT, struct.pack('<I', 99))
+    assert assert_same_failure(path).checked == bad + 2
+
+
+@pytest.mark.parametrize('changes', [
+    # the item was checked in by a block in an earlier segment
+    {25: CustodyEvent(CASE_ID, 3, 'CHECKEDIN')},
+    {10: CustodyEvent(CASE_ID, 9, 'CHECKEDIN')},
+    {20: CustodyEvent(OTHER_CASE, 19, 'CHECKEDOUT')},
+    {21: CustodyEvent(CASE_ID, 2, 'DISPOSED'), 22: CustodyEvent(CASE_ID, 2, 'CHECKEDOUT')},
+    {15: CustodyEvent(CASE_ID, 15, 'RELEASED')},
+])
+def test_parallel_verify_finds_illegal_state_change_where_serial_does(path, changes):
+    seam_chain(path, changes)
+    assert assert_same_failure(path).checked == max(changes) + 1
+
+
+def test_parallel_verify_reports_the_first_of_two_failures(path):
+    # an illegal state change before a damaged block in a later segment
+    seam_chain(path, {15: CustodyEvent(CASE_ID, 1, 'CHECKEDIN')})
+    overwrite(path, 25, LENGTH_AT, struct.pack('<I', 5))
+    assert assert_same_failure(path).checked == 16
+    # and a damaged block before an illegal state change
+    remove_log(path)
+    seam_chain(path, {25: CustodyEvent(CASE_ID, 1, 'CHECKEDIN')})
+    overwrite(path, 15, LENGTH_AT, struct.pack('<I', 5))
+    assert assert_same_failure(path).checked == 16
+
+
+def test_parallel_verify_starts_from_the_checkpoint_as_serial_does(path):
+    payloads = seam_chain(path, {27: CustodyEvent(CASE_ID, 4, 'CHECKEDIN')})
+    remove_log(path)
+    store = BlockLog(path)
+    store.append_many(payloads[:12])
+    store.close()
+    assert verify(path).clean()
+    store = BlockLog(path)
+    store.append_many(payloads[12:])
+    store.close()
+    assert assert_same_failure(path, full=False).checked == 28 - 12
@@ -0,0 +1,245 @@
+import hashlib
+import mmap
+import os
+import pickle
+from blockstore import ANCHOR_STATE, BLOCK, DIGEST_STATE, GENESIS_STATE, RECORD_LEN, canonical_case_id
+'''~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    File Name:      verify.py
+    Description:    Streaming verification of the block log.
+                    Blocks are checked one at a time straight
+                    from disk, and a checkpoint remembers how
+                    far the chain has already been verified.
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+'''
+
+REMOVED_STATES = ('DISPOSED', 'DESTROYED', 'RELEASED')
+
+# state an item is in -> states it may move to next (None = not added yet)
+TRANSITIONS = {
+    None: ('CHECKEDIN',),
+    'CHECKEDIN': ('CHECKEDOUT',) + REMOVED_STATES,
+    'CHECKEDOUT': ('CHECKEDIN',),
+}
+
+
+class VerifyResult:
+    def __init__(self, count, checked, bad_block=None, reason=None):
+        self.count = count
+        self.checked = checked
+        self.bad_block = bad_block
+        self.reason = reason
+
+    def clean(self):
+        return self.bad_block is None
+
+    def report(self):
+        lines = [f"Transactions in blockchain: {self.count}"]
+        if self.clean():
+            lines.append("State of blockchain: CLEAN")
+        else:
+            lines.append("State of blockchain: ERROR")
+            lines.append(f"Bad block: {self.bad_block}")
+            lines.append(self.reason)
+        return '\n'.join(lines)
+
+
+# <path>.verified holds (CHECKPOINT_FORMAT, height, hash of the last
+# verified block, {item id: (state, case id bytes)} at that height); it is
+# only written after a clean run
+CHECKPOINT_FORMAT = 'verified-v2'
+
+
+class Checkpoint:
+    def __init__(self, store):
+        self.store = store
+        self.path = store.path + '.verified'
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                form, height, head, statuses = pickle.load(f)
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return 0, None, {}
+        if form != CHECKPOINT_FORMAT or height == 0 or height > len(self.store):
+            return 0, None, {}
+        if hashlib.sha256(self.store.read(height - 1)).hexdigest() != head:
+            return 0, None, {}
+        return height, bytes.fromhex(head), statuses
+
+    def save(self, height, head, statuses):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((CHECKPOINT_FORMAT, height, head.hex(), statuses), f)
+        os.replace(tmp_path, self.path)
+
+
+# returns what is wrong with moving `item_id` of case `case_id` (its 16
+# bytes) to `state`, or None if the move is legal; `statuses` (item id ->
+# (state, case id)) is updated when it is
+def check_transition(statuses, item_id, case_id, state, owner):
+    current, case = statuses.get(item_id, (None, case_id))
+    if case != case_id:
+        return (f"Item belongs to case {canonical_case_id(case)}, "
+                f"not case {canonical_case_id(case_id)}.")
+    # digests of an item's image leave it in the state it is in
+    if state == DIGEST_STATE:
+        if current is None:
+            return "Item was never added to the chain."
+        if current in REMOVED_STATES:
+            return "Digests recorded for an item after its removal from chain."
+        return None
+    if state not in TRANSITIONS.get(current, ()):
+        if current is None:
+            return "Item was never added to the chain."
+        if current in REMOVED_STATES:
+            return "Item checked out or checked in after removal from chain."
+        if state == 'CHECKEDIN' and current == 'CHECKEDIN':
+            return "Duplicate item or item checked in twice."
+        return f"Invalid state change: {current} -> {state}."
+    if state == 'RELEASED' and not owner:
+        return "Item released without owner information."
+    statuses[item_id] = (state, case_id)
+    return None
+
+
+# checks that a block record is well formed and returns its fields
+def parse_block(raw):
+    if len(raw) < BLOCK.size:
+        return None
+    fields = BLOCK.unpack_from(raw)
+    if BLOCK.size + fields[5] != len(raw):
+        return None
+    return fields
+
+
+# Checks everything about block i that does not depend on the blocks
+# before it: its layout and, for block 0, that it is the genesis block.
+# `states` (raw state -> name), when given, hands out one str per state.
+# Returns (what is wrong or None, (item id, case id, state, owner) of the
+# state change it records, or None for the genesis block and anchors).
+def block_event(i, raw, states=None):
+    fields = parse_block(raw)
+    if fields is None:
+        return "Block contents do not match block checksum.", None
+    prev, micros, case_id, item_id, state, length = fields
+    name = states.get(state) if states is not None else None
+    if name is None:
+        name = state.rstrip(b'\0').decode('ascii', 'replace')
+        if states is not None:
+            states[state] = name
+    if i == 0:
+        if prev != bytes(32) or name != GENESIS_STATE:
+            return "Initial block is missing or damaged.", None
+        return None, None
+    if name == ANCHOR_STATE:
+        return None, None
+    return None, (item_id, case_id, name, raw[BLOCK.size:])
+
+
+# everything about block i; `linked` says whether its link to the block
+# before it holds (it is checked after the layout and before the state
+# change, in the same order verify always reports)
+def check_block(i, raw, linked, statuses):
+    reason, event = block_event(i, raw)
+    if reason is not None or i == 0:
+        return reason
+    if not linked:
+        return "Parent block: NOT FOUND"
+    if event is None:
+        return None
+    return check_transition(statuses, *event)
+
+
+def read_record(mm, offset):
+    (length,) = RECORD_LEN.unpack_from(mm, offset)
+    start = offset + RECORD_LEN.size
+    return mm[start:start + length]
+
+
+# Worker for parallel verification: checks the blocks at `offsets` (block
+# numbers start..start+len-1) from its own mapping of the log, all but the
+# state changes, which depend on every block before the segment. Returns
+# the first block in the segment that fails and why (or None, None), the
+# prev hash stored in the segment's first block, the state changes up to
+# the failure as (block number, item id, case id, state, owner) and the
+# digest of the segment's last block, so the caller can check the seams
+# and replay the state changes in order.
+def check_segment(path, start, offsets):
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        first_prev = read_record(mm, offsets[0])[:32]
+        events = []
+        # so the events pickle each state name once
+        states = {}
+        digest = None
+        for n, offset in enumerate(offsets):
+            i = start + n
+            raw = read_record(mm, offset)
+            reason, event = block_event(i, raw, states)
+            if reason is None and n and raw[:32] != digest:
+                reason = "Parent block: NOT FOUND"
+            if reason is not None:
+                return i, reason, first_prev, events, None
+            if event is not None:
+                events.append((i,) + event)
+            digest = hashlib.sha256(raw).digest()
+        return None, None, first_prev, events, digest
+    finally:
+        mm.close()
+
+
+# Checks blocks [start, stop) on `jobs` processes, each taking one segment
+# of the chain, and replays the state changes they send back through
+# `statuses`. Returns the first block that fails and why, or None, None,
+# and the digest of the last block.
+def check_segments(store, start, stop, prev_digest, statuses, jobs):
+    import concurrent.futures
+    size = -(-(stop - start) // jobs)
+    bounds = [(lo, min(lo + size, stop)) for lo in range(start, stop, size)]
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(check_segment, store.path, lo, store.offsets[lo - store.base:hi - store.base])
+                   for lo, hi in bounds]
+        for (lo, hi), future in zip(bounds, futures):
+            bad, reason, first_prev, events, digest = future.result()
+            if bad != lo and lo > 0 and first_prev != prev_digest:
+                return lo, "Parent block: NOT FOUND", None
+            for i, item_id, case_id, state, owner in events:
+                failure = check_transition(statuses, item_id, case_id, state, owner)
+                if failure is not None:
+                    return i, failure, None
+            if bad is not None:
+                return bad, reason, None
+            prev_digest = digest
+    return None, None, prev_digest
+
+
+# Streams every block the checkpoint has not covered (all of them with
+# full=True), checking the prev-hash links, block layout, duplicate items
+# and state transitions. Only the current block and the item states are
+# kept in memory. With jobs > 1 the blocks are read, parsed and hashed
+# across processes and this one only replays the state changes they
+# return; the first failure reported is the same either way. Blocks in
+# cold storage are read here, decompressing one segment at a time, before
+# the ones after them are split across the processes.
+def verify_chain(store, full=False, jobs=1):
+    checkpoint = Checkpoint(store)
+    start, prev_digest, statuses = (0, None, {}) if full else checkpoint.load()
+    stop = len(store)
+    split = max(start, store.base)
+    if jobs < 2 or stop - split <= jobs:
+        split = stop
+    for i in range(start, split):
+        raw = store.read(i)
+        reason = check_block(i, raw, raw[:32] == prev_digest, statuses)
+        digest = hashlib.sha256(raw).digest()
+        if reason is not None:
+            return VerifyResult(stop, i - start + 1, digest.hex(), reason)
+        prev_digest = digest
+    if split < stop:
+        bad, reason, prev_digest = check_segments(store, split, stop, prev_digest, statuses, jobs)
+        if bad is not None:
+            return VerifyResult(stop, bad - start + 1, hashlib.sha256(store.read(bad)).hexdigest(), reason)
+    if stop > start:
+        checkpoint.save(stop, prev_digest, statuses)
+    return VerifyResult(stop, stop - start)